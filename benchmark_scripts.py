@@ -0,0 +1,266 @@
+from pathlib import Path # Pathlib documentation, very useful if unfamiliar:
+                         #   https://docs.python.org/3/library/pathlib.html
+import logging
+
+import sys
+import json
+import time
+import math
+import platform
+import tempfile
+import importlib.util
+import sqlite3
+import numpy
+import pandas
+
+import convert_scope_data
+import convert_csv_to_sqlite
+import plot_IV_curve
+import generate_scope_data
+
+from run_storage import output_writers
+
+# Number of files, i.e. triggers, of each run size. Every file has 2 waveforms of 1000 points
+benchmark_sizes = {
+    "small": 100,
+    "medium": 1000,
+    "large": 10000,
+}
+
+def best_time(function, repeat:int=3):
+    # Shortest time of repeat calls of the function, in seconds, and the result of the last call
+    best_seconds = None
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        result = function()
+        seconds = time.perf_counter() - start_time
+        if best_seconds is None or seconds < best_seconds:
+            best_seconds = seconds
+    return best_seconds, result
+
+def merged_run_buffers(parsed_buffers:dict, parsed_channel_map:dict):
+    run_buffers = convert_scope_data.create_run_buffers()
+    convert_scope_data.merge_run_buffers(run_buffers, {}, 0, parsed_buffers, parsed_channel_map)
+    return run_buffers
+
+def averaged_run_buffers(run_buffers:dict):
+    waveform_average = convert_scope_data.WaveformAverage()
+    convert_scope_data.update_waveform_average(waveform_average, run_buffers, 0, 0)
+    return waveform_average
+
+def write_run_buffers(run_buffers:dict, output_format:str, path:Path):
+    # Same tables as written by convert_scope_data, without clearing the buffers so they can be written again
+    with output_writers[output_format](path) as writer:
+        for table_name in ["run_metadata", "waveform_metadata", "waveform_buffer_metadata", "waveforms"]:
+            writer.write(table_name, run_buffers[table_name].to_dataframe())
+
+def iv_curve_dataframe(num_points:int):
+    # Reverse bias sweep of an LGAD: a leakage current rising slowly with the bias voltage, followed by the breakdown
+    bias_voltage = numpy.linspace(0, 300, num_points)
+    bias_current = 1e-9*(1 + bias_voltage/100) + 1e-12*numpy.exp(bias_voltage/25)
+    return pandas.DataFrame({"Bias voltage (V)": bias_voltage, "Bias current (A)": bias_current})
+
+def benchmark_size(num_files:int, work_dir:Path, repeat:int=3, jobs:int=1):
+    # Times each stage of the conversion, and of the IV curve scripts, on a synthetic run with num_files files.
+    # Returns the timings, in seconds, and values summarising the results, which must not change between versions
+    script_logger = logging.getLogger('benchmark_scripts')
+
+    timings = {}
+    results = {}
+
+    data_dir = work_dir/'scope_data'
+    paths, _ = generate_scope_data.script_main(data_dir, num_files, seed=0)
+
+    with convert_scope_data.InfiniiumBinaryFile(paths[0]) as scope_file:
+        layout = convert_scope_data.InfiniiumFileLayout(scope_file)
+
+    script_logger.info("Parsing {} files one by one".format(num_files))
+    timings["parse_files"], _ = best_time(lambda: convert_scope_data.parse_scope_files(paths), repeat)
+    script_logger.info("Parsing {} files in uniform blocks".format(num_files))
+    timings["parse_blocks"], (parsed_buffers, parsed_channel_map, file_names, _, _) = best_time(lambda: convert_scope_data.parse_scope_files(paths, layout), repeat)
+
+    timings["merge"], run_buffers = best_time(lambda: merged_run_buffers(parsed_buffers, parsed_channel_map), repeat)
+    del parsed_buffers
+    del parsed_channel_map
+
+    timings["average"], waveform_average = best_time(lambda: averaged_run_buffers(run_buffers), repeat)
+
+    for output_format in output_writers:
+        if output_format == "parquet" and importlib.util.find_spec("pyarrow") is None:
+            script_logger.info("pyarrow is not installed, skipping the parquet output")
+            continue
+        write_paths = iter(work_dir/'write_{}.{}'.format(idx, output_format) for idx in range(repeat))
+        timings["write_{}".format(output_format)], _ = best_time(lambda: write_run_buffers(run_buffers, output_format, next(write_paths)), repeat)
+        del write_paths
+
+    convert_paths = iter(work_dir/'convert_{}'.format(idx) for idx in range(repeat))
+    timings["convert"], _ = best_time(lambda: convert_scope_data.script_main(data_dir, next(convert_paths), jobs=jobs, plots=False), repeat)
+    del convert_paths
+
+    average_waveform_df = waveform_average.to_dataframe()
+    results["files"] = len(file_names)
+    results["waveforms"] = len(run_buffers["waveform_metadata"])
+    results["samples"] = len(run_buffers["waveforms"])
+    results["sample_sum"] = float(run_buffers["waveforms"].column("y").sum(dtype=numpy.float64))
+    results["average_sum"] = float(average_waveform_df["y"].sum())
+    del run_buffers
+    del waveform_average
+    del average_waveform_df
+
+    csv_file = work_dir/'IV.csv'
+    iv_curve_dataframe(10*num_files).to_csv(csv_file, index=False)
+    iv_paths = iter(work_dir/'IV_{}'.format(idx) for idx in range(repeat))
+    timings["convert_csv_to_sqlite"], _ = best_time(lambda: convert_csv_to_sqlite.script_main(next(iv_paths), csv_file), repeat)
+    del iv_paths
+    timings["plot_IV_curve"], _ = best_time(lambda: plot_IV_curve.script_main(work_dir/'IV_0', "benchmark"), repeat)
+
+    with sqlite3.connect(work_dir/'IV_0'/'data'/'measurements.sqlite') as sqlite3_connection:
+        results["iv_points"], results["iv_current_sum"] = sqlite3_connection.execute('SELECT COUNT(*), SUM("Bias current (A)") FROM measurements').fetchone()
+
+    return timings, results
+
+def compare_with_baseline(benchmarks:dict, baseline:dict, tolerance:float=1.5, min_difference:float=0.05):
+    # Prints the timings next to the baseline, returns the number of stages slower than tolerance times the baseline
+    # and of results which differ from the baseline
+    failures = 0
+    for size, size_benchmarks in benchmarks.items():
+        size_baseline = baseline.get(size)
+        if size_baseline is None:
+            print("{:<8} no baseline".format(size))
+            continue
+
+        for stage, seconds in size_benchmarks["timings"].items():
+            baseline_seconds = size_baseline["timings"].get(stage)
+            if baseline_seconds is None:
+                print("{:<8} {:<24} {:8.3f} s (no baseline)".format(size, stage, seconds))
+                continue
+            status = "OK"
+            if seconds > baseline_seconds*tolerance and seconds - baseline_seconds > min_difference:
+                status = "SLOWER"
+                failures += 1
+            print("{:<8} {:<24} {:8.3f} s (baseline {:8.3f} s, {:5.2f}x) {}".format(size, stage, seconds, baseline_seconds, seconds/max(baseline_seconds, 1e-9), status))
+
+        for name, value in size_benchmarks["results"].items():
+            baseline_value = size_baseline["results"].get(name)
+            if baseline_value is not None and not math.isclose(value, baseline_value, rel_tol=1e-9):
+                print("{:<8} result {} is {}, but {} in the baseline".format(size, name, value, baseline_value))
+                failures += 1
+    return failures
+
+def script_main(sizes:list, baseline_file:Path, save_baseline:bool=False, repeat:int=3, tolerance:float=1.5, min_difference:float=0.05, jobs:int=1):
+    script_logger = logging.getLogger('benchmark_scripts')
+
+    benchmarks = {}
+    for size in sizes:
+        script_logger.info("Benchmarking the {} run, with {} files".format(size, benchmark_sizes[size]))
+        with tempfile.TemporaryDirectory(prefix='benchmark_scripts_') as work_dir:
+            timings, results = benchmark_size(benchmark_sizes[size], Path(work_dir), repeat, jobs)
+        benchmarks[size] = {"files": benchmark_sizes[size], "timings": timings, "results": results}
+
+    if save_baseline:
+        baseline = {}
+        if baseline_file.is_file(): # Keep the sizes which were not benchmarked now
+            with open(baseline_file) as in_file:
+                baseline = json.load(in_file)
+        baseline.update(benchmarks)
+        baseline["environment"] = {"python": platform.python_version(), "numpy": numpy.__version__, "pandas": pandas.__version__, "machine": platform.machine()}
+        with open(baseline_file, 'w') as out_file:
+            json.dump(baseline, out_file, indent=4)
+        for size, size_benchmarks in benchmarks.items():
+            for stage, seconds in size_benchmarks["timings"].items():
+                print("{:<8} {:<24} {:8.3f} s".format(size, stage, seconds))
+        print("Saved the baseline into {}".format(baseline_file))
+        return 0
+
+    if not baseline_file.is_file():
+        script_logger.error("The baseline file {} does not exist, create it with --save-baseline".format(baseline_file))
+        return 1
+
+    with open(baseline_file) as in_file:
+        baseline = json.load(in_file)
+    return compare_with_baseline(benchmarks, baseline, tolerance, min_difference)
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Times the parsing, writing and averaging of scope data and the IV curve scripts on synthetic runs of several sizes, and compares them with a stored baseline')
+    parser.add_argument(
+        '--sizes',
+        help = 'Run sizes to benchmark. Default: small medium',
+        choices = list(benchmark_sizes),
+        default = ["small", "medium"],
+        nargs = '+',
+        dest = 'sizes',
+    )
+    parser.add_argument(
+        '-b',
+        '--baseline',
+        metavar = 'path',
+        help = 'Path to the baseline file. Default: ./benchmark_baseline.json',
+        default = "./benchmark_baseline.json",
+        dest = 'baseline',
+        type = str,
+    )
+    parser.add_argument(
+        '--save-baseline',
+        help = 'Save the timings and results as the new baseline, instead of comparing with it',
+        action = 'store_true',
+        dest = 'save_baseline',
+    )
+    parser.add_argument(
+        '-r',
+        '--repeat',
+        help = 'Number of times each stage is run, the shortest time is used. Default: 3',
+        default = 3,
+        dest = 'repeat',
+        type = int,
+    )
+    parser.add_argument(
+        '-t',
+        '--tolerance',
+        help = 'A stage is reported as slower when it takes more than this factor times the baseline. Default: 1.5',
+        default = 1.5,
+        dest = 'tolerance',
+        type = float,
+    )
+    parser.add_argument(
+        '--min-difference',
+        help = 'Differences to the baseline below this number of seconds are ignored, since they are mostly noise. Default: 0.05',
+        default = 0.05,
+        dest = 'min_difference',
+        type = float,
+    )
+    parser.add_argument(
+        '-j',
+        '--jobs',
+        help = 'Number of processes used to parse the files in the full conversion. Default: 1',
+        default = 1,
+        dest = 'jobs',
+        type = int,
+    )
+    parser.add_argument(
+        '-l',
+        '--log-level',
+        help = 'Set the logging level',
+        choices = ["CRITICAL","ERROR","WARNING","INFO","DEBUG","NOTSET"],
+        default = "ERROR",
+        dest = 'log_level',
+    )
+
+    args = parser.parse_args()
+
+    if args.log_level == "CRITICAL":
+        logging.basicConfig(level=50)
+    elif args.log_level == "ERROR":
+        logging.basicConfig(level=40)
+    elif args.log_level == "WARNING":
+        logging.basicConfig(level=30)
+    elif args.log_level == "INFO":
+        logging.basicConfig(level=20)
+    elif args.log_level == "DEBUG":
+        logging.basicConfig(level=10)
+    elif args.log_level == "NOTSET":
+        logging.basicConfig(level=0)
+
+    if script_main(args.sizes, Path(args.baseline), args.save_baseline, args.repeat, args.tolerance, args.min_difference, args.jobs) > 0:
+        sys.exit(1)
@@ -0,0 +1,117 @@
+from pathlib import Path # Pathlib documentation, very useful if unfamiliar:
+                         #   https://docs.python.org/3/library/pathlib.html
+import logging
+
+import subprocess
+import sys
+
+# Time budget, in seconds, for importing each of the scripts, i.e. the startup time before they start doing any work
+import_time_budgets = {
+    "convert_scope_data": 0.8,
+    "convert_csv_to_sqlite": 0.8,
+    "plot_IV_curve": 0.8,
+    "extract_pulse_features": 0.8,
+    "compute_time_resolution": 0.8,
+    "reduce_waveforms": 0.8,
+    "run_storage": 0.6,
+}
+
+# Modules which are only imported on the code paths that need them, so they must not be imported at startup
+lazy_modules = [
+    "plotly",
+    "pyarrow.parquet",
+]
+
+def measure_import_time(module:str, repeat:int=3):
+    # Returns the shortest cumulative import time of the module, in seconds, and the set of modules imported with it.
+    # Each measurement is done in a new interpreter, with the output of python -X importtime
+    best_time = None
+    imported_modules = set()
+    for _ in range(repeat):
+        result = subprocess.run(
+                                [sys.executable, "-X", "importtime", "-c", "import {}".format(module)],
+                                cwd = Path(__file__).parent,
+                                capture_output = True,
+                                text = True,
+                            )
+        if result.returncode != 0:
+            raise RuntimeError("Unable to import {}:\n{}".format(module, result.stderr))
+
+        for line in result.stderr.splitlines():
+            if not line.startswith("import time:") or "|" not in line:
+                continue
+            _, cumulative_time, name = line.split("|")
+            if not cumulative_time.strip().isdigit(): # The header line
+                continue
+            imported_modules.add(name.strip())
+            if name.strip() == module:
+                module_time = int(cumulative_time)*1e-6
+                if best_time is None or module_time < best_time:
+                    best_time = module_time
+    return best_time, imported_modules
+
+def script_main(budget_factor:float=1, repeat:int=3):
+    script_logger = logging.getLogger('check_import_time')
+
+    failures = 0
+    for module, budget in import_time_budgets.items():
+        import_time, imported_modules = measure_import_time(module, repeat)
+        eager_modules = [name for name in lazy_modules if name in imported_modules]
+
+        status = "OK"
+        if import_time > budget*budget_factor or len(eager_modules) > 0:
+            status = "FAIL"
+            failures += 1
+        print("{:<24} {:6.3f} s (budget {:6.3f} s) {}".format(module, import_time, budget*budget_factor, status))
+        if len(eager_modules) > 0:
+            print("    imports at startup: {}".format(", ".join(eager_modules)))
+        script_logger.debug("Modules imported by {}: {}".format(module, sorted(imported_modules)))
+
+    return failures
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Checks the time it takes to import each script against its budget, so that slow startup is noticed')
+    parser.add_argument(
+        '-f',
+        '--budget-factor',
+        help = 'Scale all the budgets by this factor, e.g. for slower machines. Default: 1',
+        default = 1,
+        dest = 'budget_factor',
+        type = float,
+    )
+    parser.add_argument(
+        '-r',
+        '--repeat',
+        help = 'Number of times each import is measured, the shortest time is used. Default: 3',
+        default = 3,
+        dest = 'repeat',
+        type = int,
+    )
+    parser.add_argument(
+        '-l',
+        '--log-level',
+        help = 'Set the logging level',
+        choices = ["CRITICAL","ERROR","WARNING","INFO","DEBUG","NOTSET"],
+        default = "ERROR",
+        dest = 'log_level',
+    )
+
+    args = parser.parse_args()
+
+    if args.log_level == "CRITICAL":
+        logging.basicConfig(level=50)
+    elif args.log_level == "ERROR":
+        logging.basicConfig(level=40)
+    elif args.log_level == "WARNING":
+        logging.basicConfig(level=30)
+    elif args.log_level == "INFO":
+        logging.basicConfig(level=20)
+    elif args.log_level == "DEBUG":
+        logging.basicConfig(level=10)
+    elif args.log_level == "NOTSET":
+        logging.basicConfig(level=0)
+
+    if script_main(args.budget_factor, args.repeat) > 0:
+        sys.exit(1)
@@ -0,0 +1,356 @@
+from pathlib import Path # Pathlib documentation, very useful if unfamiliar:
+                         #   https://docs.python.org/3/library/pathlib.html
+import logging
+
+import itertools
+import numpy
+import pandas
+
+import lip_pps_run_manager as RM
+
+from tqdm import tqdm
+
+from run_storage import output_writers, read_table, read_schema_version, read_waveform_array, find_converted_output, trigger_batches, map_trigger_batches_in_order
+from extract_pulse_features import baseline_subtracted_pulses, threshold_crossings
+
+def cfd_times(
+        samples:numpy.ndarray,
+        number_points:numpy.ndarray,
+        x_origin:numpy.ndarray,
+        x_increment:numpy.ndarray,
+        fractions:list,
+        baseline_fraction:float=0.1,
+        polarity:str="auto",
+        min_amplitude_sigmas:float=5,
+        ):
+    # Constant fraction discriminator: time at which the leading edge of each pulse crosses each fraction of its amplitude, linearly interpolated
+    # between the samples. Returns a (pulses, fractions) array, with NaN for the pulses smaller than min_amplitude_sigmas times their noise
+    signal, _, noise_rms, _, peak_idx, amplitude = baseline_subtracted_pulses(samples, number_points, baseline_fraction, polarity)
+
+    # The crossings of all the fractions are between the crossing of the lowest one and the peak, so only that window of the leading edge is searched.
+    # The pulses without a crossing of the lowest fraction, e.g. cut at the start of the acquisition, have an empty window and no times
+    lowest_crossing = threshold_crossings(signal, min(fractions)*amplitude, peak_idx)
+    edge_start = numpy.where(numpy.isfinite(lowest_crossing), numpy.floor(numpy.nan_to_num(lowest_crossing)), peak_idx).astype(int)
+    edge_idx = numpy.minimum(edge_start[:, None] + numpy.arange((peak_idx - edge_start).max() + 2), signal.shape[1] - 1)
+    leading_edge = signal[numpy.arange(len(signal))[:, None], edge_idx]
+    del edge_idx
+
+    crossings = edge_start[:, None] + numpy.stack([threshold_crossings(leading_edge, fraction*amplitude, peak_idx - edge_start) for fraction in fractions], axis=1)
+    times = x_origin[:, None] + crossings*x_increment[:, None]
+    times[(amplitude < min_amplitude_sigmas*noise_rms) | ~numpy.isfinite(lowest_crossing)] = numpy.nan
+    return times
+
+def cfd_batch_times(path:Path, output_format:str, trigger_range:tuple, schema_version:int, cfd_options:dict):
+    # Reads the waveforms of a range of triggers and returns their keys and their CFD times, as returned by cfd_times
+    metadata_df, samples = read_waveform_array(path, output_format, trigger_range, schema_version)
+    if len(metadata_df) == 0:
+        return metadata_df, numpy.zeros((0, len(cfd_options["fractions"])))
+
+    times = cfd_times(
+                        samples,
+                        metadata_df["number_points"].to_numpy(),
+                        metadata_df["x_origin"].to_numpy(),
+                        metadata_df["x_increment"].to_numpy(),
+                        **cfd_options,
+                    )
+    return metadata_df[["n_trigger", "channel_idx", "waveform_idx"]], times
+
+def fit_gaussian(values:numpy.ndarray, bins:int=100):
+    # Histograms the finite values in a range of 5 robust standard deviations around their median and fits a gaussian to the core of the histogram,
+    # as a weighted least squares fit of a parabola to the logarithm of the counts. Returns the bin edges, the counts and a dictionary with the
+    # number of entries and the fitted mean, sigma, sigma error and amplitude. The fit values are NaN when there are too few entries
+    values = values[numpy.isfinite(values)]
+    fit = {"entries": len(values), "mean": numpy.nan, "sigma": numpy.nan, "sigma_error": numpy.nan, "amplitude": numpy.nan}
+    if len(values) < 3:
+        return numpy.zeros(bins + 1), numpy.zeros(bins, dtype=int), fit
+
+    median = numpy.median(values)
+    spread = 1.4826*numpy.median(numpy.abs(values - median)) # Standard deviation of a gaussian, but insensitive to the tails
+    if spread == 0:
+        spread = max(values.std(), numpy.finfo(float).tiny)
+    edges = numpy.linspace(median - 5*spread, median + 5*spread, bins + 1)
+    counts, _ = numpy.histogram(values, edges)
+
+    centers = (edges[1:] + edges[:-1])/2
+    scaled_centers = (centers - median)/spread # Keeps the fit well conditioned
+    core = (counts > 0) & (numpy.abs(scaled_centers) < 2.5)
+    if core.sum() < 3:
+        return edges, counts, fit
+
+    weights = numpy.sqrt(counts[core]) # The error of the logarithm of a Poisson count is 1/sqrt(count)
+    design = numpy.stack([numpy.ones(core.sum()), scaled_centers[core], scaled_centers[core]**2], axis=1)
+    (constant, linear, quadratic), *_ = numpy.linalg.lstsq(design*weights[:, None], numpy.log(counts[core])*weights, rcond=None)
+    if quadratic >= 0: # Not peaked, e.g. a flat distribution
+        return edges, counts, fit
+
+    fit["sigma"] = spread*numpy.sqrt(-1/(2*quadratic))
+    fit["mean"] = median - spread*linear/(2*quadratic)
+    fit["amplitude"] = numpy.exp(constant - linear**2/(4*quadratic))
+    fit["sigma_error"] = fit["sigma"]/numpy.sqrt(2*counts[core].sum())
+    return edges, counts, fit
+
+def plot_time_resolution(resolution_df:pandas.DataFrame, histograms_df:pandas.DataFrame, task_path:Path):
+    import plotly.express as px # Slow to import, so only imported when plotting
+    import plotly.graph_objects as go
+
+    fig = px.line(
+        resolution_df.reset_index(),
+        x = 'cfd_fraction',
+        y = 'sigma',
+        error_y = 'sigma_error',
+        color = 'pair',
+        markers = True,
+        labels = {
+            "cfd_fraction": "CFD fraction",
+            "sigma": "Time difference sigma (s)",
+            "pair": "Channels",
+        },
+        title = "Time resolution of each pair of channels",
+    )
+    fig.write_html(
+        task_path/'time_resolution.html',
+        include_plotlyjs = 'cdn',
+    )
+
+    # Histogram of the best fraction of each pair, with the fitted gaussian
+    fig = go.Figure()
+    for pair, pair_df in resolution_df.reset_index().groupby("pair", sort=False):
+        best = pair_df.loc[pair_df["sigma"].idxmin()] if pair_df["sigma"].notna().any() else pair_df.iloc[0]
+        histogram_df = histograms_df.reset_index()
+        histogram_df = histogram_df[(histogram_df["channel_a_idx"] == best["channel_a_idx"]) & (histogram_df["channel_b_idx"] == best["channel_b_idx"]) & (histogram_df["cfd_fraction"] == best["cfd_fraction"])]
+        bin_centers = (histogram_df["bin_low"] + histogram_df["bin_high"])/2
+        fig.add_trace(go.Bar(x=bin_centers, y=histogram_df["count"], name="{} (CFD {:.2f})".format(pair, best["cfd_fraction"]), opacity=0.6))
+        if numpy.isfinite(best["sigma"]):
+            fig.add_trace(go.Scatter(
+                x = bin_centers,
+                y = best["fit_amplitude"]*numpy.exp(-(bin_centers - best["mean"])**2/(2*best["sigma"]**2)),
+                name = "Fit {}: sigma = {:.2f} ps".format(pair, best["sigma"]*1e12),
+                mode = 'lines',
+            ))
+    fig.update_layout(
+        barmode = 'overlay',
+        title = "Time differences at the best CFD fraction",
+        xaxis_title = "Time difference (s)",
+        yaxis_title = "Triggers",
+    )
+    fig.write_html(
+        task_path/'time_difference_histograms.html',
+        include_plotlyjs = 'cdn',
+    )
+
+def script_main(
+        run_directory:Path,
+        fractions:list=[0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9],
+        bins:int=100,
+        batch_size:int=1000,
+        jobs:int=1,
+        baseline_fraction:float=0.1,
+        polarity:str="auto",
+        min_amplitude_sigmas:float=5,
+        plots:bool=True,
+        ):
+    script_logger = logging.getLogger('compute_time_resolution')
+
+    with RM.RunManager(run_directory.resolve()) as John:
+        John.create_run(raise_error=False)
+
+        if not John.task_completed("convert_scope_data"):
+            script_logger.error("You must first convert the scope data with convert_scope_data.py")
+            return
+
+        output_path, output_format = find_converted_output(John.path_directory/"data")
+        if output_path is None:
+            script_logger.error("No converted waveforms found in {}".format(John.path_directory/"data"))
+            return
+
+        with John.handle_task("compute_time_resolution") as Sofia:
+            schema_version = read_schema_version(output_path, output_format)
+            channel_map_df = read_table(output_path, output_format, 'channel_map')
+            channel_names = dict(zip(channel_map_df["channel_idx"].astype(int), channel_map_df["channel_name"]))
+            del channel_map_df
+
+            trigger_ranges = trigger_batches(output_path, output_format, batch_size)
+            if len(trigger_ranges) == 0:
+                script_logger.error("The run has no triggers")
+                return
+            cfd_options = {
+                "fractions": list(fractions),
+                "baseline_fraction": baseline_fraction,
+                "polarity": polarity,
+                "min_amplitude_sigmas": min_amplitude_sigmas,
+            }
+
+            # CFD time of every (trigger, channel) for each fraction, in single precision to keep 1M triggers within a few hundred MB.
+            # The times are a few ns, so the rounding is below 1 fs
+            # Only the first waveform of each channel in each trigger is used, the time differences are between channels
+            times = numpy.full((trigger_ranges[-1][1] + 1, max(channel_names) + 1, len(fractions)), numpy.nan, dtype=numpy.float32)
+            num_ignored_waveforms = 0
+            with tqdm(total=len(trigger_ranges), desc="Computing CFD times...") as progress_bar:
+                for keys_df, batch_times in map_trigger_batches_in_order(cfd_batch_times, output_path, output_format, trigger_ranges, schema_version, cfd_options, jobs):
+                    first_waveform = ~keys_df.duplicated(["n_trigger", "channel_idx"]).to_numpy()
+                    num_ignored_waveforms += len(first_waveform) - first_waveform.sum()
+                    times[keys_df["n_trigger"].to_numpy()[first_waveform], keys_df["channel_idx"].to_numpy()[first_waveform]] = batch_times[first_waveform]
+                    progress_bar.update(1)
+            del trigger_ranges
+            if num_ignored_waveforms > 0:
+                script_logger.warning("Ignored {} waveforms of channels with more than one waveform in a trigger, only the first waveform of each channel in each trigger is used".format(num_ignored_waveforms))
+
+            resolution_rows = []
+            histogram_dfs = []
+            for channel_a_idx, channel_b_idx in itertools.combinations(sorted(channel_names), 2):
+                differences = times[:, channel_b_idx, :].astype(float) - times[:, channel_a_idx, :].astype(float)
+                for fraction_idx, fraction in enumerate(fractions):
+                    edges, counts, fit = fit_gaussian(differences[:, fraction_idx], bins)
+                    script_logger.info("{} - {}, CFD {:.2f}: sigma = {:.2f} ps from {} triggers".format(channel_names[channel_b_idx], channel_names[channel_a_idx], fraction, fit["sigma"]*1e12, fit["entries"]))
+                    resolution_rows += [{
+                        "channel_a_idx": channel_a_idx,
+                        "channel_b_idx": channel_b_idx,
+                        "cfd_fraction": fraction,
+                        "pair": "{} - {}".format(channel_names[channel_b_idx], channel_names[channel_a_idx]),
+                        "entries": fit["entries"],
+                        "mean": fit["mean"],
+                        "sigma": fit["sigma"],
+                        "sigma_error": fit["sigma_error"],
+                        "fit_amplitude": fit["amplitude"],
+                    }]
+                    histogram_dfs += [pandas.DataFrame({
+                        "channel_a_idx": channel_a_idx,
+                        "channel_b_idx": channel_b_idx,
+                        "cfd_fraction": fraction,
+                        "bin_idx": numpy.arange(bins),
+                        "bin_low": edges[:-1],
+                        "bin_high": edges[1:],
+                        "count": counts,
+                    })]
+                del differences
+            del times
+
+            if len(resolution_rows) == 0:
+                script_logger.error("At least two channels are needed for the time differences")
+                return
+            resolution_df = pandas.DataFrame(resolution_rows).set_index(["channel_a_idx", "channel_b_idx", "cfd_fraction"])
+            histograms_df = pandas.concat(histogram_dfs).set_index(["channel_a_idx", "channel_b_idx", "cfd_fraction", "bin_idx"])
+            del resolution_rows
+            del histogram_dfs
+
+            script_logger.info('Saving the time resolution into database...')
+            with output_writers[output_format](output_path) as writer:
+                writer.write('cfd_time_resolution', resolution_df)
+                writer.write('cfd_time_difference_histograms', histograms_df)
+
+            if plots:
+                plot_time_resolution(resolution_df, histograms_df, Sofia.task_path)
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Computes the CFD time of the pulses of a run converted with convert_scope_data.py, for a scan of CFD fractions, and the time resolution of each pair of channels from a gaussian fit to their time differences')
+    parser.add_argument('--dir',
+        metavar = 'path',
+        help = 'Path to the run directory.',
+        required = True,
+        dest = 'directory',
+        type = str,
+    )
+    parser.add_argument(
+        '-f',
+        '--fractions',
+        help = 'CFD fractions to scan. Default: 0.1 to 0.9 in steps of 0.1',
+        default = [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9],
+        nargs = '+',
+        dest = 'fractions',
+        type = float,
+    )
+    parser.add_argument(
+        '--bins',
+        help = 'Number of bins of the time difference histograms. Default: 100',
+        default = 100,
+        dest = 'bins',
+        type = int,
+    )
+    parser.add_argument(
+        '--batch-size',
+        help = 'Number of triggers processed together. Default: 1000',
+        default = 1000,
+        dest = 'batch_size',
+        type = int,
+    )
+    parser.add_argument(
+        '-j',
+        '--jobs',
+        help = 'Number of processes used to read and process the batches of triggers. Default: 1',
+        default = 1,
+        dest = 'jobs',
+        type = int,
+    )
+    parser.add_argument(
+        '--baseline-fraction',
+        help = 'Fraction of each waveform, from its start, used for the baseline and the noise. Default: 0.1',
+        default = 0.1,
+        dest = 'baseline_fraction',
+        type = float,
+    )
+    parser.add_argument(
+        '--polarity',
+        help = 'Polarity of the pulses, with auto it is found for each waveform. Default: auto',
+        choices = ["auto", "positive", "negative"],
+        default = "auto",
+        dest = 'polarity',
+    )
+    parser.add_argument(
+        '--min-amplitude-sigmas',
+        help = 'Pulses with an amplitude below this number of times their noise RMS are not used. Default: 5',
+        default = 5,
+        dest = 'min_amplitude_sigmas',
+        type = float,
+    )
+    parser.add_argument(
+        '--no-plots',
+        help = 'Do not make the plots, only save the tables. plotly is then not imported',
+        action = 'store_false',
+        dest = 'plots',
+    )
+    parser.add_argument(
+        '-l',
+        '--log-level',
+        help = 'Set the logging level',
+        choices = ["CRITICAL","ERROR","WARNING","INFO","DEBUG","NOTSET"],
+        default = "ERROR",
+        dest = 'log_level',
+    )
+    parser.add_argument(
+        '--log-file',
+        help = 'If set, the full log will be saved to a file (i.e. the log level is ignored)',
+        action = 'store_true',
+        dest = 'log_file',
+    )
+
+    args = parser.parse_args()
+
+    if args.log_file:
+        logging.basicConfig(filename='logging.log', filemode='w', encoding='utf-8', level=logging.NOTSET)
+    else:
+        if args.log_level == "CRITICAL":
+            logging.basicConfig(level=50)
+        elif args.log_level == "ERROR":
+            logging.basicConfig(level=40)
+        elif args.log_level == "WARNING":
+            logging.basicConfig(level=30)
+        elif args.log_level == "INFO":
+            logging.basicConfig(level=20)
+        elif args.log_level == "DEBUG":
+            logging.basicConfig(level=10)
+        elif args.log_level == "NOTSET":
+            logging.basicConfig(level=0)
+
+    script_main(
+        Path(args.directory),
+        fractions = args.fractions,
+        bins = args.bins,
+        batch_size = args.batch_size,
+        jobs = args.jobs,
+        baseline_fraction = args.baseline_fraction,
+        polarity = args.polarity,
+        min_amplitude_sigmas = args.min_amplitude_sigmas,
+        plots = args.plots,
+    )
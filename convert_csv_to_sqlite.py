@@ -2,41 +2,103 @@ from pathlib import Path # Pathlib documentation, very useful if unfamiliar:
                          #   https://docs.python.org/3/library/pathlib.html
 import logging
 
-import sqlite3
 import pandas
 import shutil
 
-import plotly.express as px
-
 import lip_pps_run_manager as RM
 
-def script_main(run_directory: Path, csv_file: Path):
+from run_storage import SQLiteWriter
+
+def csv_column_dtypes(csv_files:list, infer_rows:int=10000):
+    # Fixed dtypes of the columns, inferred from the first infer_rows rows of every file, so that all the chunks are read into
+    # the same sqlite column types. Integer columns are nullable, columns which are integer in some files and floating point in
+    # others are floating point, and any other disagreement between the files is read as text
+    column_dtypes = {}
+    for csv_file in csv_files:
+        for column, dtype in pandas.read_csv(csv_file, nrows=infer_rows).dtypes.items():
+            if dtype.kind in "iu":
+                dtype = "Int64"
+            elif dtype.kind == "f":
+                dtype = "float64"
+            elif dtype.kind == "b":
+                dtype = "boolean"
+            else:
+                dtype = "str"
+
+            if column not in column_dtypes or column_dtypes[column] == dtype:
+                column_dtypes[column] = dtype
+            elif {column_dtypes[column], dtype} == {"Int64", "float64"}:
+                column_dtypes[column] = "float64"
+            else:
+                column_dtypes[column] = "str"
+    return column_dtypes
+
+def read_csv_chunks(csv_file:Path, column_dtypes:dict, chunk_size:int=100000):
+    # Chunks of chunk_size rows of the file, with all the columns in column_dtypes, in that order and with those dtypes,
+    # and the row number in the file as the index
+    with pandas.read_csv(csv_file, dtype={column: dtype for column, dtype in column_dtypes.items()}, chunksize=chunk_size) as reader:
+        first_row = 0
+        for chunk_df in reader:
+            for column, dtype in column_dtypes.items():
+                if column not in chunk_df.columns: # Only in some of the files
+                    chunk_df[column] = pandas.Series(None, index=chunk_df.index, dtype=dtype)
+            chunk_df = chunk_df[list(column_dtypes)]
+            chunk_df.index = pandas.RangeIndex(first_row, first_row + len(chunk_df), name="row")
+            first_row += len(chunk_df)
+            yield chunk_df
+
+def script_main(run_directory: Path, csv_files, chunk_size: int = 100000, infer_rows: int = 10000):
+    # The files are streamed into the measurements table in chunks of chunk_size rows, each written in its own transaction, so
+    # the memory used does not depend on the size of the files. With more than one file, the name of the file and the row
+    # number in it are stored in the source and row columns, which are indexed
     script_logger = logging.getLogger('convert_sqlite')
 
+    csv_files = [Path(csv_files)] if isinstance(csv_files, (str, Path)) else [Path(csv_file) for csv_file in csv_files] # A single file is also accepted
+
     if not run_directory.parent.is_dir():
         script_logger.info("The run base directory should be an existing directory")
         return
 
-    if not csv_file.is_file():
-        script_logger.info("The csv file with the measurement data must exist")
+    for csv_file in csv_files:
+        if not csv_file.is_file():
+            script_logger.info("The csv file with the measurement data must exist, {} does not".format(csv_file))
+            return
+
+    if len(set(csv_file.name for csv_file in csv_files)) < len(csv_files):
+        script_logger.error("The csv files must have different names, they are used as the source of the measurements")
         return
 
     with RM.RunManager(run_directory.resolve()) as Michael:
         Michael.create_run(raise_error=True)
 
         (Michael.path_directory/"data").mkdir()
-        shutil.copyfile(csv_file, (Michael.path_directory/"data"/"measurements.csv"))
+        if len(csv_files) == 1:
+            data_files = {csv_files[0].name: Michael.path_directory/"data"/"measurements.csv"}
+        else:
+            (Michael.path_directory/"data"/"measurements").mkdir()
+            data_files = {csv_file.name: Michael.path_directory/"data"/"measurements"/csv_file.name for csv_file in csv_files}
+        for csv_file in csv_files:
+            shutil.copyfile(csv_file, data_files[csv_file.name])
 
         with Michael.handle_task("convert_to_sqlite"):
             sqlite_file = Michael.path_directory/"data"/"measurements.sqlite"
 
-            with sqlite3.connect(sqlite_file) as sqlite3_connection:
-                measurements_df = pandas.read_csv(Michael.path_directory/"data"/"measurements.csv")
-
-                measurements_df.to_sql('measurements',
-                                        sqlite3_connection,
-                                        index=False,
-                                        if_exists='replace')
+            column_dtypes = csv_column_dtypes(data_files.values(), infer_rows)
+            script_logger.info("Column types: {}".format(column_dtypes))
+
+            with SQLiteWriter(sqlite_file) as writer:
+                for source, data_file in data_files.items():
+                    script_logger.info("Converting {}".format(source))
+                    try:
+                        for measurements_df in read_csv_chunks(data_file, column_dtypes, chunk_size):
+                            if len(data_files) == 1:
+                                writer.write('measurements', measurements_df, index=False)
+                            else:
+                                measurements_df.insert(0, "source", source)
+                                writer.write('measurements', measurements_df.set_index("source", append=True).swaplevel())
+                    except (ValueError, TypeError) as e:
+                        script_logger.error("The values of {} do not match the column types inferred from the first {} rows, try a larger --infer-rows: {}".format(source, infer_rows, e))
+                        raise
 
 if __name__ == '__main__':
     import argparse
@@ -51,11 +113,26 @@ if __name__ == '__main__':
     )
     parser.add_argument('--data',
         metavar = 'path',
-        help = 'Path to the csv file with the measurements.',
+        help = 'Path to the csv file with the measurements. With more than one file, the file of each measurement is stored in the source column',
         required = True,
-        dest = 'csv_file',
+        nargs = '+',
+        dest = 'csv_files',
         type = str,
     )
+    parser.add_argument(
+        '--chunk-size',
+        help = 'Number of rows read and written at a time, which bounds the memory used. Default: 100000',
+        default = 100000,
+        dest = 'chunk_size',
+        type = int,
+    )
+    parser.add_argument(
+        '--infer-rows',
+        help = 'Number of rows at the start of each file used to infer the type of the columns. Default: 10000',
+        default = 10000,
+        dest = 'infer_rows',
+        type = int,
+    )
     parser.add_argument(
         '-l',
         '--log-level',
@@ -89,4 +166,4 @@ if __name__ == '__main__':
         elif args.log_level == "NOTSET":
             logging.basicConfig(level=0)
 
-    script_main(Path(args.directory), Path(args.csv_file))
+    script_main(Path(args.directory), [Path(csv_file) for csv_file in args.csv_files], args.chunk_size, args.infer_rows)
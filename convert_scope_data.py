@@ -1,16 +1,20 @@
 from pathlib import Path # Pathlib documentation, very useful if unfamiliar:
                          #   https://docs.python.org/3/library/pathlib.html
-from distutils.dir_util import copy_tree
 import shutil
-import dateutil.parser as dp
-
-import plotly.express as px
+import os
+import re
 
 import logging
 
 import random
+import hashlib
+import functools
+import datetime
+import json
+import contextlib
+import time
+import zipfile
 import numpy
-import sqlite3
 import pandas
 
 import lip_pps_run_manager as RM
@@ -19,6 +23,11 @@ from math import sqrt
 
 from tqdm import tqdm
 
+from run_storage import output_writers, schema_versions, sample_codecs, expand_compact_waveforms, encode_sample_blobs, read_table, read_schema_version, read_sample_codec, table_exists, discard_triggers, init_worker_logging, merged_moments, WaveformStore
+
+from collections import deque, Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
 # structures for parsing the binary file format
 
 def InfiniiumUnitsToString(unit:int):
@@ -37,6 +46,69 @@ def InfiniiumUnitsToString(unit:int):
     else:
         return "Unknown"
 
+## Month abbreviations of the date_string header field, e.g. "17 OCT 2026", packed into integers so they can be looked up in arrays
+infiniium_months = numpy.array([int.from_bytes(month, "big") for month in [b"JAN", b"FEB", b"MAR", b"APR", b"MAY", b"JUN", b"JUL", b"AUG", b"SEP", b"OCT", b"NOV", b"DEC"]])
+infiniium_month_order = numpy.argsort(infiniium_months)
+
+@functools.lru_cache(maxsize=4096)
+def InfiniiumTimestampFallback(date_string:bytes, time_string:bytes):
+    # General parser for the header timestamps which do not follow the fixed format, only called once per distinct pair of strings
+    import dateutil.parser as dp
+
+    script_logger = logging.getLogger('convert_scope')
+
+    try:
+        timestamp = dp.parse(date_string.decode('utf-8') + ' ' + time_string.decode('utf-8'))
+    except (ValueError, OverflowError):
+        script_logger.warning("Unable to parse the waveform timestamp {!r} {!r}".format(date_string, time_string))
+        return numpy.datetime64('NaT', 'us')
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return numpy.datetime64(timestamp, 'us')
+
+def InfiniiumTimestamps(date_strings:numpy.ndarray, time_strings:numpy.ndarray):
+    # Converts arrays of date_string ("17 OCT 2026") and time_string ("10:12:00") header fields into a datetime64[us] array.
+    # The fixed format is decoded directly from the bytes of the whole arrays, the other formats fall back to the general parser
+    date_bytes = numpy.ascontiguousarray(date_strings, dtype='S16').reshape(-1).view(numpy.uint8).reshape(-1, 16).astype(numpy.int64)
+    time_bytes = numpy.ascontiguousarray(time_strings, dtype='S16').reshape(-1).view(numpy.uint8).reshape(-1, 16).astype(numpy.int64)
+
+    date_digits = date_bytes[:, [0, 1, 7, 8, 9, 10]] - ord('0')
+    time_digits = time_bytes[:, [0, 1, 3, 4, 6, 7]] - ord('0')
+    day    = date_digits[:, 0]*10 + date_digits[:, 1]
+    year   = date_digits[:, 2]*1000 + date_digits[:, 3]*100 + date_digits[:, 4]*10 + date_digits[:, 5]
+    hour   = time_digits[:, 0]*10 + time_digits[:, 1]
+    minute = time_digits[:, 2]*10 + time_digits[:, 3]
+    second = time_digits[:, 4]*10 + time_digits[:, 5]
+
+    month_code = ((date_bytes[:, 3] & 0xDF) << 16) | ((date_bytes[:, 4] & 0xDF) << 8) | (date_bytes[:, 5] & 0xDF)
+    month_position = numpy.searchsorted(infiniium_months[infiniium_month_order], month_code).clip(0, len(infiniium_months) - 1)
+    month = infiniium_month_order[month_position]
+
+    valid = ((date_digits >= 0) & (date_digits <= 9)).all(axis=1)
+    valid &= ((time_digits >= 0) & (time_digits <= 9)).all(axis=1)
+    valid &= (date_bytes[:, 2] == ord(' ')) & (date_bytes[:, 6] == ord(' ')) & (date_bytes[:, 11:] == 0).all(axis=1)
+    valid &= (time_bytes[:, 2] == ord(':')) & (time_bytes[:, 5] == ord(':')) & (time_bytes[:, 8:] == 0).all(axis=1)
+    valid &= infiniium_months[month] == month_code
+    valid &= (day >= 1) & (day <= 31) & (hour <= 23) & (minute <= 59) & (second <= 59)
+
+    month_start = (year - 1970).astype('M8[Y]').astype('M8[M]') + month.astype('m8[M]')
+    timestamps = month_start.astype('M8[D]') + (day - 1).astype('m8[D]')
+    valid &= timestamps.astype('M8[M]') == month_start # Days past the end of the month, e.g. 31 FEB, would roll over into the next one
+    timestamps = timestamps.astype('M8[us]') + (hour*3600 + minute*60 + second).astype('m8[s]')
+
+    if not valid.all():
+        invalid = numpy.flatnonzero(~valid)
+        pairs = numpy.stack([numpy.ascontiguousarray(date_strings, dtype='S16').reshape(-1)[invalid], numpy.ascontiguousarray(time_strings, dtype='S16').reshape(-1)[invalid]], axis=1)
+        unique_pairs, pair_inverse = numpy.unique(pairs.view('S32'), return_inverse=True)
+        unique_timestamps = numpy.array([InfiniiumTimestampFallback(pair[:16].rstrip(b'\0'), pair[16:]) for pair in unique_pairs.tolist()], dtype='M8[us]')
+        timestamps[invalid] = unique_timestamps[pair_inverse.ravel()]
+    return timestamps
+
+@functools.lru_cache(maxsize=4096)
+def InfiniiumTimestamp(date_string:bytes, time_string:bytes):
+    # Single header version of InfiniiumTimestamps, cached by the raw bytes since consecutive waveforms mostly share their timestamp
+    return InfiniiumTimestamps(numpy.array([date_string], dtype='S16'), numpy.array([time_string], dtype='S16'))[0]
+
 ## File header format
 file_header_dtype = numpy.dtype([('cookie', 'S2'),
                                  ('version', 'S2'),
@@ -68,11 +140,1588 @@ waveform_data_header_dtype = numpy.dtype([('header_size', 'i4'),
                                           ('bytes_per_point', 'i2'),
                                           ('buffer_size', 'i4')])
 
+def InfiniiumBufferDtype(buffer_type:int, bytes_per_point:int):
+    if buffer_type in [1,2,3,4,5]: # Float type data
+        return numpy.dtype('f{}'.format(bytes_per_point))
+    elif buffer_type == 6: # Unsigned type data
+        return numpy.dtype('u{}'.format(bytes_per_point))
+    else: # Unknown type data, read as RAW data
+        return numpy.dtype('V{}'.format(bytes_per_point))
+
+class InfiniiumFileError(Exception):
+    pass
+
+class InfiniiumBinaryFile:
+    """Memory-mapped reader for the Agilent/Infiniium binary waveform files.
+
+    Only the headers are parsed when the file is opened, the waveform buffers
+    are returned as zero-copy numpy views into the mapped file on request.
+    Any inconsistency in the file structure raises an InfiniiumFileError.
+    """
+    def __init__(self, path:Path):
+        self.path = Path(path)
+
+        if self.path.stat().st_size < file_header_dtype.itemsize:
+            raise InfiniiumFileError("The file {} is too small to contain an Agilent Binary Data header".format(self.path.name))
+
+        self._raw = numpy.memmap(self.path, dtype='u1', mode='r')
+
+        self.file_header = self._record(0, file_header_dtype)
+        if self.file_header['cookie'] != b'AG':
+            raise InfiniiumFileError("The file {} is not in the Agilent Binary Data format".format(self.path.name))
+
+        self.waveform_headers = []
+        self.buffer_headers = []
+        self._buffer_locations = [] # For each waveform, a list with the (offset, dtype, points) of each buffer
+
+        offset = file_header_dtype.itemsize
+        for waveform_idx in range(self.file_header['num_waveforms']):
+            waveform_header = self._record(offset, waveform_header_dtype)
+            if waveform_header['header_size'] != 140:
+                raise InfiniiumFileError("The waveform header has a length which is not 140. This is unexpected and requires fixing")
+            offset += waveform_header_dtype.itemsize
+
+            buffer_headers = []
+            buffer_locations = []
+            processed_points = 0
+            for buffer_idx in range(waveform_header['num_waveform_buffers']):
+                buffer_header = self._record(offset, waveform_data_header_dtype)
+                if buffer_header['header_size'] != 12:
+                    raise InfiniiumFileError("The waveform buffer header has a length which is not 12. This is unexpected and requires fixing")
+                offset += waveform_data_header_dtype.itemsize
+
+                if buffer_header['bytes_per_point'] <= 0:
+                    raise InfiniiumFileError("The waveform buffer header reports {} bytes per point. Maybe a corrupt file?".format(buffer_header['bytes_per_point']))
+
+                buffer_dtype = InfiniiumBufferDtype(buffer_header['buffer_type'], buffer_header['bytes_per_point'])
+                buffer_points = int(buffer_header['buffer_size']/buffer_header['bytes_per_point'])
+                available_points = max(len(self._raw) - offset, 0)//buffer_dtype.itemsize
+                if available_points < buffer_points:
+                    raise InfiniiumFileError("There is a serious issue, asked to read {} points, but only {} are available. Maybe a corrupt file?".format(buffer_points, available_points))
+
+                buffer_headers += [buffer_header]
+                buffer_locations += [(offset, buffer_dtype, buffer_points)]
+                processed_points += buffer_points
+                offset += buffer_points*buffer_dtype.itemsize
+
+            if processed_points != waveform_header['num_points']:
+                raise InfiniiumFileError("There is a mismatch between the number of points reported in the waveform header and the total number of points in the buffers")
+
+            self.waveform_headers += [waveform_header]
+            self.buffer_headers += [buffer_headers]
+            self._buffer_locations += [buffer_locations]
+
+    def _record(self, offset:int, dtype:numpy.dtype):
+        if offset + dtype.itemsize > len(self._raw):
+            raise InfiniiumFileError("The file {} ended unexpectedly while reading a header. Maybe a corrupt file?".format(self.path.name))
+        return self._raw[offset:offset + dtype.itemsize].view(dtype)[0]
+
+    def __len__(self):
+        return len(self.waveform_headers)
+
+    def __getitem__(self, key):
+        waveform_idx, buffer_idx = key
+        return self.buffer(waveform_idx, buffer_idx)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, err_type, err_value, err_traceback):
+        self.close()
+
+    def close(self):
+        # Views handed out previously keep the mapping alive until they are released
+        self._raw = None
+
+    def buffer(self, waveform_idx:int, buffer_idx:int):
+        offset, buffer_dtype, buffer_points = self._buffer_locations[waveform_idx][buffer_idx]
+        return self._raw[offset:offset + buffer_points*buffer_dtype.itemsize].view(buffer_dtype)
+
+    def waveform(self, waveform_idx:int):
+        # A single buffer is returned as a view, multiple buffers are copied one after the other into a preallocated array
+        buffer_locations = self._buffer_locations[waveform_idx]
+        if len(buffer_locations) == 1:
+            return self.buffer(waveform_idx, 0)
+
+        y_data = numpy.empty(sum(buffer_points for _, _, buffer_points in buffer_locations), dtype=numpy.result_type(*[buffer_dtype for _, buffer_dtype, _ in buffer_locations]))
+        start = 0
+        for buffer_idx, (_, _, buffer_points) in enumerate(buffer_locations):
+            y_data[start:start + buffer_points] = self.buffer(waveform_idx, buffer_idx)
+            start += buffer_points
+        return y_data
+
+    def segments(self):
+        # Indexes of the waveforms of each segment, i.e. trigger, of a segmented acquisition, in the order of the segment_index and then of the file.
+        # A file which is not segmented has a single segment with all its waveforms
+        segment_index = numpy.array([waveform_header['segment_index'] for waveform_header in self.waveform_headers], dtype=numpy.int64)
+        order = numpy.argsort(segment_index, kind='stable')
+        return numpy.split(order, numpy.flatnonzero(numpy.diff(segment_index[order])) + 1)
+
+def InfiniiumFileLayout(scope_file:InfiniiumBinaryFile):
+    # Builds a structured dtype describing the full byte layout of the file, so that files with the same layout can be read in one go.
+    # Only files where every waveform is split into the same buffers, with the same type and number of points, are supported, otherwise None is returned
+    if len(scope_file) == 0 or len(scope_file.buffer_headers[0]) == 0:
+        return None
+
+    buffer_dtype = InfiniiumBufferDtype(scope_file.buffer_headers[0][0]['buffer_type'], scope_file.buffer_headers[0][0]['bytes_per_point'])
+    buffer_points = [int(buffer_header['buffer_size']//buffer_header['bytes_per_point']) for buffer_header in scope_file.buffer_headers[0]]
+    for buffer_headers in scope_file.buffer_headers:
+        if len(buffer_headers) != len(buffer_points):
+            return None
+        for buffer_header, points in zip(buffer_headers, buffer_points):
+            if InfiniiumBufferDtype(buffer_header['buffer_type'], buffer_header['bytes_per_point']) != buffer_dtype:
+                return None
+            if buffer_header['buffer_size'] != points*buffer_dtype.itemsize:
+                return None
+
+    buffer_fields = []
+    for buffer_idx, points in enumerate(buffer_points):
+        buffer_fields += [('buffer_header_{}'.format(buffer_idx), waveform_data_header_dtype),
+                          ('data_{}'.format(buffer_idx), buffer_dtype, (points,))]
+    waveform_layout_dtype = numpy.dtype([('header', waveform_header_dtype)] + buffer_fields)
+    return numpy.dtype([('file_header', file_header_dtype),
+                        ('waveforms', waveform_layout_dtype, (len(scope_file),))])
+
+def InfiniiumLayoutShape(layout:numpy.dtype):
+    # Number of waveforms in each file of a layout from InfiniiumFileLayout, the number of points of each buffer of the waveforms and their dtype
+    waveform_layout_dtype, (num_waveforms,) = layout['waveforms'].subdtype
+    buffer_points = [waveform_layout_dtype[name].shape[0] for name in waveform_layout_dtype.names if name.startswith('data_')]
+    return num_waveforms, buffer_points, waveform_layout_dtype['data_0'].base
+
+class InfiniiumUniformBlock:
+    """Loads a set of files sharing the layout from InfiniiumFileLayout into preallocated arrays.
+
+    The samples are placed in a contiguous (file, waveform, sample) array, with the buffers of each waveform
+    copied one after the other, and the headers in (file,), (file, waveform) and (file, waveform, buffer)
+    structured arrays. Each file is read with a single call and validated with vectorized checks, files which
+    do not match the layout are flagged in is_uniform. The waveforms of segmented acquisitions are sorted by
+    segment, so the arrays can be reshaped into num_segments triggers per file.
+    """
+    def __init__(self, paths:list, layout:numpy.dtype):
+        self.paths = list(paths)
+        self.layout = layout
+
+        num_waveforms, self.buffer_points, buffer_dtype = InfiniiumLayoutShape(layout)
+        buffer_starts = numpy.cumsum([0] + self.buffer_points)
+
+        self.file_headers = numpy.zeros(len(self.paths), dtype=file_header_dtype)
+        self.waveform_headers = numpy.zeros((len(self.paths), num_waveforms), dtype=waveform_header_dtype)
+        self.buffer_headers = numpy.zeros((len(self.paths), num_waveforms, len(self.buffer_points)), dtype=waveform_data_header_dtype)
+        self.samples = numpy.zeros((len(self.paths), num_waveforms, buffer_starts[-1]), dtype=buffer_dtype)
+        self.is_uniform = numpy.zeros(len(self.paths), dtype=bool)
+
+        scratch = numpy.zeros(1, dtype=layout)
+        scratch_bytes = scratch.view('u1')
+        for idx, path in enumerate(self.paths):
+            with path.open(mode='rb') as in_file:
+                if os.fstat(in_file.fileno()).st_size != layout.itemsize:
+                    continue
+                if in_file.readinto(scratch_bytes) != layout.itemsize:
+                    continue
+            self.file_headers[idx] = scratch['file_header'][0]
+            self.waveform_headers[idx] = scratch['waveforms']['header'][0]
+            for buffer_idx in range(len(self.buffer_points)):
+                self.buffer_headers[idx, :, buffer_idx] = scratch['waveforms']['buffer_header_{}'.format(buffer_idx)][0]
+                self.samples[idx, :, buffer_starts[buffer_idx]:buffer_starts[buffer_idx + 1]] = scratch['waveforms']['data_{}'.format(buffer_idx)][0]
+            self.is_uniform[idx] = True
+
+        # Same checks as done by InfiniiumBinaryFile, but for all the files at once
+        if buffer_dtype.kind == 'f':
+            buffer_type_ok = numpy.isin(self.buffer_headers['buffer_type'], [1,2,3,4,5])
+        elif buffer_dtype.kind == 'u':
+            buffer_type_ok = self.buffer_headers['buffer_type'] == 6
+        else:
+            buffer_type_ok = ~numpy.isin(self.buffer_headers['buffer_type'], [1,2,3,4,5,6])
+
+        self.is_uniform &= self.file_headers['cookie'] == b'AG'
+        self.is_uniform &= self.file_headers['num_waveforms'] == num_waveforms
+        self.is_uniform &= numpy.all(self.waveform_headers['header_size'] == 140, axis=1)
+        self.is_uniform &= numpy.all(self.waveform_headers['num_waveform_buffers'] == len(self.buffer_points), axis=1)
+        self.is_uniform &= numpy.all(self.waveform_headers['num_points'] == buffer_starts[-1], axis=1)
+        self.is_uniform &= numpy.all(self.buffer_headers['header_size'] == 12, axis=(1,2))
+        self.is_uniform &= numpy.all(buffer_type_ok, axis=(1,2))
+        self.is_uniform &= numpy.all(self.buffer_headers['bytes_per_point'] == buffer_dtype.itemsize, axis=(1,2))
+        self.is_uniform &= numpy.all(self.buffer_headers['buffer_size'] == numpy.array(self.buffer_points)*buffer_dtype.itemsize, axis=(1,2))
+
+        # Segmented acquisitions store the segments of each channel one after the other, sort them into (segment, channel) order.
+        # Only files with the same number of segments as the first valid file, each one with the same number of waveforms, are kept in the block
+        order = numpy.argsort(self.waveform_headers['segment_index'], axis=1, kind='stable')
+        if numpy.any(order != numpy.arange(num_waveforms)):
+            self.waveform_headers = numpy.take_along_axis(self.waveform_headers, order, axis=1)
+            self.buffer_headers = numpy.take_along_axis(self.buffer_headers, order[:, :, numpy.newaxis], axis=1)
+            self.samples = numpy.take_along_axis(self.samples, order[:, :, numpy.newaxis], axis=1)
+        del order
+
+        segment_index = self.waveform_headers['segment_index']
+        num_segments = 1 + numpy.count_nonzero(numpy.diff(segment_index, axis=1), axis=1)
+        self.num_segments = 1
+        if numpy.any(self.is_uniform):
+            self.num_segments = int(num_segments[numpy.argmax(self.is_uniform)])
+        self.is_uniform &= num_segments == self.num_segments
+        if num_waveforms % self.num_segments != 0:
+            self.is_uniform[:] = False
+        elif self.num_segments > 1:
+            segment_index = segment_index.reshape(len(self.paths), self.num_segments, -1)
+            self.is_uniform &= numpy.all(segment_index == segment_index[:, :, :1], axis=(1,2))
+
+    def __len__(self):
+        return len(self.paths)
+
+class ColumnarBuffer:
+    """Growable table with one preallocated, typed numpy column per field.
+
+    Rows are appended in place, with the capacity doubled when full, so filling the buffer is linear
+    in the number of rows. A DataFrame is only built when the contents are needed, e.g. when saving.
+    """
+    def __init__(self, columns:numpy.dtype, index:list=[], capacity:int=1024):
+        self.index = list(index)
+        self.names = list(columns.names)
+        self._size = 0
+        self._columns = {name: numpy.empty(max(capacity, 1), dtype=columns[name]) for name in columns.names}
+
+    def __len__(self):
+        return self._size
+
+    def __getstate__(self):
+        # Only the filled rows are pickled, e.g. when sending the buffers between processes
+        state = self.__dict__.copy()
+        state["_columns"] = {name: self.column(name) for name in self.names}
+        return state
+
+    @property
+    def capacity(self):
+        return len(next(iter(self._columns.values())))
+
+    def _reserve(self, size:int):
+        if size <= self.capacity:
+            return
+        new_capacity = max(size, 2*self.capacity)
+        for name, column in self._columns.items():
+            new_column = numpy.empty(new_capacity, dtype=column.dtype)
+            new_column[:self._size] = column[:self._size]
+            self._columns[name] = new_column
+
+    def extend(self, num_rows:int, **values):
+        # Each value is either an array with num_rows entries or a scalar which is repeated for all rows
+        if set(values) != set(self._columns):
+            raise ValueError("Values must be given for exactly the columns {}, got {}".format(list(self._columns), list(values)))
+        self._reserve(self._size + num_rows)
+        for name, value in values.items():
+            self._columns[name][self._size:self._size + num_rows] = value
+        self._size += num_rows
+
+    def append(self, **values):
+        self.extend(1, **values)
+
+    def column(self, name:str):
+        return self._columns[name][:self._size]
+
+    def to_dataframe(self, start:int=0, stop:int=None):
+        if stop is None:
+            stop = self._size
+        dataframe = pandas.DataFrame({name: column[start:stop].copy() for name, column in self._columns.items()})
+        if len(self.index) > 0:
+            dataframe.set_index(self.index, inplace=True)
+        return dataframe
+
+    def clear(self):
+        # Keep the allocated memory for the next rows, but release references to python objects
+        for column in self._columns.values():
+            if column.dtype == object:
+                column[:self._size] = None
+        self._size = 0
+
+class WaveformAverage:
+    """Running mean and variance of the waveforms of each channel, per sample index.
+
+    The samples are accumulated in batches, e.g. one chunk of triggers at a time, and each batch is combined
+    with the running values using Welford's update generalised to batches (Chan et al.), so the average
+    waveform is available at the end of the conversion without reading the samples back from the database.
+    """
+    def __init__(self):
+        self._accumulators = {} # (channel_idx, waveform_idx) -> count, mean x, mean y and sum of squared deviations of y, per sample index
+        self._start_times = []
+
+    def update(self, channel_idx:numpy.ndarray, waveform_idx:numpy.ndarray, x_idx:numpy.ndarray, x:numpy.ndarray, y:numpy.ndarray):
+        if len(x_idx) == 0:
+            return
+
+        for channel, waveform in numpy.unique(numpy.stack([channel_idx, waveform_idx]), axis=1).T:
+            selection = (channel_idx == channel) & (waveform_idx == waveform)
+            self._update((int(channel), int(waveform)), x_idx[selection], x[selection], y[selection])
+
+        start = x_idx == 0
+        self._start_times += [(channel_idx[start], waveform_idx[start], x[start])]
+
+    def _update(self, key:tuple, x_idx:numpy.ndarray, x:numpy.ndarray, y:numpy.ndarray):
+        size = int(x_idx.max()) + 1
+        if key not in self._accumulators:
+            self._accumulators[key] = numpy.zeros((4, size))
+        elif self._accumulators[key].shape[1] < size: # Longer waveforms than seen so far
+            self._accumulators[key] = numpy.pad(self._accumulators[key], ((0, 0), (0, size - self._accumulators[key].shape[1])))
+        count, mean_x, mean_y, m2_y = self._accumulators[key][:, :size]
+
+        batch_count = numpy.bincount(x_idx, minlength=size)
+        batch_mean_x = numpy.bincount(x_idx, weights=x, minlength=size)/numpy.maximum(batch_count, 1)
+        batch_mean_y = numpy.bincount(x_idx, weights=y, minlength=size)/numpy.maximum(batch_count, 1)
+        batch_m2_y = numpy.bincount(x_idx, weights=(y - batch_mean_y[x_idx])**2, minlength=size)
+
+        new_count, mean_y[:], m2_y[:] = merged_moments(count, mean_y, m2_y, batch_count, batch_mean_y, batch_m2_y)
+        mean_x += (batch_mean_x - mean_x) * batch_count/numpy.maximum(new_count, 1)
+        count[:] = new_count
+
+    def to_arrays(self):
+        # The state of the average as a dictionary of plain arrays, e.g. to save it with numpy.savez, see from_arrays
+        keys = sorted(self._accumulators)
+        arrays = {"keys": numpy.array(keys, dtype=numpy.int64).reshape(len(keys), 2)}
+        for key_idx, key in enumerate(keys):
+            arrays["accumulator_{}".format(key_idx)] = self._accumulators[key]
+        arrays["start_channel_idx"] = numpy.concatenate([start[0] for start in self._start_times] + [numpy.zeros(0, dtype=int)])
+        arrays["start_waveform_idx"] = numpy.concatenate([start[1] for start in self._start_times] + [numpy.zeros(0, dtype=int)])
+        arrays["start_x"] = numpy.concatenate([start[2] for start in self._start_times] + [numpy.zeros(0)])
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        waveform_average = cls()
+        for key_idx, (channel, waveform) in enumerate(arrays["keys"]):
+            waveform_average._accumulators[(int(channel), int(waveform))] = numpy.array(arrays["accumulator_{}".format(key_idx)], dtype=float)
+        waveform_average._start_times = [(arrays["start_channel_idx"], arrays["start_waveform_idx"], arrays["start_x"])]
+        return waveform_average
+
+    def to_dataframe(self):
+        # Same layout as the average_waveform table, with the sample variance of the amplitude
+        average_waveform_dfs = []
+        for (channel, waveform), (count, mean_x, mean_y, m2_y) in sorted(self._accumulators.items()):
+            x_idx = numpy.flatnonzero(count > 0)
+            with numpy.errstate(invalid='ignore', divide='ignore'):
+                y_variance = numpy.where(count[x_idx] > 1, m2_y[x_idx]/(count[x_idx] - 1), numpy.nan)
+            average_waveform_dfs += [pandas.DataFrame(
+                                                        {
+                                                            "channel_idx": channel,
+                                                            "waveform_idx": waveform,
+                                                            "x_idx": x_idx,
+                                                            "x": mean_x[x_idx],
+                                                            "y": mean_y[x_idx],
+                                                            "y_variance": y_variance,
+                                                        }
+                                                    )]
+        if len(average_waveform_dfs) == 0:
+            average_waveform_df = pandas.DataFrame(columns=["channel_idx", "waveform_idx", "x_idx", "x", "y", "y_variance"])
+        else:
+            average_waveform_df = pandas.concat(average_waveform_dfs, ignore_index=True)
+        average_waveform_df.set_index(["channel_idx", "waveform_idx", "x_idx"], inplace=True)
+        return average_waveform_df
+
+    def start_times_dataframe(self):
+        # Time of the first sample of every waveform
+        return pandas.DataFrame(
+                                {
+                                    "channel_idx": numpy.concatenate([start[0] for start in self._start_times] + [numpy.zeros(0, dtype=int)]),
+                                    "waveform_idx": numpy.concatenate([start[1] for start in self._start_times] + [numpy.zeros(0, dtype=int)]),
+                                    "x": numpy.concatenate([start[2] for start in self._start_times] + [numpy.zeros(0)]),
+                                }
+                            )
+
+def peak_memory_usage():
+    # Peak resident set size, in bytes, of this process and of its finished child processes, e.g. the parsing workers.
+    # None where the resource module is not available
+    try:
+        import resource
+    except ImportError:
+        return None, None
+    scale = 1 if os.uname().sysname == "Darwin" else 1024 # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*scale, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss*scale
+
+class ConversionMetrics:
+    """Time spent and amount of data processed in each stage of a conversion.
+
+    Every stage accumulates its seconds, number of calls and any counts given, e.g. files, waveforms, bytes or rows.
+    The parsing workers fill their own instance, which is added to the one of the run with merge.
+    """
+    def __init__(self):
+        self.stages = {}
+        self.start_time = time.perf_counter()
+
+    def add(self, stage:str, seconds:float=0, **counts):
+        stage_metrics = self.stages.setdefault(stage, {"seconds": 0., "calls": 0})
+        stage_metrics["seconds"] += seconds
+        stage_metrics["calls"] += 1
+        for name, count in counts.items():
+            stage_metrics[name] = stage_metrics.get(name, 0) + count
+
+    @contextlib.contextmanager
+    def stage(self, stage:str, **counts):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start_time, **counts)
+
+    def merge(self, other):
+        for stage, other_metrics in other.stages.items():
+            stage_metrics = self.stages.setdefault(stage, {"seconds": 0., "calls": 0})
+            for name, count in other_metrics.items():
+                stage_metrics[name] = stage_metrics.get(name, 0) + count
+
+    def report(self, **run_information):
+        # Summary of the whole conversion followed by the metrics of every stage, with the rate of each count
+        wall_seconds = time.perf_counter() - self.start_time
+        peak_rss, peak_children_rss = peak_memory_usage()
+        parse_metrics = self.stages.get("parse", {})
+        report = dict(run_information)
+        report.update(
+                        wall_seconds = wall_seconds,
+                        files = parse_metrics.get("files", 0),
+                        triggers = parse_metrics.get("triggers", 0),
+                        waveforms = parse_metrics.get("waveforms", 0),
+                        bytes = parse_metrics.get("bytes", 0),
+                        rows_written = self.stages.get("write", {}).get("rows", 0),
+                        peak_rss_bytes = peak_rss,
+                        peak_children_rss_bytes = peak_children_rss,
+                    )
+        for name in ["files", "triggers", "waveforms", "bytes", "rows_written"]:
+            report["{}_per_second".format(name)] = report[name]/max(wall_seconds, 1e-9)
+
+        report["stages"] = {}
+        for stage, stage_metrics in self.stages.items():
+            stage_report = dict(stage_metrics)
+            for name, count in stage_metrics.items():
+                if name not in ["seconds", "calls"]:
+                    stage_report["{}_per_second".format(name)] = count/max(stage_metrics["seconds"], 1e-9)
+            report["stages"][stage] = stage_report
+        return report
+
+    def save(self, path:Path, **run_information):
+        script_logger = logging.getLogger('convert_scope')
+
+        report = self.report(**run_information)
+        with open(path, 'w') as metrics_file:
+            json.dump(report, metrics_file, indent=4)
+
+        script_logger.info("Converted {} files, {} waveforms, in {:.2f} s ({:.1f} files/s, {:.0f} waveforms/s, {:.1f} MB/s)".format(
+            report["files"],
+            report["waveforms"],
+            report["wall_seconds"],
+            report["files_per_second"],
+            report["waveforms_per_second"],
+            report["bytes_per_second"]/1e6,
+        ))
+        for stage, stage_report in report["stages"].items():
+            script_logger.info("  - {}: {:.2f} s in {} calls".format(stage, stage_report["seconds"], stage_report["calls"]))
+        return report
+
+# Columns and index of the tables produced while converting a run
+run_tables = {
+    "run_metadata": {
+        "columns": numpy.dtype([('n_trigger', 'i8'),
+                                ('file_name', 'O'),
+                                ('file_version', 'i8'),
+                                ('file_size', 'i8'),
+                                ('number_waveforms', 'i8')]),
+        "index": ["n_trigger"],
+    },
+    "waveform_metadata": {
+        "columns": numpy.dtype([('channel_idx', 'i8'),
+                                ('waveform_idx', 'i8'),
+                                ('n_trigger', 'i8'),
+                                ('header_size', 'i4'),
+                                ('waveform_type', 'i4'),
+                                ('number_buffers', 'i4'),
+                                ('number_points', 'i4'),
+                                ('count', 'i4'),
+                                ('x_display_range', 'f4'),
+                                ('x_display_origin', 'f8'),
+                                ('x_increment', 'f8'),
+                                ('x_origin', 'f8'),
+                                ('raw_x_units', 'i4'),
+                                ('raw_y_units', 'i4'),
+                                ('x_units', 'O'),
+                                ('y_units', 'O'),
+                                ('date', 'O'),
+                                ('time', 'O'),
+                                ('datetime', 'M8[us]'),
+                                ('frame', 'O'),
+                                ('channel', 'O'),
+                                ('time_tag', 'f8'),
+                                ('segment_index', 'u4')]),
+        "index": ["n_trigger", "channel_idx", "waveform_idx"],
+    },
+    "waveform_buffer_metadata": {
+        "columns": numpy.dtype([('channel_idx', 'i8'),
+                                ('waveform_idx', 'i8'),
+                                ('buffer_idx', 'i8'),
+                                ('n_trigger', 'i8'),
+                                ('header_size', 'i4'),
+                                ('buffer_type', 'i2'),
+                                ('bytes_per_point', 'i2'),
+                                ('buffer_size', 'i4'),
+                                ('x_units', 'O'),
+                                ('y_units', 'O')]),
+        "index": ["n_trigger", "channel_idx", "waveform_idx", "buffer_idx"],
+    },
+    "waveform_buffer": {
+        "columns": numpy.dtype([('channel_idx', 'i8'),
+                                ('waveform_idx', 'i8'),
+                                ('buffer_idx', 'i8'),
+                                ('n_trigger', 'i8'),
+                                ('x', 'f8'),
+                                ('y', 'f8'),
+                                ('x_idx', 'i8')]),
+        "index": ["n_trigger", "channel_idx", "waveform_idx", "buffer_idx", "x_idx"],
+    },
+    "waveforms": {
+        "columns": numpy.dtype([('channel_idx', 'i8'),
+                                ('waveform_idx', 'i8'),
+                                ('n_trigger', 'i8'),
+                                ('x', 'f8'),
+                                ('y', 'f8'),
+                                ('x_idx', 'i8')]),
+        "index": ["n_trigger", "channel_idx", "waveform_idx", "x_idx"],
+    },
+}
+
+# Sample tables of the version 2 schema, see run_storage.schema_versions, which replace those in run_tables
+compact_sample_tables = {
+    "waveform_buffer": {
+        "columns": numpy.dtype([('channel_idx', 'i8'),
+                                ('waveform_idx', 'i8'),
+                                ('buffer_idx', 'i8'),
+                                ('n_trigger', 'i8'),
+                                ('number_points', 'i8'),
+                                ('sample_dtype', 'O'),
+                                ('samples', 'O')]),
+        "index": ["n_trigger", "channel_idx", "waveform_idx", "buffer_idx"],
+    },
+    "waveforms": {
+        "columns": numpy.dtype([('channel_idx', 'i8'),
+                                ('waveform_idx', 'i8'),
+                                ('n_trigger', 'i8'),
+                                ('number_points', 'i8'),
+                                ('sample_dtype', 'O'),
+                                ('samples', 'O')]),
+        "index": ["n_trigger", "channel_idx", "waveform_idx"],
+    },
+}
+
+# Sample tables of the version 3 schema, the version 2 tables with the scaling of the samples of each waveform. The scaling
+# columns go before the samples, since in SQLite reading a column after a large BLOB reads the overflow pages of the BLOB
+scaled_sample_tables = {
+    table_name: {"columns": numpy.dtype(table["columns"].descr[:-2] + [('y_scale', 'f8'), ('y_offset', 'f8')] + table["columns"].descr[-2:]), "index": table["index"]}
+    for table_name, table in compact_sample_tables.items()
+}
+
+def create_run_buffers(waveforms_capacity:int=1024, schema_version:int=1):
+    tables = dict(run_tables)
+    if schema_version >= 2:
+        tables.update(compact_sample_tables if schema_version == 2 else scaled_sample_tables)
+        waveforms_capacity = 1024 # One row per waveform, so the capacity for one row per sample is not needed
+
+    run_buffers = {}
+    for table_name, table in tables.items():
+        capacity = 1024
+        if table_name in ["waveforms", "waveform_buffer"]:
+            capacity = waveforms_capacity
+        run_buffers[table_name] = ColumnarBuffer(table["columns"], table["index"], capacity=capacity)
+    return run_buffers
+
+# Files which were already converted, so a conversion can be resumed with only the new or changed files.
+# Files which could not be parsed are recorded with n_trigger -1
+manifest_table = {
+    "columns": numpy.dtype([('file_name', 'O'),
+                            ('file_size', 'i8'),
+                            ('file_mtime', 'f8'),
+                            ('file_hash', 'O'),
+                            ('n_trigger', 'i8'),
+                            ('converted', 'f8')]), # Time at which the entry was added, the latest entry of a file is the valid one
+    "index": ["file_name"],
+}
+
+def file_digest(path:Path):
+    file_hash = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as file:
+        for data in iter(lambda: file.read(2**20), b""):
+            file_hash.update(data)
+    return file_hash.hexdigest()
+
+def read_manifest(output_path:Path, output_format:str):
+    # Latest entry of each file
+    manifest_df = read_table(output_path, output_format, 'manifest')
+    manifest_df.sort_values("converted", kind="stable", inplace=True)
+    manifest_df.drop_duplicates("file_name", keep="last", inplace=True)
+    manifest_df.set_index("file_name", inplace=True)
+    return manifest_df
+
+def select_new_files(paths:list, manifest_df:pandas.DataFrame):
+    # Returns the files which are not in the manifest or which changed since they were converted, and the triggers of the changed files.
+    # Files with the same size and modification time are assumed unchanged, otherwise the content is compared when the manifest has its hash,
+    # i.e. when the file was converted with resume or watch
+    new_paths = []
+    stale_triggers = []
+    for path in paths:
+        if path.name not in manifest_df.index:
+            new_paths += [path]
+            continue
+
+        entry = manifest_df.loc[path.name]
+        file_stat = path.stat()
+        if file_stat.st_size == entry["file_size"] and file_stat.st_mtime == entry["file_mtime"]:
+            continue
+        if isinstance(entry["file_hash"], str) and entry["file_hash"] != "" and file_digest(path) == entry["file_hash"]:
+            continue
+
+        new_paths += [path]
+        if entry["n_trigger"] >= 0:
+            stale_triggers += [int(entry["n_trigger"])]
+    return new_paths, stale_triggers
+
+def stored_samples(samples:numpy.ndarray, y_scale, y_offset, schema_version:int=1, float32:bool=False, scaled:bool=False):
+    # Samples as written to the sample tables. When the run is scaled, the scaling is applied to the samples of every channel, except for the
+    # version 3 schema where it is stored next to them, so integer samples keep their native type. With float32, float samples of 8 bytes
+    # are stored in 4 in the compact schemas
+    if scaled and schema_version < 3:
+        samples = samples.astype(float)*y_scale + y_offset
+    if float32 and schema_version >= 2 and samples.dtype.kind == 'f' and samples.dtype.itemsize > 4:
+        samples = samples.astype(numpy.float32)
+    return samples
+
+def buffered_points(run_buffers:dict):
+    # Number of samples held in the buffers, independently of the schema version
+    return int(run_buffers["waveform_metadata"].column("number_points").sum())
+
+def parse_scope_file(
+        scope_file:InfiniiumBinaryFile,
+        n_trigger:int,
+        channel_map:dict,
+        run_buffers:dict,
+        save_buffers:bool=False,
+        schema_version:int=1,
+        float32:bool=False,
+        sample_scaling:dict=None,
+        ):
+    # Returns the number of triggers in the file, one per segment of a segmented acquisition.
+    # sample_scaling maps channel names to the (y_scale, y_offset) of their samples, see stored_samples
+    script_logger = logging.getLogger('convert_scope')
+
+    # The file header was already read and validated by the reader
+    file_header = scope_file.file_header
+
+    # Checked once per file, so the per waveform messages are not even formatted when their level is disabled
+    log_info = script_logger.isEnabledFor(logging.INFO)
+    log_debug = script_logger.isEnabledFor(logging.DEBUG)
+
+    if log_debug:
+        script_logger.debug("    Got the following file header:")
+        script_logger.debug("      - Cookie: {}".format(file_header['cookie']))
+        script_logger.debug("      - Version: {}".format(file_header['version']))
+        script_logger.debug("      - File Size: {} bytes".format(file_header['file_size']))
+        script_logger.debug("      - Number of Waveforms: {}".format(file_header['num_waveforms']))
+
+    # Each segment of a segmented acquisition is a trigger, with its waveforms numbered in the order of the file
+    segments = scope_file.segments()
+    waveform_locations = []
+    for segment_idx, segment_waveforms in enumerate(segments):
+        run_buffers["run_metadata"].append(
+                                            n_trigger = n_trigger + segment_idx,
+                                            file_name = scope_file.path.name,
+                                            file_version = int(file_header['version']),
+                                            file_size = int(file_header['file_size']),
+                                            number_waveforms = len(segment_waveforms),
+                                        )
+        waveform_locations += [(n_trigger + segment_idx, waveform_idx, int(file_waveform_idx)) for waveform_idx, file_waveform_idx in enumerate(segment_waveforms)]
+
+    for trigger, waveform_idx, file_waveform_idx in waveform_locations: # Loop on the waveforms in the file, in trigger order
+        waveform_header = scope_file.waveform_headers[file_waveform_idx]
+        channel_string = bytes(waveform_header['waveform_string']).decode('utf-8')
+        frame_string   = bytes(waveform_header[   'frame_string']).decode('utf-8')
+        date_string    = bytes(waveform_header[    'date_string']).decode('utf-8')
+        time_string    = bytes(waveform_header[    'time_string']).decode('utf-8')
+
+        if log_info:
+            script_logger.info("    Parsing {}".format(channel_string))
+        if log_debug:
+            script_logger.debug("      Got the Waveform header:")
+            script_logger.debug("        - Header Size: {}".format(waveform_header['header_size']))
+            script_logger.debug("        - Type: {}".format(waveform_header['waveform_type']))
+            script_logger.debug("        - Number Buffers: {}".format(waveform_header['num_waveform_buffers']))
+            script_logger.debug("        - Number of Points: {}".format(waveform_header['num_points']))
+            script_logger.debug("        - Count: {}".format(waveform_header['count']))
+            script_logger.debug("        - Range X Display: {}".format(waveform_header['x_display_range']))
+            script_logger.debug("        - Origin X Display: {}".format(waveform_header['x_display_origin']))
+            script_logger.debug("        - X Increment: {}".format(waveform_header['x_increment']))
+            script_logger.debug("        - X Origin: {}".format(waveform_header['x_origin']))
+            script_logger.debug("        - X Units: {}".format(waveform_header['x_units']))
+            script_logger.debug("        - Y Units: {}".format(waveform_header['y_units']))
+            script_logger.debug("        - Date: {}".format(waveform_header['date_string']))
+            script_logger.debug("        - Time: {}".format(waveform_header['time_string']))
+            script_logger.debug("        - Frame: {}".format(waveform_header['frame_string']))
+            script_logger.debug("        - Waveform Label: {}".format(waveform_header['waveform_string']))
+            script_logger.debug("        - Time Tag: {}".format(waveform_header['time_tag']))
+            script_logger.debug("        - Segment Index: {}".format(waveform_header['segment_index']))
+
+        if channel_string in channel_map:
+            channel_idx = channel_map[channel_string]
+        else:
+            channel_idx = len(channel_map)
+            channel_map[channel_string] = channel_idx
+
+        y_scale, y_offset = (sample_scaling or {}).get(channel_string, (1., 0.))
+        scaling_columns = {"y_scale": y_scale, "y_offset": y_offset} if schema_version >= 3 else {}
+
+        run_buffers["waveform_metadata"].append(
+                                                channel_idx = channel_idx,
+                                                waveform_idx = waveform_idx,
+                                                n_trigger = trigger,
+                                                header_size = waveform_header['header_size'],
+                                                waveform_type = waveform_header['waveform_type'],
+                                                number_buffers = waveform_header['num_waveform_buffers'],
+                                                number_points = waveform_header['num_points'],
+                                                count = waveform_header['count'],
+                                                x_display_range = waveform_header['x_display_range'],
+                                                x_display_origin = waveform_header['x_display_origin'],
+                                                x_increment = waveform_header['x_increment'],
+                                                x_origin = waveform_header['x_origin'],
+                                                raw_x_units = waveform_header['x_units'],
+                                                raw_y_units = waveform_header['y_units'],
+                                                x_units = InfiniiumUnitsToString(waveform_header['x_units']),
+                                                y_units = InfiniiumUnitsToString(waveform_header['y_units']),
+                                                date = date_string,
+                                                time = time_string,
+                                                datetime = InfiniiumTimestamp(bytes(waveform_header['date_string']), bytes(waveform_header['time_string'])),
+                                                frame = frame_string,
+                                                channel = channel_string,
+                                                time_tag = waveform_header['time_tag'],
+                                                segment_index = waveform_header['segment_index'],
+                                            )
+
+        del channel_string
+        del frame_string
+        del date_string
+        del time_string
+
+        for buffer_idx, buffer_header in enumerate(scope_file.buffer_headers[file_waveform_idx]): # Loop on the buffers for this waveform
+            if log_debug:
+                script_logger.debug("      Got the Waveform Data header:")
+                script_logger.debug("        - Header Size: {}".format(buffer_header['header_size']))
+                script_logger.debug("        - Buffer Type: {}".format(buffer_header['buffer_type']))
+                script_logger.debug("        - Bytes Per Point: {}".format(buffer_header['bytes_per_point']))
+                script_logger.debug("        - Buffer Size: {}".format(buffer_header['buffer_size']))
+
+            run_buffers["waveform_buffer_metadata"].append(
+                                                            channel_idx = channel_idx,
+                                                            waveform_idx = waveform_idx,
+                                                            buffer_idx = buffer_idx,
+                                                            n_trigger = trigger,
+                                                            header_size = buffer_header['header_size'],
+                                                            buffer_type = buffer_header['buffer_type'],
+                                                            bytes_per_point = buffer_header['bytes_per_point'],
+                                                            buffer_size = buffer_header['buffer_size'],
+                                                            x_units = InfiniiumUnitsToString(waveform_header['x_units']),
+                                                            y_units = InfiniiumUnitsToString(waveform_header['y_units']),
+                                                        )
+            del buffer_header
+
+            if save_buffers and schema_version >= 2:
+                amplitude_data = stored_samples(scope_file.buffer(file_waveform_idx, buffer_idx), y_scale, y_offset, schema_version, float32, bool(sample_scaling))
+                run_buffers["waveform_buffer"].append(
+                                                    channel_idx = channel_idx,
+                                                    waveform_idx = waveform_idx,
+                                                    buffer_idx = buffer_idx,
+                                                    n_trigger = trigger,
+                                                    number_points = len(amplitude_data),
+                                                    sample_dtype = amplitude_data.dtype.str,
+                                                    samples = amplitude_data.tobytes(),
+                                                    **scaling_columns,
+                                                )
+                del amplitude_data
+            elif save_buffers:
+                # Zero-copy view of the buffer data in the file, unless it is scaled
+                amplitude_data = stored_samples(scope_file.buffer(file_waveform_idx, buffer_idx), y_scale, y_offset, schema_version, scaled=bool(sample_scaling))
+
+                time_idx = numpy.arange(len(amplitude_data))
+                time_data = time_idx * waveform_header['x_increment'] + waveform_header['x_origin']
+
+                run_buffers["waveform_buffer"].extend(
+                                                    len(amplitude_data),
+                                                    channel_idx = channel_idx,
+                                                    waveform_idx = waveform_idx,
+                                                    buffer_idx = buffer_idx,
+                                                    n_trigger = trigger,
+                                                    x = time_data,
+                                                    y = amplitude_data,
+                                                    x_idx = time_idx,
+                                                )
+                del amplitude_data
+
+        y_data = stored_samples(scope_file.waveform(file_waveform_idx), y_scale, y_offset, schema_version, float32, bool(sample_scaling))
+
+        if schema_version >= 2: # Samples kept in their native type, the time axis is given by the metadata
+            run_buffers["waveforms"].append(
+                                            channel_idx = channel_idx,
+                                            waveform_idx = waveform_idx,
+                                            n_trigger = trigger,
+                                            number_points = len(y_data),
+                                            sample_dtype = y_data.dtype.str,
+                                            samples = y_data.tobytes(),
+                                            **scaling_columns,
+                                        )
+            del y_data
+            del channel_idx
+            continue
+
+        time_idx = numpy.arange(waveform_header['num_points'])
+        time_data = time_idx * waveform_header['x_increment'] + waveform_header['x_origin']
+
+        run_buffers["waveforms"].extend(
+                                        len(y_data),
+                                        channel_idx = channel_idx,
+                                        waveform_idx = waveform_idx,
+                                        n_trigger = trigger,
+                                        x = time_data,
+                                        y = y_data,
+                                        x_idx = time_idx,
+                                    )
+
+        del time_idx
+        del time_data
+        del y_data
+        del channel_idx
+
+    return len(segments)
+
+
+def parse_uniform_block(
+        block:InfiniiumUniformBlock,
+        rows:numpy.ndarray,
+        n_trigger:int,
+        channel_map:dict,
+        run_buffers:dict,
+        save_buffers:bool=False,
+        schema_version:int=1,
+        float32:bool=False,
+        sample_scaling:dict=None,
+        ):
+    # Vectorized equivalent of parse_scope_file for the files of a block with indexes rows, which get consecutive trigger numbers starting at n_trigger.
+    # Returns the number of triggers, block.num_segments per file
+
+    # One row per trigger, for segmented acquisitions the segments of each file are consecutive triggers
+    file_headers = numpy.repeat(block.file_headers[rows], block.num_segments)
+    waveform_headers = block.waveform_headers[rows].reshape(len(rows)*block.num_segments, -1)
+    buffer_headers = block.buffer_headers[rows].reshape(len(rows)*block.num_segments, waveform_headers.shape[1], -1)
+    samples = block.samples[rows].reshape(len(rows)*block.num_segments, waveform_headers.shape[1], -1)
+
+    num_triggers, num_waveforms, num_points = samples.shape
+    num_buffers = len(block.buffer_points)
+    trigger_idx = n_trigger + numpy.arange(num_triggers)
+
+    # Assign channel indexes in order of first appearance, as is done when parsing file by file
+    channel_strings = numpy.char.decode(waveform_headers['waveform_string'].ravel(), 'utf-8')
+    unique_channels, first_appearance, channel_inverse = numpy.unique(channel_strings, return_index=True, return_inverse=True)
+    for unique_idx in numpy.argsort(first_appearance):
+        if unique_channels[unique_idx] not in channel_map:
+            channel_map[unique_channels[unique_idx]] = len(channel_map)
+    channel_idx = numpy.array([channel_map[channel] for channel in unique_channels], dtype=int)[channel_inverse.ravel()]
+
+    # Scaling of the samples of each waveform, from its channel
+    channel_scaling = numpy.array([(sample_scaling or {}).get(channel, (1., 0.)) for channel in unique_channels], dtype=float).reshape(len(unique_channels), 2)
+    y_scale = channel_scaling[channel_inverse.ravel(), 0]
+    y_offset = channel_scaling[channel_inverse.ravel(), 1]
+    samples = stored_samples(samples, y_scale.reshape(num_triggers, num_waveforms, 1), y_offset.reshape(num_triggers, num_waveforms, 1), schema_version, float32, bool(sample_scaling))
+    del channel_scaling
+
+    # All the waveforms of a run are taken within a few distinct seconds, so parse each distinct timestamp only once
+    date_strings = numpy.char.decode(waveform_headers['date_string'].ravel(), 'utf-8')
+    time_strings = numpy.char.decode(waveform_headers['time_string'].ravel(), 'utf-8')
+    datetimes = InfiniiumTimestamps(waveform_headers['date_string'].ravel(), waveform_headers['time_string'].ravel())
+
+    waveform_trigger_idx = numpy.repeat(trigger_idx, num_waveforms)
+    waveform_idx = numpy.tile(numpy.arange(num_waveforms), num_triggers)
+    flat_waveform_headers = waveform_headers.ravel()
+    flat_buffer_headers = buffer_headers.ravel()
+    x_units = numpy.array([InfiniiumUnitsToString(unit) for unit in flat_waveform_headers['x_units']], dtype=object)
+    y_units = numpy.array([InfiniiumUnitsToString(unit) for unit in flat_waveform_headers['y_units']], dtype=object)
+
+    run_buffers["run_metadata"].extend(
+                                        num_triggers,
+                                        n_trigger = trigger_idx,
+                                        file_name = [block.paths[row].name for row in rows for _ in range(block.num_segments)],
+                                        file_version = file_headers['version'].astype(int),
+                                        file_size = file_headers['file_size'],
+                                        number_waveforms = num_waveforms,
+                                    )
+
+    run_buffers["waveform_metadata"].extend(
+                                            num_triggers*num_waveforms,
+                                            channel_idx = channel_idx,
+                                            waveform_idx = waveform_idx,
+                                            n_trigger = waveform_trigger_idx,
+                                            header_size = flat_waveform_headers['header_size'],
+                                            waveform_type = flat_waveform_headers['waveform_type'],
+                                            number_buffers = flat_waveform_headers['num_waveform_buffers'],
+                                            number_points = flat_waveform_headers['num_points'],
+                                            count = flat_waveform_headers['count'],
+                                            x_display_range = flat_waveform_headers['x_display_range'],
+                                            x_display_origin = flat_waveform_headers['x_display_origin'],
+                                            x_increment = flat_waveform_headers['x_increment'],
+                                            x_origin = flat_waveform_headers['x_origin'],
+                                            raw_x_units = flat_waveform_headers['x_units'],
+                                            raw_y_units = flat_waveform_headers['y_units'],
+                                            x_units = x_units,
+                                            y_units = y_units,
+                                            date = date_strings,
+                                            time = time_strings,
+                                            datetime = datetimes,
+                                            frame = numpy.char.decode(flat_waveform_headers['frame_string'], 'utf-8'),
+                                            channel = channel_strings,
+                                            time_tag = flat_waveform_headers['time_tag'],
+                                            segment_index = flat_waveform_headers['segment_index'],
+                                        )
+
+    run_buffers["waveform_buffer_metadata"].extend(
+                                                    num_triggers*num_waveforms*num_buffers,
+                                                    channel_idx = numpy.repeat(channel_idx, num_buffers),
+                                                    waveform_idx = numpy.repeat(waveform_idx, num_buffers),
+                                                    buffer_idx = numpy.tile(numpy.arange(num_buffers), num_triggers*num_waveforms),
+                                                    n_trigger = numpy.repeat(waveform_trigger_idx, num_buffers),
+                                                    header_size = flat_buffer_headers['header_size'],
+                                                    buffer_type = flat_buffer_headers['buffer_type'],
+                                                    bytes_per_point = flat_buffer_headers['bytes_per_point'],
+                                                    buffer_size = flat_buffer_headers['buffer_size'],
+                                                    x_units = numpy.repeat(x_units, num_buffers),
+                                                    y_units = numpy.repeat(y_units, num_buffers),
+                                                )
+
+    # The buffers of each waveform are consecutive in the samples
+    buffer_starts = numpy.cumsum([0] + block.buffer_points)
+
+    if schema_version >= 2:
+        flat_samples = samples.reshape(num_triggers*num_waveforms, num_points)
+        waveform_columns = {
+            "channel_idx": channel_idx,
+            "waveform_idx": waveform_idx,
+            "n_trigger": waveform_trigger_idx,
+            "number_points": num_points,
+            "sample_dtype": samples.dtype.str,
+            "samples": [waveform.tobytes() for waveform in flat_samples],
+        }
+        buffer_scaling_columns = {}
+        if schema_version >= 3:
+            waveform_columns.update(y_scale = y_scale, y_offset = y_offset)
+            buffer_scaling_columns.update(y_scale = numpy.repeat(y_scale, num_buffers), y_offset = numpy.repeat(y_offset, num_buffers))
+        if save_buffers and num_buffers == 1: # With a single buffer per waveform, the buffer holds exactly the waveform
+            run_buffers["waveform_buffer"].extend(num_triggers*num_waveforms, buffer_idx = 0, **waveform_columns)
+        elif save_buffers:
+            run_buffers["waveform_buffer"].extend(
+                                                    num_triggers*num_waveforms*num_buffers,
+                                                    channel_idx = numpy.repeat(channel_idx, num_buffers),
+                                                    waveform_idx = numpy.repeat(waveform_idx, num_buffers),
+                                                    buffer_idx = numpy.tile(numpy.arange(num_buffers), num_triggers*num_waveforms),
+                                                    n_trigger = numpy.repeat(waveform_trigger_idx, num_buffers),
+                                                    number_points = numpy.tile(block.buffer_points, num_triggers*num_waveforms),
+                                                    sample_dtype = samples.dtype.str,
+                                                    samples = [waveform[start:stop].tobytes() for waveform in flat_samples for start, stop in zip(buffer_starts[:-1], buffer_starts[1:])],
+                                                    **buffer_scaling_columns,
+                                                )
+        run_buffers["waveforms"].extend(num_triggers*num_waveforms, **waveform_columns)
+        return num_triggers
+
+    # Same operation order as in parse_scope_file, so the time values are bit-identical
+    time_idx = numpy.arange(num_points)
+    time_data = time_idx[numpy.newaxis, numpy.newaxis, :] * waveform_headers['x_increment'][:, :, numpy.newaxis] + waveform_headers['x_origin'][:, :, numpy.newaxis]
+
+    sample_columns = {
+        "channel_idx": numpy.repeat(channel_idx, num_points),
+        "waveform_idx": numpy.repeat(waveform_idx, num_points),
+        "n_trigger": numpy.repeat(waveform_trigger_idx, num_points),
+        "x": time_data.ravel(),
+        "y": samples.ravel(),
+        "x_idx": numpy.tile(time_idx, num_triggers*num_waveforms),
+    }
+    if save_buffers and num_buffers == 1: # With a single buffer per waveform, the buffer holds exactly the waveform
+        run_buffers["waveform_buffer"].extend(samples.size, buffer_idx = 0, **sample_columns)
+    elif save_buffers: # The time of the samples of each buffer starts again from the origin, as in parse_scope_file
+        buffer_x_idx = time_idx - numpy.repeat(buffer_starts[:-1], block.buffer_points)
+        buffer_time_data = buffer_x_idx[numpy.newaxis, numpy.newaxis, :] * waveform_headers['x_increment'][:, :, numpy.newaxis] + waveform_headers['x_origin'][:, :, numpy.newaxis]
+        run_buffers["waveform_buffer"].extend(
+                                                samples.size,
+                                                channel_idx = sample_columns["channel_idx"],
+                                                waveform_idx = sample_columns["waveform_idx"],
+                                                buffer_idx = numpy.tile(numpy.repeat(numpy.arange(num_buffers), block.buffer_points), num_triggers*num_waveforms),
+                                                n_trigger = sample_columns["n_trigger"],
+                                                x = buffer_time_data.ravel(),
+                                                y = sample_columns["y"],
+                                                x_idx = numpy.tile(buffer_x_idx, num_triggers*num_waveforms),
+                                            )
+        del buffer_x_idx
+        del buffer_time_data
+    run_buffers["waveforms"].extend(samples.size, **sample_columns)
+    return num_triggers
+
+def trigger_waveforms_dataframe(run_buffers:dict, n_trigger:int, schema_version:int=1):
+    # One row per sample dataframe with the waveforms of a trigger which is still in the buffers, the triggers are in increasing order in the buffers
+    waveform_rows = numpy.searchsorted(run_buffers["waveforms"].column("n_trigger"), [n_trigger, n_trigger + 1])
+    waveforms_df = run_buffers["waveforms"].to_dataframe(waveform_rows[0], waveform_rows[1])
+    if schema_version == 1:
+        return waveforms_df
+
+    metadata_rows = numpy.searchsorted(run_buffers["waveform_metadata"].column("n_trigger"), [n_trigger, n_trigger + 1])
+    return expand_compact_waveforms(waveforms_df, run_buffers["waveform_metadata"].to_dataframe(metadata_rows[0], metadata_rows[1]))
+
+def update_waveform_average(waveform_average:WaveformAverage, run_buffers:dict, first_waveform_row:int, first_metadata_row:int, schema_version:int=1):
+    # Adds the waveforms appended to the run buffers since the given rows to the running average
+    if schema_version == 1:
+        columns = {name: run_buffers["waveforms"].column(name)[first_waveform_row:] for name in ["channel_idx", "waveform_idx", "x_idx", "x", "y"]}
+    else:
+        samples_df = expand_compact_waveforms(
+                                                run_buffers["waveforms"].to_dataframe(first_waveform_row),
+                                                run_buffers["waveform_metadata"].to_dataframe(first_metadata_row),
+                                            ).reset_index()
+        columns = {name: samples_df[name].to_numpy() for name in ["channel_idx", "waveform_idx", "x_idx", "x", "y"]}
+    waveform_average.update(**columns)
+
+def rebuild_waveform_average(output_path:Path, output_format:str):
+    # Only needed when resuming a conversion for which the saved running average can not be used, since it reads all the samples back.
+    # They are read in chunks of triggers, so the memory stays bounded
+    waveform_average = WaveformAverage()
+    if not table_exists(output_path, output_format, 'waveforms'):
+        return waveform_average
+
+    with WaveformStore(output_path, output_format) as waveform_store:
+        for metadata_df, times, samples in waveform_store.iter_chunks():
+            valid = ~numpy.isnan(times) # Not the padding of the shorter waveforms
+            number_points = metadata_df["number_points"].to_numpy()
+            waveform_average.update(
+                                    channel_idx = numpy.repeat(metadata_df["channel_idx"].to_numpy(), number_points),
+                                    waveform_idx = numpy.repeat(metadata_df["waveform_idx"].to_numpy(), number_points),
+                                    x_idx = numpy.broadcast_to(numpy.arange(times.shape[1]), times.shape)[valid],
+                                    x = times[valid],
+                                    y = samples[valid],
+                                )
+    return waveform_average
+
+def save_waveform_average(path:Path, waveform_average:WaveformAverage, n_trigger:int):
+    # The running average is saved as plain arrays, with the first trigger it does not include, so a resumed conversion can check it matches the tables
+    arrays = waveform_average.to_arrays()
+    arrays["n_trigger"] = numpy.array(n_trigger)
+    temporary_path = path.with_suffix('.tmp')
+    with open(temporary_path, "wb") as file:
+        numpy.savez(file, **arrays)
+    os.replace(temporary_path, path)
+
+def load_waveform_average(path:Path, n_trigger:int):
+    # None when there is no saved average, it does not match n_trigger or it can not be read, so it is rebuilt from the tables
+    script_logger = logging.getLogger('convert_scope')
+
+    if not path.is_file():
+        return None
+    try:
+        with numpy.load(path, allow_pickle=False) as arrays:
+            if int(arrays["n_trigger"]) != n_trigger:
+                return None
+            return WaveformAverage.from_arrays(arrays)
+    except Exception as error:
+        script_logger.warning("Could not read the saved running average {}: {}".format(path, error))
+        return None
+
+def save_channel_map(channel_map:dict, num_saved_channels:int, writer):
+    # Only the channels which are not yet in the table are written
+    script_logger = logging.getLogger('convert_scope')
+
+    script_logger.info('Saving channel map into database...')
+    channel_list = []
+    idx_list = []
+    for channel, idx in channel_map.items():
+        if idx < num_saved_channels:
+            continue
+        channel_list += [channel]
+        idx_list += [idx]
+    channel_map_df = pandas.DataFrame(
+                        {
+                            "channel_name": channel_list,
+                            "channel_idx": idx_list,
+                        }
+                    )
+    channel_map_df.set_index(["channel_idx"], inplace=True)
+    writer.write('channel_map', channel_map_df)
+
+def save_conversion_progress(
+        run_buffers:dict,
+        manifest_buffer:ColumnarBuffer,
+        channel_map:dict,
+        num_saved_channels:int,
+        waveform_average:WaveformAverage,
+        n_trigger:int,
+        writer,
+        average_path:Path,
+        save_buffers:bool=False,
+        metrics:ConversionMetrics=None,
+        sample_codec:str="none",
+        ):
+    # The manifest entries are only written after the rows of their files, so the manifest never lists files which are not in the tables.
+    # Returns the number of channels in the channel map table
+    start_time = time.perf_counter()
+    rows = sum(len(run_buffer) for run_buffer in run_buffers.values()) + len(manifest_buffer)
+
+    save_channel_map(channel_map, num_saved_channels, writer)
+    save_run_buffers(run_buffers, writer, save_buffers, sample_codec)
+    writer.write('manifest', manifest_buffer.to_dataframe())
+    manifest_buffer.clear()
+    save_waveform_average(average_path, waveform_average, n_trigger)
+
+    if metrics is not None:
+        metrics.add("write", time.perf_counter() - start_time, rows=rows)
+    return len(channel_map)
+
+def min_max_decimation(y:numpy.ndarray, max_points:int):
+    # Indexes of the samples to keep so a curve has at most max_points, keeping the minimum and maximum of each bucket of
+    # consecutive samples so the peaks of the pulses survive the decimation
+    if max_points is None or len(y) <= max_points:
+        return numpy.arange(len(y))
+
+    num_buckets = max(1, (max_points - 2)//2)
+    edges = numpy.linspace(0, len(y), num_buckets + 1).astype(int)
+    bucket = numpy.repeat(numpy.arange(num_buckets), numpy.diff(edges))
+    order = numpy.lexsort((y, bucket)) # Sorted by bucket, then by amplitude within each bucket
+    return numpy.unique(numpy.concatenate([[0, len(y) - 1], order[edges[:-1]], order[edges[1:] - 1]])) # The first and last samples keep the full time range
+
+def decimate_waveforms(waveforms_df:pandas.DataFrame, max_points:int, y_column:str="y"):
+    # Applies min_max_decimation to each waveform of each channel in the dataframe
+    if max_points is None:
+        return waveforms_df
+
+    rows = []
+    for waveform_rows in waveforms_df.groupby(level=["channel_idx", "waveform_idx"], sort=False).indices.values():
+        rows += [waveform_rows[min_max_decimation(waveforms_df[y_column].to_numpy()[waveform_rows], max_points)]]
+    if len(rows) == 0:
+        return waveforms_df
+    return waveforms_df.iloc[numpy.sort(numpy.concatenate(rows))]
+
+class PlotPool:
+    """Renders the plots in worker processes, so the conversion does not wait for them.
+
+    At most a few plots per worker are queued, submitting more waits for the oldest one to finish.
+    With no workers the plots are rendered when submitted.
+    """
+    def __init__(self, workers:int=1):
+        self._executor = None
+        if workers > 0:
+            self._executor = ProcessPoolExecutor(max_workers=workers, initializer=init_worker_logging, initargs=(logging.getLogger().getEffectiveLevel(),))
+        self._pending = deque()
+        self._max_pending = 4*workers
+        self.statistics = {"plots": 0, "seconds": 0.} # Time the conversion spent rendering or waiting for the plots
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, err_type, err_value, err_traceback):
+        self.close()
+
+    def submit(self, function, *args, **kwargs):
+        start_time = time.perf_counter()
+        self.statistics["plots"] += 1
+        if self._executor is None:
+            function(*args, **kwargs)
+        else:
+            while len(self._pending) >= self._max_pending:
+                self._pending.popleft().result()
+            self._pending.append(self._executor.submit(function, *args, **kwargs))
+        self.statistics["seconds"] += time.perf_counter() - start_time
+
+    def close(self):
+        if self._executor is None:
+            return
+        start_time = time.perf_counter()
+        while len(self._pending) > 0:
+            self._pending.popleft().result()
+        self._executor.shutdown()
+        self._executor = None
+        self.statistics["seconds"] += time.perf_counter() - start_time
+
+def plot_trigger_waveforms(waveforms_df:pandas.DataFrame, file_name:str, plot_dir:Path, max_points:int=None):
+    import plotly.express as px # Slow to import, so only imported when plotting
+
+    plot_dir.mkdir(exist_ok=True)
+
+    fig = px.line(
+        decimate_waveforms(waveforms_df, max_points).reset_index(["waveform_idx", "channel_idx"]),
+        x = 'x',
+        y = 'y',
+        facet_row = 'waveform_idx',
+        line_group = 'channel_idx',
+        labels = {
+            "x": "Time (s)",
+            "y": "Amplitude (V)",
+        },
+        render_mode = 'webgl', # https://plotly.com/python/webgl-vs-svg/
+        title = "Waveform of {}".format(file_name)
+    )
+
+    fig.write_html(
+        str(plot_dir/'waveform.html'),
+        full_html = False, # For saving a html containing only a div with the plot
+        include_plotlyjs = 'cdn',
+    )
+
+def save_run_buffers(run_buffers:dict, writer, save_buffers:bool=False, sample_codec:str="none"):
+    # The samples are kept uncompressed in the buffers, e.g. for the average and the plots, and only compressed when written
+    script_logger = logging.getLogger('convert_scope')
+
+    for table_name in ["run_metadata", "waveform_metadata", "waveform_buffer_metadata", "waveform_buffer", "waveforms"]:
+        if table_name == "waveform_buffer" and not save_buffers:
+            continue
+        script_logger.info('Saving {} into database...'.format(table_name.replace('_', ' ')))
+        table_df = run_buffers[table_name].to_dataframe()
+        if sample_codec != "none" and "samples" in table_df.columns:
+            table_df["samples"] = encode_sample_blobs(table_df["samples"].tolist(), table_df["sample_dtype"].tolist(), sample_codec)
+        writer.write(table_name, table_df)
+        del table_df
+        run_buffers[table_name].clear()
+
+def plot_average_waveform(average_waveform_df:pandas.DataFrame, x_start_df:pandas.DataFrame, task_path:Path, max_points:int=None):
+    import plotly.express as px
+    x_start_var = x_start_df["x"].var()
+    average_waveform_df = decimate_waveforms(average_waveform_df, max_points)
+
+    #print(x_start_df)
+    #print(waveforms_df)
+    #print(average_waveform_df)
+
+    plot_dir = task_path#/"summary"
+    plot_dir.resolve()
+    plot_dir.mkdir(exist_ok=True)
+
+    fig = px.histogram(
+        x_start_df,
+        x = 'x',
+        labels = {
+            "x": "Start Time (s)",
+            "y": "Counts",
+        },
+        title = "Histogram of Waveform Start Times<br><sup>Standard Deviation: {}</sup>".format(sqrt(x_start_var))
+    )
+
+    fig.write_html(
+        str(plot_dir/'waveform_start_times.html'),
+        full_html = False, # For saving a html containing only a div with the plot
+        include_plotlyjs = 'cdn',
+    )
+
+    # Draw the mean together with a band of one standard deviation around it
+    y_std = numpy.sqrt(average_waveform_df["y_variance"])
+    average_waveform_plot_df = pandas.concat(
+                                                [
+                                                    average_waveform_df[["x"]].assign(y = average_waveform_df["y"], curve = "mean"),
+                                                    average_waveform_df[["x"]].assign(y = average_waveform_df["y"] + y_std, curve = "mean + σ"),
+                                                    average_waveform_df[["x"]].assign(y = average_waveform_df["y"] - y_std, curve = "mean - σ"),
+                                                ]
+                                            )
+    del y_std
+
+    fig = px.line(
+        average_waveform_plot_df.reset_index(["waveform_idx", "channel_idx"]),
+        x = 'x',
+        y = 'y',
+        facet_row = 'waveform_idx',
+        line_group = 'channel_idx',
+        line_dash = 'curve',
+        labels = {
+            "x": "Time (s)",
+            "y": "Amplitude (V)",
+        },
+        render_mode = 'webgl', # https://plotly.com/python/webgl-vs-svg/
+        title = "Average Waveform"
+    )
+
+    fig.write_html(
+        str(plot_dir/'average_waveform.html'),
+        full_html = False, # For saving a html containing only a div with the plot
+        include_plotlyjs = 'cdn',
+    )
+
+def natural_sort_key(path:Path):
+    # Sort file names by their numeric parts, so that wav2.bin comes before wav10.bin
+    return [int(token) if token.isdigit() else token for token in re.split(r'(\d+)', path.name)]
+
+def parse_scope_files(
+        paths:list,
+        layout:numpy.dtype=None,
+        save_buffers:bool=False,
+        schema_version:int=1,
+        float32:bool=False,
+        sample_scaling:dict=None,
+        hash_files:bool=False,
+        ):
+    # Parses the files into new run buffers, with trigger numbers starting at 0 and a channel map local to these files.
+    # Returns the buffers, the channel map, the file name of each trigger, which is repeated for the segments of a segmented
+    # acquisition, the content hash of every file, an empty string unless hash_files, and the metrics of the parsing, use
+    # merge_run_buffers to add them to the run
+    script_logger = logging.getLogger('convert_scope')
+
+    metrics = ConversionMetrics()
+    run_buffers = create_run_buffers(schema_version=schema_version)
+    channel_map = {}
+    file_names = []
+    file_digests = {path.name: "" for path in paths}
+    if hash_files: # An extra read of the files, only needed to recognise unchanged files with a new modification time when resuming
+        with metrics.stage("hash", files=len(paths), bytes=sum(path.stat().st_size for path in paths)):
+            file_digests = {path.name: file_digest(path) for path in paths}
+
+    start_time = time.perf_counter()
+    block = None
+    if layout is not None:
+        block = InfiniiumUniformBlock(paths, layout)
+
+    idx = 0
+    while idx < len(paths): # Loop on consecutive groups of files which can be processed together
+        if block is not None and block.is_uniform[idx]:
+            end = idx
+            while end < len(paths) and block.is_uniform[end]:
+                end += 1
+            script_logger.info("  Processing runs {} to {} with the uniform layout".format(paths[idx].name, paths[end - 1].name))
+            parse_uniform_block(block, numpy.arange(idx, end), len(file_names), channel_map, run_buffers, save_buffers, schema_version, float32, sample_scaling)
+            file_names += [path.name for path in paths[idx:end] for _ in range(block.num_segments)]
+            idx = end
+        else:
+            path = paths[idx]
+            idx += 1
+            script_logger.info("  Processing run {}".format(path.name))
+
+            try:
+                scope_file = InfiniiumBinaryFile(path)
+            except InfiniiumFileError as error: # Skip files with incorrect format
+                script_logger.error("Skipping the file {}: {}".format(path.name, error))
+                continue
+
+            with scope_file: # Open the file
+                num_triggers = parse_scope_file(scope_file, len(file_names), channel_map, run_buffers, save_buffers, schema_version, float32, sample_scaling)
+            file_names += [path.name]*num_triggers # Only files which were correctly parsed get here
+            del num_triggers
+            del scope_file
+
+        script_logger.info("")
+
+    parsed_files = set(file_names)
+    metrics.add(
+                "parse",
+                time.perf_counter() - start_time,
+                files = len(parsed_files),
+                triggers = len(file_names),
+                waveforms = len(run_buffers["waveform_metadata"]),
+                bytes = sum(path.stat().st_size for path in paths if path.name in parsed_files),
+            )
+    return run_buffers, channel_map, file_names, file_digests, metrics
+
+def merge_run_buffers(
+        run_buffers:dict,
+        channel_map:dict,
+        n_trigger:int,
+        parsed_buffers:dict,
+        parsed_channel_map:dict,
+        ):
+    # Appends the buffers from parse_scope_files to the run buffers, renumbering the triggers from n_trigger and translating the local channel indexes
+    channel_lookup = numpy.zeros(len(parsed_channel_map), dtype=int)
+    for channel, idx in parsed_channel_map.items(): # In order of first appearance, so the result is the same as parsing all the files in one go
+        if channel not in channel_map:
+            channel_map[channel] = len(channel_map)
+        channel_lookup[idx] = channel_map[channel]
+
+    for table_name, parsed_buffer in parsed_buffers.items():
+        columns = {name: parsed_buffer.column(name) for name in parsed_buffer.names}
+        columns["n_trigger"] = columns["n_trigger"] + n_trigger
+        if "channel_idx" in columns:
+            columns["channel_idx"] = channel_lookup[columns["channel_idx"]]
+        run_buffers[table_name].extend(len(parsed_buffer), **columns)
+
+def parse_scope_files_in_order(
+        chunks:list,
+        layout:numpy.dtype=None,
+        save_buffers:bool=False,
+        schema_version:int=1,
+        jobs:int=1,
+        float32:bool=False,
+        sample_scaling:dict=None,
+        hash_files:bool=False,
+        ):
+    # Yields the result of parse_scope_files for each chunk of files, in the order of the chunks.
+    # With more than one job the chunks are parsed in a process pool, with at most two chunks per job waiting to be merged so memory stays bounded
+    if jobs <= 1:
+        for chunk in chunks:
+            yield parse_scope_files(chunk, layout, save_buffers, schema_version, float32, sample_scaling, hash_files)
+        return
+
+    with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker_logging, initargs=(logging.getLogger().getEffectiveLevel(),)) as executor:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(executor.submit(parse_scope_files, chunk, layout, save_buffers, schema_version, float32, sample_scaling, hash_files))
+            if len(pending) >= 2*jobs:
+                yield pending.popleft().result()
+        while len(pending) > 0:
+            yield pending.popleft().result()
+
+def scope_file_complete(path:Path):
+    # The scope writes the size of the whole file in its header, so the file is complete once it reaches that size
+    file_size = path.stat().st_size
+    if file_size < file_header_dtype.itemsize:
+        return False
+    with open(path, "rb") as file:
+        file_header = numpy.frombuffer(file.read(file_header_dtype.itemsize), dtype=file_header_dtype)[0]
+    return file_header['file_size'] == file_size
+
+def find_new_scope_files(directory:Path, known_files:set):
+    # Returns the complete files which are not in known_files, in acquisition order, and adds them to it
+    new_paths = []
+    for path in sorted(directory.glob('wav*.bin'), key=natural_sort_key):
+        if path.name in known_files or not scope_file_complete(path):
+            continue
+        known_files.add(path.name)
+        new_paths += [path]
+    return new_paths
+
+def wait_for_scope_files(directory:Path, known_files:set, poll_interval:float=5, timeout:float=None):
+    # Polls the directory until there are new complete files, returns an empty list if none arrive within the timeout or on Ctrl+C
+    script_logger = logging.getLogger('convert_scope')
+
+    start_time = time.monotonic()
+    try:
+        while timeout is None or time.monotonic() - start_time < timeout:
+            new_paths = find_new_scope_files(directory, known_files)
+            if len(new_paths) > 0:
+                return new_paths
+            time.sleep(poll_interval)
+        script_logger.info("No new files in the last {} s, stopping".format(timeout))
+    except KeyboardInterrupt:
+        script_logger.info("Stopped watching for new files")
+    return []
+
+class RawDataBackup:
+    """Backs up the original files in a background thread, while they are being converted.
+
+    The files are compressed into a zip archive or, with link=True, hardlinked into a directory (copied when the
+    filesystem does not support hardlinks). The blake2b checksum of each file is written next to the backup in the
+    format of `b2sum -l 128`, so the backed up files can be verified with `b2sum -c`.
+    Files already in the backup, e.g. when resuming a conversion, are not backed up again, except for the stale_names,
+    e.g. files which changed since they were converted, whose old copy and checksum are removed so they are backed up again.
+    """
+    def __init__(self, path:Path, link:bool=False, compresslevel:int=1, stale_names:set=frozenset()):
+        script_logger = logging.getLogger('convert_scope')
+
+        self.path = Path(path)
+        self.link = link
+        self.compresslevel = compresslevel
+        self._archive = None
+        if link:
+            self.path.mkdir(exist_ok=True)
+            self._checksum_path = self.path/'checksums.b2'
+            self._names = {str(file_path.relative_to(self.path)) for file_path in self.path.rglob('*') if file_path.is_file() and file_path != self._checksum_path}
+        else:
+            self._checksum_path = self.path.with_suffix('.b2')
+            try:
+                self._archive = zipfile.ZipFile(self.path, 'a', compression=zipfile.ZIP_DEFLATED, compresslevel=compresslevel)
+            except zipfile.BadZipFile: # Left unfinished by an interrupted conversion
+                script_logger.warning("The backup archive {} is incomplete, moving it aside and starting a new one".format(self.path))
+                self.path.rename(self.path.with_suffix('.incomplete.zip'))
+                self._archive = zipfile.ZipFile(self.path, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=compresslevel)
+            self._names = set(self._archive.namelist())
+        self._checksum_file = open(self._checksum_path, 'a')
+        self._executor = ThreadPoolExecutor(max_workers=1) # A single worker, so the archive is written sequentially
+        self._futures = []
+        self.statistics = {"files": 0, "bytes": 0, "seconds": 0.} # Filled by the background thread
+
+        stale_names = self._names & set(stale_names)
+        if len(stale_names) > 0: # Removed by the worker before any other file is backed up
+            self._names -= stale_names
+            self._futures += [self._executor.submit(self._remove_backups, stale_names)]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, err_type, err_value, err_traceback):
+        self.close()
+
+    def add(self, path:Path, name:str):
+        if name in self._names:
+            return
+        self._names.add(name)
+        self._futures += [self._executor.submit(self._backup_file, Path(path), name)]
+
+    def add_directory(self, directory:Path):
+        for path in sorted(directory.rglob('*')):
+            if path.is_file():
+                self.add(path, str(path.relative_to(directory)))
+
+    def _remove_backups(self, names:set):
+        if self.link:
+            for name in names:
+                (self.path/name).unlink(missing_ok=True)
+        else: # Entries can not be removed from a zip archive, so it is rewritten without them
+            self._archive.close()
+            rewritten_path = self.path.with_suffix('.rewritten.zip')
+            with zipfile.ZipFile(self.path, 'r') as archive, zipfile.ZipFile(rewritten_path, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=self.compresslevel) as rewritten_archive:
+                for info in archive.infolist():
+                    if info.filename not in names:
+                        with archive.open(info) as in_file, rewritten_archive.open(info, 'w') as out_file:
+                            shutil.copyfileobj(in_file, out_file, 2**20)
+            os.replace(rewritten_path, self.path)
+            self._archive = zipfile.ZipFile(self.path, 'a', compression=zipfile.ZIP_DEFLATED, compresslevel=self.compresslevel)
+
+        self._checksum_file.close()
+        with open(self._checksum_path) as checksum_file:
+            checksum_lines = [line for line in checksum_file if line.rstrip("\n").split("  ", 1)[-1] not in names]
+        with open(self._checksum_path, 'w') as checksum_file:
+            checksum_file.writelines(checksum_lines)
+        self._checksum_file = open(self._checksum_path, 'a')
+
+    def _backup_file(self, path:Path, name:str):
+        start_time = time.perf_counter()
+        if self.link:
+            backup_path = self.path/name
+            backup_path.parent.mkdir(parents=True, exist_ok=True)
+            try:
+                os.link(path, backup_path)
+            except OSError: # e.g. the backup is on a different filesystem
+                shutil.copy2(path, backup_path)
+        else:
+            self._archive.write(path, name)
+        self._checksum_file.write("{}  {}\n".format(file_digest(path), name))
+        self.statistics["files"] += 1
+        self.statistics["bytes"] += path.stat().st_size
+        self.statistics["seconds"] += time.perf_counter() - start_time
+
+    def close(self):
+        script_logger = logging.getLogger('convert_scope')
+
+        if self._executor is None:
+            return
+        script_logger.info("Waiting for the backup of the original data to finish")
+        self._executor.shutdown(wait=True)
+        self._executor = None
+        if self._archive is not None:
+            self._archive.close()
+        self._checksum_file.close()
+        for future in self._futures: # Raise any error from the backup
+            future.result()
+        self._futures = []
+
 def script_main(
         directory:Path,
         output_directory:Path,
         plot_waveforms:bool=False,
         save_buffers:bool=False,
+        jobs:int=1,
+        output_format:str="sqlite",
+        schema_version:int=1,
+        resume:bool=False,
+        watch:bool=False,
+        poll_interval:float=5,
+        watch_timeout:float=None,
+        refresh_triggers:int=100,
+        backup:str="zip",
+        plot_jobs:int=1,
+        plot_points:int=2000,
+        plots:bool=True,
+        float32:bool=False,
+        sample_scaling:dict=None,
+        sample_codec:str="none",
         ):
 
     script_logger = logging.getLogger('convert_scope')
@@ -82,9 +1731,12 @@ def script_main(
         return
 
     with RM.RunManager(output_directory.resolve()) as John:
-        John.create_run(raise_error=True)
+        John.create_run(raise_error=not resume)
 
-        if not plot_waveforms:
+        waveform_plot_list = []
+        if not plots:
+            plot_waveforms = False
+        elif not plot_waveforms and not watch: # When watching, the number of files is not known in advance
             numFiles = len(list(directory.glob('wav*.bin')))
             if numFiles < 10:
                 plot_waveforms = True
@@ -92,13 +1744,8 @@ def script_main(
                 waveform_plot_list = random.sample(range(1, numFiles), 10)
 
 
-        with John.handle_task("convert_scope_data") as Oliver:
-            # Copied data location
-            copied_data = (Oliver.task_path/'original_data_from_oscilloscope').resolve()
-
-            # Copy and save original data
-            script_logger.info("Copying original data to backup location")
-            copy_tree(str(directory.resolve()), str(copied_data))
+        with John.handle_task("convert_scope_data", drop_old_data=not resume) as Oliver:
+            metrics = ConversionMetrics()
 
             #if (output_directory/'waveforms.sqlite').exists():
             #    script_logger.info("Deleting old database file")
@@ -106,561 +1753,248 @@ def script_main(
 
             # Create data directory
             data_dir = John.path_directory/"data"
-            data_dir.mkdir()
-
-            with sqlite3.connect(data_dir/'waveforms.sqlite') as sqlite3_connection:
-                waveforms_df = pandas.DataFrame()
-                waveform_buffer_df = pandas.DataFrame()
-                run_metadata_df = pandas.DataFrame()
-                waveform_metadata_df = pandas.DataFrame()
-                waveform_buffer_metadata_df = pandas.DataFrame()
-
-                if_exists = 'replace' # What to do if the table already exists in the output sqlite
-
-                # TODO: How to guarantee the order of the files?
-                n_trigger = 0
-                channel_map = {}
-                for path in tqdm (copied_data.glob('wav*.bin'), desc="Converting Scope data..."): # Loop on binary waveform files
-                    script_logger.info("  Processing run {}".format(path.name))
-
-                    with path.open(mode='rb') as runFile: # Open the file
-                        # Prepare empty pandas dataframes for the information from this file
-                        file__waveforms_df = pandas.DataFrame()
-                        file__waveform_buffer_df = pandas.DataFrame()
-                        file__run_metadata_df = pandas.DataFrame()
-                        file__waveform_metadata_df = pandas.DataFrame()
-                        file__waveform_buffer_metadata_df = pandas.DataFrame()
-
-                        data_ok = True
-                        file_header_ok = True
-                        waveform_header_ok = True
-                        waveform_data_header_ok = True
-
-                        # Read the file header
-                        file_header = numpy.fromfile(runFile, dtype=file_header_dtype, count=1)
-
-                        script_logger.debug("    Got the following file header:")
-                        script_logger.debug("      - Cookie: {}".format(file_header['cookie'][0]))
-                        script_logger.debug("      - Version: {}".format(file_header['version'][0]))
-                        script_logger.debug("      - File Size: {} bytes".format(file_header['file_size'][0]))
-                        script_logger.debug("      - Number of Waveforms: {}".format(file_header['num_waveforms'][0]))
-
-                        if file_header['cookie'][0] != b'AG': # Skip files with incorrect format
-                            file_header_ok = False
-                            script_logger.error("The file {} is not in the Agilent Binary Data format, skipping it...".format(path.name))
-                            continue
-
-                        file__run_metadata_df = pandas.concat(
-                                                            [
-                                                                file__run_metadata_df,
-                                                                pandas.DataFrame(
-                                                                    {
-                                                                        "n_trigger": n_trigger,
-                                                                        "file_name": path.name,
-                                                                        "file_version": int(file_header['version'][0]),
-                                                                        "file_size": int(file_header['file_size'][0]),
-                                                                        "number_waveforms": int(file_header['num_waveforms'][0]),
-                                                                    },
-                                                                    index=[0]
-                                                                ),
-                                                            ],
-                                                            #ignore_index=True
-                                                            )
-                        #print(file__run_metadata_df)
-                        file__run_metadata_df.set_index(["n_trigger"], inplace=True)
-                        #print(file__run_metadata_df)
-
-                        for waveform_idx in numpy.arange(file_header['num_waveforms'][0]): # Loop on the waveforms in the file. TODO: Is it possible to have more than one waveform per channel?
-                            # Read the waveform header
-                            waveform_header = numpy.fromfile(runFile, dtype=waveform_header_dtype, count=1)
-
-                            channel_string = bytes(waveform_header['waveform_string'][0]).decode('utf-8')
-                            frame_string   = bytes(waveform_header[   'frame_string'][0]).decode('utf-8')
-                            date_string    = bytes(waveform_header[    'date_string'][0]).decode('utf-8')
-                            time_string    = bytes(waveform_header[    'time_string'][0]).decode('utf-8')
-
-                            script_logger.info("    Parsing {}".format(channel_string))
-                            script_logger.debug("      Got the Waveform header:")
-                            script_logger.debug("        - Header Size: {}".format(waveform_header['header_size'][0], 'i4'))
-                            script_logger.debug("        - Type: {}".format(waveform_header['waveform_type'][0], 'i4'))
-                            script_logger.debug("        - Number Buffers: {}".format(waveform_header['num_waveform_buffers'][0], 'i4'))
-                            script_logger.debug("        - Number of Points: {}".format(waveform_header['num_points'][0], 'i4'))
-                            script_logger.debug("        - Count: {}".format(waveform_header['count'][0], 'i4'))
-                            script_logger.debug("        - Range X Display: {}".format(waveform_header['x_display_range'][0], 'f4'))
-                            script_logger.debug("        - Origin X Display: {}".format(waveform_header['x_display_origin'][0], 'f8'))
-                            script_logger.debug("        - X Increment: {}".format(waveform_header['x_increment'][0], 'f8'))
-                            script_logger.debug("        - X Origin: {}".format(waveform_header['x_origin'][0], 'f8'))
-                            script_logger.debug("        - X Units: {}".format(waveform_header['x_units'][0], 'i4'))
-                            script_logger.debug("        - Y Units: {}".format(waveform_header['y_units'][0], 'i4'))
-                            script_logger.debug("        - Date: {}".format(waveform_header['date_string'][0], 'S16'))
-                            script_logger.debug("        - Time: {}".format(waveform_header['time_string'][0], 'S16'))
-                            script_logger.debug("        - Frame: {}".format(waveform_header['frame_string'][0], 'S24'))
-                            script_logger.debug("        - Waveform Label: {}".format(waveform_header['waveform_string'][0], 'S16'))
-                            script_logger.debug("        - Time Tag: {}".format(waveform_header['time_tag'][0], 'f8'))
-                            script_logger.debug("        - Segment Index: {}".format(waveform_header['segment_index'][0], 'u4'))
-
-                            if waveform_header['header_size'][0] != 140: # Check correct format for waveform header, if wrong we stop parsing waveforms and move to the next file
-                                waveform_header_ok = False
-                                script_logger.error("The waveform header has a length which is not 140. This is unexpected and requires fixing, skipping rest of file")
-                                break
-
-                            if channel_string in channel_map:
-                                channel_idx = channel_map[channel_string]
-                            else:
-                                channel_idx = len(channel_map)
-                                channel_map[channel_string] = channel_idx
-
-                            file__waveform_metadata_df = pandas.concat(
-                                                                        [
-                                                                            file__waveform_metadata_df,
-                                                                            pandas.DataFrame(
-                                                                                {
-                                                                                    "channel_idx": channel_idx,
-                                                                                    "waveform_idx": waveform_idx,
-                                                                                    "n_trigger": n_trigger,
-                                                                                    "header_size": waveform_header['header_size'][0],
-                                                                                    "waveform_type": waveform_header['waveform_type'][0],
-                                                                                    "number_buffers": waveform_header['num_waveform_buffers'][0],
-                                                                                    "number_points": waveform_header['num_points'][0],
-                                                                                    "count": waveform_header['count'][0],
-                                                                                    "x_display_range": waveform_header['x_display_range'][0],
-                                                                                    "x_display_origin": waveform_header['x_display_origin'][0],
-                                                                                    "x_increment": waveform_header['x_increment'][0],
-                                                                                    "x_origin": waveform_header['x_origin'][0],
-                                                                                    "raw_x_units": waveform_header['x_units'][0],
-                                                                                    "raw_y_units": waveform_header['y_units'][0],
-                                                                                    "x_units": InfiniiumUnitsToString(waveform_header['x_units'][0]),
-                                                                                    "y_units": InfiniiumUnitsToString(waveform_header['y_units'][0]),
-                                                                                    "date": date_string,
-                                                                                    "time": time_string,
-                                                                                    "datetime": dp.parse(date_string + ' ' + time_string),
-                                                                                    "frame": frame_string,
-                                                                                    "channel": channel_string,
-                                                                                    "time_tag": waveform_header['time_tag'][0],
-                                                                                    "segment_index": waveform_header['segment_index'][0],
-                                                                                },
-                                                                                index=[0]
-                                                                            ),
-                                                                        ],
-                                                                        #ignore_index=True
-                                                                    )
-                            #print(file__waveform_metadata_df)
-                            file__waveform_metadata_df.set_index(["n_trigger", "channel_idx", "waveform_idx"], inplace=True)
-                            #print(file__waveform_metadata_df)
-
-                            del channel_string
-                            del frame_string
-                            del date_string
-                            del time_string
-
-                            if waveform_header['num_waveform_buffers'][0] > 1:
-                                script_logger.critical("Please review the code that is merging the waveform buffers together, this has not been tested")
-
-                            processed_points = 0
-                            y_data = None
-                            for buffer_idx in range(waveform_header['num_waveform_buffers'][0]): # Loop on the buffers for this waveform. TODO: Is it possible to have more than 1 per waveform?
-                                # Read the waveform buffer header
-                                buffer_header = numpy.fromfile(runFile, dtype=waveform_data_header_dtype, count=1)
-
-                                script_logger.debug("      Got the Waveform Data header:")
-                                script_logger.debug("        - Header Size: {}".format(buffer_header['header_size'][0]))
-                                script_logger.debug("        - Buffer Type: {}".format(buffer_header['buffer_type'][0]))
-                                script_logger.debug("        - Bytes Per Point: {}".format(buffer_header['bytes_per_point'][0]))
-                                script_logger.debug("        - Buffer Size: {}".format(buffer_header['buffer_size'][0]))
-
-                                if buffer_header['header_size'][0] != 12: # Check correct format for waveform data header, if wrong we stop parsing waveform buffers
-                                    waveform_data_header_ok = False
-                                    script_logger.error("The waveform buffer header has a length which is not 12. This is unexpected and requires fixing, skipping rest of file")
-                                    break
-
-                                file__waveform_buffer_metadata_df = pandas.concat(
-                                                                                    [
-                                                                                        file__waveform_buffer_metadata_df,
-                                                                                        pandas.DataFrame(
-                                                                                            {
-                                                                                                "channel_idx": channel_idx,
-                                                                                                "waveform_idx": waveform_idx,
-                                                                                                "buffer_idx": buffer_idx,
-                                                                                                "n_trigger": n_trigger,
-                                                                                                "header_size": buffer_header['header_size'][0],
-                                                                                                "buffer_type": buffer_header['buffer_type'][0],
-                                                                                                "bytes_per_point": buffer_header['bytes_per_point'][0],
-                                                                                                "buffer_size": buffer_header['buffer_size'][0],
-                                                                                                "x_units": InfiniiumUnitsToString(waveform_header['x_units'][0]),
-                                                                                                "y_units": InfiniiumUnitsToString(waveform_header['y_units'][0]),
-                                                                                            },
-                                                                                            index=[0]
-                                                                                        ),
-                                                                                    ],
-                                                                                    #ignore_index=True
-                                                                                )
-                                #print(file__waveform_buffer_metadata_df)
-                                file__waveform_buffer_metadata_df.set_index(["n_trigger", "channel_idx", "waveform_idx", "buffer_idx"], inplace=True)
-                                #print(file__waveform_buffer_metadata_df)
-
-                                buffer_type = buffer_header['buffer_type'][0]
-                                bytes_per_point = buffer_header['bytes_per_point'][0]
-                                buffer_size = buffer_header['buffer_size'][0]
-                                buffer_points = int(buffer_size/bytes_per_point)
-                                del buffer_header
-                                del buffer_size
-
-                                # Build the dtype to read the data from the buffer
-                                if buffer_type in [1,2,3,4,5]: # Float type data
-                                    dtype_string = 'f{}'.format(bytes_per_point)
-                                elif buffer_type == 6: # Unsigned type data
-                                    dtype_string = 'u{}'.format(bytes_per_point)
-                                else: # Unknown type data, read as RAW data
-                                    dtype_string = 'V{}'.format(bytes_per_point)
-                                del buffer_type
-                                del bytes_per_point
-
-                                channel_dtype = numpy.dtype([('data', dtype_string)])
-                                del dtype_string
-
-                                # Read the buffer data from the file
-                                amplitude_data = numpy.fromfile(runFile, dtype=channel_dtype, count=buffer_points)
-                                del channel_dtype
-
-                                if len(amplitude_data) != buffer_points:
-                                    script_logger.error("There is a serious issue, asked to read {} points, but only {} were read. Maybe a corrupt file?".format(buffer_points, len(amplitude_data)))
-                                    script_logger.error("The file will be ignored")
-                                    data_ok = False
-                                    break
-
-                                time_idx = numpy.arange(buffer_points)
-                                time_data = time_idx * waveform_header['x_increment'][0] + waveform_header['x_origin'][0]
-                                del buffer_points
-
-                                file__waveform_buffer_df = pandas.concat(
-                                                                            [
-                                                                                file__waveform_buffer_df,
-                                                                                pandas.DataFrame(
-                                                                                    {
-                                                                                        "channel_idx": channel_idx,
-                                                                                        "waveform_idx": waveform_idx,
-                                                                                        "buffer_idx": buffer_idx,
-                                                                                        "n_trigger": n_trigger,
-                                                                                        "x": time_data,
-                                                                                        "y": amplitude_data.astype(float),
-                                                                                        "x_idx": time_idx,
-                                                                                    },
-                                                                                ),
-                                                                            ],
-                                                                            #ignore_index=True
-                                                                        )
-                                #print(file__waveform_buffer_df)
-                                file__waveform_buffer_df.set_index(["n_trigger", "channel_idx", "waveform_idx", "buffer_idx", "x_idx"], inplace=True)
-                                #print(file__waveform_buffer_df)
-                                processed_points += len(amplitude_data)
-
-                                if y_data is None:
-                                    y_data = amplitude_data.astype(float)
-                                else:
-                                    y_data = numpy.hstack([y_data, amplitude_data.astype(float)])
-                                del amplitude_data
-                            del buffer_idx
-
-                            if not waveform_data_header_ok or not data_ok:
-                                break
-
-                            if processed_points != waveform_header['num_points'][0]:
-                                script_logger.error("There is a mismatch between the number of points reported in the waveform header and the total number of points in the buffers. Skipping this file")
-                                data_ok = False
+            data_dir.mkdir(exist_ok=resume)
+            output_path = data_dir/'waveforms.{}'.format(output_format)
+            average_path = data_dir/'waveform_average.npz'
+
+            # Sort the files by their index so the trigger numbering follows the acquisition order
+            known_files = set()
+            if watch: # The last file may still be being written, so only the complete files are converted
+                paths = find_new_scope_files(directory, known_files)
+            else:
+                paths = sorted(directory.glob('wav*.bin'), key=natural_sort_key)
+
+            n_trigger = 0
+            channel_map = {}
+            waveform_average = WaveformAverage()
+            changed_files = set()
+            resumed = resume and table_exists(output_path, output_format, 'manifest')
+            if resumed:
+                if read_schema_version(output_path, output_format) != schema_version:
+                    schema_version = read_schema_version(output_path, output_format)
+                    script_logger.warning("Resuming a run converted with the schema version {}, which will be used".format(schema_version))
+                if read_sample_codec(output_path, output_format) != sample_codec:
+                    sample_codec = read_sample_codec(output_path, output_format)
+                    script_logger.warning("Resuming a run converted with the sample codec {}, which will be used".format(sample_codec))
+
+                manifest_df = read_manifest(output_path, output_format)
+                n_trigger = max(0, int(manifest_df["n_trigger"].max()) + 1)
+                if table_exists(output_path, output_format, 'channel_map'):
+                    channel_map_df = read_table(output_path, output_format, 'channel_map')
+                    channel_map = dict(zip(channel_map_df["channel_name"], channel_map_df["channel_idx"].astype(int)))
+                    del channel_map_df
+
+                num_files = len(paths)
+                paths, stale_triggers = select_new_files(paths, manifest_df)
+                changed_files = {path.name for path in paths if path.name in manifest_df.index} # Their backup is also stale
+                if len(stale_triggers) > 0: # The manifest holds the last trigger of each file, segmented files have more triggers
+                    run_metadata_df = read_table(output_path, output_format, 'run_metadata', columns=["n_trigger", "file_name"])
+                    stale_files = run_metadata_df.loc[run_metadata_df["n_trigger"].isin(stale_triggers), "file_name"]
+                    stale_triggers = run_metadata_df.loc[run_metadata_df["file_name"].isin(stale_files), "n_trigger"].astype(int).tolist()
+                    del run_metadata_df
+                    del stale_files
+                script_logger.info("Resuming the conversion from trigger {}, {} of {} files are new or changed".format(n_trigger, len(paths), num_files))
+                del num_files
+                del manifest_df
+
+                # Remove rows written after the last manifest entry, e.g. by an interrupted conversion, and those of the changed files
+                discard_triggers(output_path, output_format, n_trigger, stale_triggers)
+
+                waveform_average = load_waveform_average(average_path, n_trigger)
+                if waveform_average is None or len(stale_triggers) > 0:
+                    script_logger.warning("The saved running average does not match the converted data, rebuilding it from the tables")
+                    waveform_average = rebuild_waveform_average(output_path, output_format)
+                del stale_triggers
+            num_saved_channels = len(channel_map)
+            if float32 and schema_version == 1:
+                script_logger.warning("Samples are stored as float64 in the schema version 1, the float32 option is ignored")
+            if sample_codec != "none" and schema_version == 1:
+                script_logger.warning("The samples of the schema version 1 are not stored in BLOBs, the sample codec is ignored")
+                sample_codec = "none"
+
+            writer_options = {}
+            if output_format == "parquet": # Split the sample tables per channel, so a single channel can be read on its own
+                writer_options["partitions"] = {"waveforms": "channel_idx", "waveform_buffer": "channel_idx"}
+            elif output_format == "sqlite" and (resume or watch): # Every flush must survive a crash, so the conversion can be resumed from it
+                writer_options["bulk_load"] = False
+            writer = output_writers[output_format](output_path, append=resumed, **writer_options)
+
+            # The original data is backed up in the background, while the conversion reads it from the input directory
+            script_logger.info("Backing up the original data")
+            if backup == "link":
+                raw_data_backup = RawDataBackup(Oliver.task_path/'original_data_from_oscilloscope', link=True, stale_names=changed_files)
+            else:
+                raw_data_backup = RawDataBackup(Oliver.task_path/'original_data_from_oscilloscope.zip', stale_names=changed_files)
+            del changed_files
+
+            if not plots:
+                plot_jobs = 0
+            with PlotPool(plot_jobs) as plot_pool, raw_data_backup, writer:
+                if watch:
+                    for file_name in sorted(known_files, key=natural_sort_key):
+                        raw_data_backup.add(directory/file_name, file_name)
+                else:
+                    raw_data_backup.add_directory(directory)
+
+                flush_size = int(2e6) # Number of waveform rows to accumulate before writing them to the database
+                run_buffers = create_run_buffers(waveforms_capacity=flush_size, schema_version=schema_version)
+                manifest_buffer = ColumnarBuffer(manifest_table["columns"], manifest_table["index"])
+
+                if not resumed: # Written first, so an interrupted conversion can be resumed with the right schema
+                    writer.write('schema_info', pandas.DataFrame({"schema_version": [schema_version], "sample_codec": [sample_codec]}), index=False)
+
+                layout = None
+                block_size = 1000
+                last_plot_trigger = n_trigger
+                while True:
+                    # Most runs have the same layout in all files, find it from the first valid file so those files can be loaded in vectorized blocks.
+                    # When watching, the first files may only arrive later
+                    if layout is None:
+                        for path in paths:
+                            try:
+                                with InfiniiumBinaryFile(path) as scope_file:
+                                    layout = InfiniiumFileLayout(scope_file)
                                 break
-
-                            time_idx = numpy.arange(waveform_header['num_points'][0])
-                            time_data = time_idx * waveform_header['x_increment'][0] + waveform_header['x_origin'][0]
-
-                            file__waveforms_df = pandas.concat(
-                                                                [
-                                                                    file__waveforms_df,
-                                                                    pandas.DataFrame(
-                                                                        {
-                                                                            "channel_idx": channel_idx,
-                                                                            "waveform_idx": waveform_idx,
-                                                                            "n_trigger": n_trigger,
-                                                                            "x": time_data,
-                                                                            "y": y_data,
-                                                                            "x_idx": time_idx,
-                                                                        },
-                                                                    ),
-                                                                ],
-                                                                #ignore_index=True
-                                                            )
-                            #print(file__waveforms_df)
-                            file__waveforms_df.set_index(["n_trigger", "channel_idx", "waveform_idx", "x_idx"], inplace=True)
-                            #print(file__waveforms_df)
-
-                            del time_idx
-                            del time_data
-                            del y_data
-                            del processed_points
-                            del channel_idx
-                            del waveform_header
-                        del waveform_idx
-
-                        if file_header_ok and waveform_header_ok and waveform_data_header_ok and data_ok:
-                            n_trigger += 1 # Only increment if the file was correctly processed
-
-                            # Put data into the final data frames:
-                            run_metadata_df = pandas.concat(
-                                                            [
-                                                                run_metadata_df,
-                                                                file__run_metadata_df
-                                                            ],
-                                                            #ignore_index=True
-                                                        )
-                            waveform_metadata_df = pandas.concat(
-                                                            [
-                                                                waveform_metadata_df,
-                                                                file__waveform_metadata_df
-                                                            ],
-                                                            #ignore_index=True
-                                                        )
-                            waveform_buffer_metadata_df = pandas.concat(
-                                                            [
-                                                                waveform_buffer_metadata_df,
-                                                                file__waveform_buffer_metadata_df
-                                                            ],
-                                                            #ignore_index=True
-                                                        )
-                            waveforms_df = pandas.concat(
-                                                            [
-                                                                waveforms_df,
-                                                                file__waveforms_df
-                                                            ],
-                                                            #ignore_index=True
-                                                        )
-                            waveform_buffer_df = pandas.concat(
-                                                            [
-                                                                waveform_buffer_df,
-                                                                file__waveform_buffer_df
-                                                            ],
-                                                            #ignore_index=True
-                                                        )
-
-                            if plot_waveforms or n_trigger in waveform_plot_list:
-                                plot_dir = Oliver.task_path/path.name
-                                plot_dir.resolve()
-                                plot_dir.mkdir(exist_ok=True)
-
-                                fig = px.line(
-                                    file__waveforms_df.reset_index(["waveform_idx", "channel_idx"]),
-                                    x = 'x',
-                                    y = 'y',
-                                    facet_row = 'waveform_idx',
-                                    line_group = 'channel_idx',
-                                    labels = {
-                                        "x": "Time (s)",
-                                        "y": "Amplitude (V)",
-                                    },
-                                    render_mode = 'webgl', # https://plotly.com/python/webgl-vs-svg/
-                                    title = "Waveform of {}".format(path.name)
-                                )
-
-                                fig.write_html(
-                                    str(plot_dir/'waveform.html'),
-                                    full_html = False, # For saving a html containing only a div with the plot
-                                    include_plotlyjs = 'cdn',
-                                )
-
-                                del fig
-
-                            if len(waveforms_df.index) > 2e6:
-                                script_logger.info('Saving run metadata into database...')
-                                run_metadata_df.to_sql('run_metadata',
-                                                    sqlite3_connection,
-                                                    #index=False,
-                                                    if_exists=if_exists)
-                                run_metadata_df = pandas.DataFrame()
-
-                                script_logger.info('Saving waveform metadata into database...')
-                                waveform_metadata_df.to_sql('waveform_metadata',
-                                                            sqlite3_connection,
-                                                            #index=False,
-                                                            if_exists=if_exists)
-                                waveform_metadata_df = pandas.DataFrame()
-
-                                script_logger.info('Saving waveform buffer metadata into database...')
-                                waveform_buffer_metadata_df.to_sql('waveform_buffer_metadata',
-                                                                sqlite3_connection,
-                                                                #index=False,
-                                                                if_exists=if_exists)
-                                waveform_buffer_metadata_df = pandas.DataFrame()
-
-                                if save_buffers:
-                                    script_logger.info('Saving waveform buffer into database...')
-                                    waveform_buffer_df.to_sql('waveform_buffer',
-                                                            sqlite3_connection,
-                                                            #index=False,
-                                                            if_exists=if_exists)
-                                waveform_buffer_df = pandas.DataFrame()
-
-                                script_logger.info('Saving waveforms into database...')
-                                waveforms_df.to_sql('waveforms',
-                                                    sqlite3_connection,
-                                                    #index=False,
-                                                    if_exists=if_exists)
-                                waveforms_df = pandas.DataFrame()
-
-                                if_exists = "append" # Since we already wrote some of the databases to the output file, now we want to append
-                        del file__run_metadata_df
-                        del file__waveform_metadata_df
-                        del file__waveform_buffer_metadata_df
-                        del file__waveforms_df
-                        del file__waveform_buffer_df
-                        del data_ok
-                        del file_header_ok
-                        del waveform_header_ok
-                        del waveform_data_header_ok
-                        del file_header
-                    del runFile
-
-                    script_logger.info("")
-                del path
+                            except InfiniiumFileError:
+                                continue
+
+                        if layout is not None:
+                            num_waveforms, buffer_points, _ = InfiniiumLayoutShape(layout)
+                            block_size = max(1, int(flush_size // (num_waveforms*sum(buffer_points)))) # Keep each block within the database flush size
+                            del num_waveforms
+                            del buffer_points
+                            script_logger.info("Files with a uniform layout of {} bytes are loaded in blocks of {}".format(layout.itemsize, block_size))
+                        elif len(paths) > 0:
+                            script_logger.info("No uniform file layout found, parsing the files one by one")
+
+                    chunks = [paths[chunk_start:chunk_start + block_size] for chunk_start in range(0, len(paths), block_size)]
+
+                    parsed_chunks = parse_scope_files_in_order(chunks, layout, save_buffers, schema_version, jobs, float32, sample_scaling, resume or watch)
+                    with tqdm(total=len(paths), desc="Converting Scope data...") as progress_bar:
+                        for chunk in chunks:
+                            with metrics.stage("wait_for_parsing"): # Parsing itself when there is a single job
+                                parsed_buffers, parsed_channel_map, file_names, file_digests, parsed_metrics = next(parsed_chunks)
+                            metrics.merge(parsed_metrics)
+                            del parsed_metrics
+
+                            first_waveform_row = len(run_buffers["waveforms"])
+                            first_metadata_row = len(run_buffers["waveform_metadata"])
+                            with metrics.stage("merge"):
+                                merge_run_buffers(run_buffers, channel_map, n_trigger, parsed_buffers, parsed_channel_map)
+                            del parsed_buffers
+                            del parsed_channel_map
+
+                            with metrics.stage("average"):
+                                update_waveform_average(waveform_average, run_buffers, first_waveform_row, first_metadata_row, schema_version)
+                            del first_waveform_row
+                            del first_metadata_row
+
+                            chunk_triggers = dict(zip(file_names, range(n_trigger, n_trigger + len(file_names)))) # The last trigger of each file
+                            manifest_buffer.extend(
+                                                    len(chunk),
+                                                    file_name = [path.name for path in chunk],
+                                                    file_size = [path.stat().st_size for path in chunk],
+                                                    file_mtime = [path.stat().st_mtime for path in chunk],
+                                                    file_hash = [file_digests[path.name] for path in chunk],
+                                                    n_trigger = [chunk_triggers.get(path.name, -1) for path in chunk],
+                                                    converted = time.time(),
+                                                )
+                            del chunk_triggers
+                            del file_digests
+
+                            segmented_files = {file_name for file_name, count in Counter(file_names).items() if count > 1}
+                            for file_name in file_names:
+                                if plot_waveforms or (n_trigger + 1) in waveform_plot_list:
+                                    if file_name in segmented_files: # Several triggers come from the same file
+                                        file_name = "{}_trigger{}".format(file_name, n_trigger)
+                                    plot_pool.submit(
+                                        plot_trigger_waveforms,
+                                        trigger_waveforms_dataframe(run_buffers, n_trigger, schema_version),
+                                        file_name,
+                                        Oliver.task_path/file_name,
+                                        plot_points,
+                                    )
+                                n_trigger += 1
+                            del file_names
+                            del segmented_files
+
+                            if buffered_points(run_buffers) > flush_size:
+                                num_saved_channels = save_conversion_progress(run_buffers, manifest_buffer, channel_map, num_saved_channels, waveform_average, n_trigger, writer, average_path, save_buffers, metrics, sample_codec)
+
+                            if plots and watch and n_trigger - last_plot_trigger >= refresh_triggers:
+                                plot_pool.submit(plot_average_waveform, waveform_average.to_dataframe(), waveform_average.start_times_dataframe(), Oliver.task_path/'live', plot_points)
+                                last_plot_trigger = n_trigger
+
+                            progress_bar.update(len(chunk))
+                    del chunks
+                    del parsed_chunks
+                    if not watch:
+                        break
+
+                    # Make everything converted so far available while waiting for more files
+                    num_saved_channels = save_conversion_progress(run_buffers, manifest_buffer, channel_map, num_saved_channels, waveform_average, n_trigger, writer, average_path, save_buffers, metrics, sample_codec)
+                    script_logger.info("Waiting for new files in {}".format(directory))
+                    paths = wait_for_scope_files(directory, known_files, poll_interval, watch_timeout)
+                    for path in paths:
+                        raw_data_backup.add(path, path.name)
+                    if len(paths) == 0:
+                        break
+                del paths
+                del layout
+                del last_plot_trigger
+
+                if watch: # Also back up the other files in the directory, e.g. the scope setup
+                    raw_data_backup.add_directory(directory)
+                del known_files
 
                 # Write dataframes to database
-                script_logger.info('Saving channel map into database...')
-                channel_list = []
-                idx_list = []
-                for channel, idx in channel_map.items():
-                    channel_list += [channel]
-                    idx_list += [idx]
-                channel_map_df = pandas.DataFrame(
-                                    {
-                                        "channel_name": channel_list,
-                                        "channel_idx": idx_list,
-                                    }
-                                )
-                channel_map_df.set_index(["channel_idx"], inplace=True)
-                channel_map_df.to_sql('channel_map',
-                                    sqlite3_connection,
-                                    #index=False,
-                                    if_exists='replace')
-                del channel_map_df
+                save_conversion_progress(run_buffers, manifest_buffer, channel_map, num_saved_channels, waveform_average, n_trigger, writer, average_path, save_buffers, metrics, sample_codec)
                 del channel_map
-                del channel_list
-                del idx_list
-                del channel
-                del idx
-
-                script_logger.info('Saving run metadata into database...')
-                run_metadata_df.to_sql('run_metadata',
-                                    sqlite3_connection,
-                                    #index=False,
-                                    if_exists=if_exists)
-                del run_metadata_df
-
-                script_logger.info('Saving waveform metadata into database...')
-                waveform_metadata_df.to_sql('waveform_metadata',
-                                            sqlite3_connection,
-                                            #index=False,
-                                            if_exists=if_exists)
-                del waveform_metadata_df
-
-                script_logger.info('Saving waveform buffer metadata into database...')
-                waveform_buffer_metadata_df.to_sql('waveform_buffer_metadata',
-                                                sqlite3_connection,
-                                                #index=False,
-                                                if_exists=if_exists)
-                del waveform_buffer_metadata_df
-
-                if save_buffers:
-                    script_logger.info('Saving waveform buffer into database...')
-                    waveform_buffer_df.to_sql('waveform_buffer',
-                                            sqlite3_connection,
-                                            #index=False,
-                                            if_exists=if_exists)
-                del waveform_buffer_df
-
-                script_logger.info('Saving waveforms into database...')
-                waveforms_df.to_sql('waveforms',
-                                    sqlite3_connection,
-                                    #index=False,
-                                    if_exists=if_exists)
-                del waveforms_df
-                del if_exists
+                del num_saved_channels
+                del run_buffers
+                del manifest_buffer
                 del n_trigger
-            del sqlite3_connection
-            del plot_dir
-
-            # Zip and delete the backed up data
-            script_logger.info("Compressing the backup data")
-            shutil.make_archive(str(copied_data), 'zip', str(copied_data))
-            shutil.rmtree(copied_data)
-            del copied_data
+                finish_start_time = time.perf_counter()
+            # Leaving the block waits for the plots and the backup, and builds the indexes
+            metrics.add("finish", time.perf_counter() - finish_start_time)
+            metrics.add("plot", plot_pool.statistics["seconds"], plots=plot_pool.statistics["plots"])
+            metrics.add("backup", raw_data_backup.statistics["seconds"], files=raw_data_backup.statistics["files"], bytes=raw_data_backup.statistics["bytes"])
+            if hasattr(writer, "statistics"):
+                metrics.add("index", sum(table_statistics["index_seconds"] for table_statistics in writer.statistics.values()))
+            metrics.save(
+                            Oliver.task_path/'conversion_metrics.json',
+                            output_format = output_format,
+                            schema_version = schema_version,
+                            jobs = jobs,
+                            resumed = resumed,
+                            watch = watch,
+                        )
+            del metrics
+            del finish_start_time
+            del writer
+            del raw_data_backup
+            del resumed
+            del average_path
         del Oliver
         del waveform_plot_list
 
-        script_logger.info('Finished converting to sqlite format...')
+        script_logger.info('Finished converting to {} format...'.format(output_format))
 
         with John.handle_task("average_waveform") as Mike:
-            with sqlite3.connect(John.path_directory/'waveforms.sqlite') as sqlite3_connection:
-                script_logger.info('Calculating average waveform...')
-
-                # Make average plot (Processing with pandas; old approach)
-                #waveforms_df = pandas.read_sql('SELECT * from waveforms', sqlite3_connection)
-                #average_waveform_df = waveforms_df.groupby(["channel_idx", "waveform_idx", "x_idx"]).mean().drop(columns=["n_trigger"])
-
-                # Make average plot (Processing with sqlite; new approach)
-                average_waveform_df = pandas.read_sql(
-                    'SELECT waveform_idx, channel_idx, x_idx, AVG(x) AS x, AVG(y) AS y FROM waveforms GROUP BY x_idx, waveform_idx, channel_idx',
-                    sqlite3_connection).set_index(["channel_idx", "waveform_idx", "x_idx"])
-
-                # Make dataframe of start times
-                x_start_df = pandas.read_sql('SELECT * from waveforms WHERE x_idx=0', sqlite3_connection)
-                x_start_var = x_start_df["x"].var()
-
-                #print(x_start_df)
-                #print(waveforms_df)
-                #print(average_waveform_df)
-
-                plot_dir = Mike.task_path#/"summary"
-                plot_dir.resolve()
-                plot_dir.mkdir(exist_ok=True)
-
-                fig = px.histogram(
-                    x_start_df,
-                    x = 'x',
-                    labels = {
-                        "x": "Start Time (s)",
-                        "y": "Counts",
-                    },
-                    title = "Histogram of Waveform Start Times<br><sup>Standard Deviation: {}</sup>".format(sqrt(x_start_var))
-                )
-
-                fig.write_html(
-                    str(plot_dir/'waveform_start_times.html'),
-                    full_html = False, # For saving a html containing only a div with the plot
-                    include_plotlyjs = 'cdn',
-                )
-
-                fig = px.line(
-                    average_waveform_df.reset_index(["waveform_idx", "channel_idx"]),
-                    x = 'x',
-                    y = 'y',
-                    facet_row = 'waveform_idx',
-                    line_group = 'channel_idx',
-                    labels = {
-                        "x": "Time (s)",
-                        "y": "Amplitude (V)",
-                    },
-                    render_mode = 'webgl', # https://plotly.com/python/webgl-vs-svg/
-                    title = "Average Waveform"
-                )
-
-                fig.write_html(
-                    str(plot_dir/'average_waveform.html'),
-                    full_html = False, # For saving a html containing only a div with the plot
-                    include_plotlyjs = 'cdn',
-                )
-
-                script_logger.info('Saving average waveform into database...')
-                average_waveform_df.to_sql('average_waveform',
-                                        sqlite3_connection,
-                                        #index=False,
-                                        if_exists="replace")
+            script_logger.info('Calculating average waveform...')
+            # The samples were accumulated while converting, so there is no need to read them back
+            average_waveform_df = waveform_average.to_dataframe()
+            x_start_df = waveform_average.start_times_dataframe()
+            del waveform_average
+
+            if plots:
+                plot_average_waveform(average_waveform_df, x_start_df, Mike.task_path, plot_points)
+
+            script_logger.info('Saving average waveform into database...')
+            with output_writers[output_format](data_dir/'waveforms.{}'.format(output_format)) as writer:
+                writer.write('average_waveform', average_waveform_df)
+            del average_waveform_df
+            del x_start_df
 
             #script_logger.info("Compressing the sqlite data")
             #shutil.make_archive(str(output_directory/'waveforms.sqlite'), 'zip', str(output_directory), 'waveforms.sqlite')
@@ -704,6 +2038,121 @@ if __name__ == '__main__':
         action = 'store_true',
         dest = 'save_buffers',
     )
+    parser.add_argument(
+        '-j',
+        '--jobs',
+        metavar = 'N',
+        help = 'Number of processes used to parse the binary files. The trigger numbering is the same for any number of processes. Default: 1',
+        default = 1,
+        dest = 'jobs',
+        type = int,
+    )
+    parser.add_argument(
+        '-f',
+        '--output-format',
+        help = 'Format of the output data. The parquet format is columnar and compressed, with the waveforms split per channel, it requires pyarrow. Default: sqlite',
+        choices = list(output_writers),
+        default = "sqlite",
+        dest = 'output_format',
+    )
+    parser.add_argument(
+        '-s',
+        '--schema-version',
+        help = 'Schema of the waveform tables. Version 1 has one row per sample, version 2 has one row per waveform with the samples in a BLOB and no time column, which is much smaller and faster to write. Version 3 is version 2 with the scaling of the samples stored next to them, so ADC counts keep their native type. Default: 1',
+        choices = schema_versions,
+        default = 1,
+        dest = 'schema_version',
+        type = int,
+    )
+    parser.add_argument(
+        '--float32',
+        help = 'Store float samples of 8 bytes as float32, with schema versions 2 and 3. Samples of 4 bytes and integer samples are always stored in their native type',
+        action = 'store_true',
+        dest = 'float32',
+    )
+    parser.add_argument(
+        '--sample-codec',
+        help = 'Lossless compression of the samples, with schema versions 2 and 3. The samples are byte-shuffled, and integer samples delta encoded, before being compressed in a thread pool. zstd requires the zstandard package. Default: none',
+        choices = sample_codecs,
+        default = "none",
+        dest = 'sample_codec',
+    )
+    parser.add_argument(
+        '--sample-scaling',
+        metavar = ('CHANNEL', 'SCALE', 'OFFSET'),
+        help = 'Amplitude of the samples of a channel, e.g. ADC counts, as sample*SCALE + OFFSET. Can be repeated for several channels. With schema version 3 the scaling is stored and applied when reading, otherwise it is applied while converting',
+        action = 'append',
+        nargs = 3,
+        default = [],
+        dest = 'sample_scaling',
+    )
+    parser.add_argument(
+        '-r',
+        '--resume',
+        help = 'Continue the conversion of an existing run, e.g. after it was interrupted or when the scope saved more files. Only the files which are new or changed since they were converted are parsed, and appended to the existing tables',
+        action = 'store_true',
+        dest = 'resume',
+    )
+    parser.add_argument(
+        '-w',
+        '--watch',
+        help = 'Keep watching the input directory while the scope is acquiring, each new file is converted once the scope has finished writing it. Stop watching with Ctrl+C or with --watch-timeout',
+        action = 'store_true',
+        dest = 'watch',
+    )
+    parser.add_argument(
+        '--poll-interval',
+        metavar = 'seconds',
+        help = 'When watching, time between checks for new files. Default: 5',
+        default = 5,
+        dest = 'poll_interval',
+        type = float,
+    )
+    parser.add_argument(
+        '--watch-timeout',
+        metavar = 'seconds',
+        help = 'When watching, stop if no new file arrives within this time. Default: watch until stopped with Ctrl+C',
+        default = None,
+        dest = 'watch_timeout',
+        type = float,
+    )
+    parser.add_argument(
+        '--refresh-triggers',
+        metavar = 'N',
+        help = 'When watching, update the average waveform and start time plots in convert_scope_data/live every N triggers. Default: 100',
+        default = 100,
+        dest = 'refresh_triggers',
+        type = int,
+    )
+    parser.add_argument(
+        '--no-plots',
+        help = 'Do not make any plots, plotly is then not even imported. The average waveform is still saved',
+        action = 'store_false',
+        dest = 'plots',
+    )
+    parser.add_argument(
+        '--plot-jobs',
+        metavar = 'N',
+        help = 'Number of worker processes rendering the waveform plots in the background, 0 to render them in the conversion loop. Default: 1',
+        default = 1,
+        dest = 'plot_jobs',
+        type = int,
+    )
+    parser.add_argument(
+        '--plot-points',
+        metavar = 'N',
+        help = 'Maximum number of points of each curve in the plots, longer waveforms are reduced to the minimum and maximum of groups of samples. Default: 2000',
+        default = 2000,
+        dest = 'plot_points',
+        type = int,
+    )
+    parser.add_argument(
+        '--backup',
+        help = 'How to back up the original data into the run: compressed into a zip archive, or hardlinked into a directory (copied if hardlinks are not possible, e.g. across filesystems). Default: zip',
+        choices = ["zip", "link"],
+        default = "zip",
+        dest = 'backup',
+    )
     parser.add_argument(
         '-o',
         '--out-directory',
@@ -732,4 +2181,4 @@ if __name__ == '__main__':
         elif args.log_level == "NOTSET":
             logging.basicConfig(level=0)
 
-    script_main(Path(args.directory), Path(args.out_directory), plot_waveforms=args.plot_waveforms, save_buffers=args.save_buffers)
+    script_main(Path(args.directory), Path(args.out_directory), plot_waveforms=args.plot_waveforms, save_buffers=args.save_buffers, jobs=args.jobs, output_format=args.output_format, schema_version=args.schema_version, resume=args.resume, watch=args.watch, poll_interval=args.poll_interval, watch_timeout=args.watch_timeout, refresh_triggers=args.refresh_triggers, backup=args.backup, plot_jobs=args.plot_jobs, plot_points=args.plot_points, plots=args.plots, float32=args.float32, sample_scaling={channel: (float(scale), float(offset)) for channel, scale, offset in args.sample_scaling}, sample_codec=args.sample_codec)
@@ -0,0 +1,294 @@
+from pathlib import Path # Pathlib documentation, very useful if unfamiliar:
+                         #   https://docs.python.org/3/library/pathlib.html
+import logging
+
+import numpy
+import pandas
+
+import lip_pps_run_manager as RM
+
+from tqdm import tqdm
+
+from run_storage import output_writers, read_schema_version, read_waveform_array, find_converted_output, trigger_batches, map_trigger_batches_in_order
+
+
+# Columns and index of the table with the features of each pulse
+waveform_features_table = {
+    "columns": numpy.dtype([('n_trigger', 'i8'),
+                            ('channel_idx', 'i8'),
+                            ('waveform_idx', 'i8'),
+                            ('polarity', 'i1'),
+                            ('baseline', 'f4'),
+                            ('noise_rms', 'f4'),
+                            ('amplitude', 'f4'),
+                            ('peak_time', 'f8'),
+                            ('rise_time', 'f4'),
+                            ('collected_charge', 'f4'),
+                            ('time_over_threshold', 'f4')]),
+    "index": ["n_trigger", "channel_idx", "waveform_idx"],
+}
+
+def threshold_crossings(signal:numpy.ndarray, level:numpy.ndarray, peak_idx:numpy.ndarray, leading:bool=True):
+    # Fractional sample index where each row of signal crosses its level, on the leading edge (last crossing before the peak)
+    # or on the trailing edge (first crossing after the peak), linearly interpolated between the samples. NaN where there is no crossing
+    num_rows, num_points = signal.shape
+    sample_idx = numpy.arange(num_points)
+    below = ~(signal >= level[:, None]) # The NaN padding counts as below the level
+
+    rows = numpy.arange(num_rows)
+    if leading:
+        candidates = below & (sample_idx < peak_idx[:, None])
+        crossing_idx = num_points - 1 - candidates[:, ::-1].argmax(axis=1)
+        first_idx = crossing_idx
+    else:
+        candidates = below & (sample_idx > peak_idx[:, None])
+        crossing_idx = candidates.argmax(axis=1)
+        first_idx = crossing_idx - 1
+    found = candidates[rows, crossing_idx]
+    del candidates
+    first_idx = numpy.clip(first_idx, 0, num_points - 2)
+
+    first_value = signal[rows, first_idx]
+    second_value = signal[rows, first_idx + 1]
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        fraction = (level - first_value)/(second_value - first_value)
+    return numpy.where(found, first_idx + fraction, numpy.nan)
+
+def baseline_subtracted_pulses(samples:numpy.ndarray, number_points:numpy.ndarray, baseline_fraction:float=0.1, polarity:str="auto"):
+    # Subtracts the baseline, the mean of the first baseline_fraction of each waveform, from a 2D array with one waveform per row padded with NaN,
+    # and inverts the negative pulses, with the polarity found from the largest excursion from the baseline when set to auto.
+    # Returns the signal, the baseline, the noise RMS, the polarity, the index of the peak and the amplitude of every pulse
+    num_rows, num_points = samples.shape
+    sample_idx = numpy.arange(num_points)
+
+    baseline_points = numpy.maximum(1, (number_points*baseline_fraction).astype(int))
+    baseline_samples = numpy.where(sample_idx[:baseline_points.max()] < baseline_points[:, None], samples[:, :baseline_points.max()], numpy.nan)
+    with numpy.errstate(invalid='ignore'):
+        baseline = numpy.nanmean(baseline_samples, axis=1)
+        noise_rms = numpy.nanstd(baseline_samples, axis=1)
+    del baseline_samples
+
+    signal = samples - baseline[:, None]
+    if polarity == "positive":
+        sign = numpy.ones(num_rows, dtype=numpy.int8)
+    elif polarity == "negative":
+        sign = -numpy.ones(num_rows, dtype=numpy.int8)
+    else:
+        sign = numpy.where(numpy.nanmax(signal, axis=1) >= -numpy.nanmin(signal, axis=1), 1, -1).astype(numpy.int8)
+    signal *= sign[:, None]
+
+    peak_idx = numpy.where(numpy.isnan(signal), -numpy.inf, signal).argmax(axis=1)
+    amplitude = signal[numpy.arange(num_rows), peak_idx]
+    return signal, baseline, noise_rms, sign, peak_idx, amplitude
+
+def pulse_features(
+        samples:numpy.ndarray,
+        number_points:numpy.ndarray,
+        x_origin:numpy.ndarray,
+        x_increment:numpy.ndarray,
+        baseline_fraction:float=0.1,
+        polarity:str="auto",
+        threshold:float=None,
+        threshold_sigmas:float=5,
+        impedance:float=50,
+        ):
+    # Computes the features of every pulse, from a 2D array with one waveform per row padded with NaN, as returned by read_waveform_array.
+    # The time over threshold uses a fixed threshold, in the units of the samples, or threshold_sigmas times the noise of each waveform
+    signal, baseline, noise_rms, sign, peak_idx, amplitude = baseline_subtracted_pulses(samples, number_points, baseline_fraction, polarity)
+
+    rise_start = threshold_crossings(signal, 0.1*amplitude, peak_idx)
+    rise_end = threshold_crossings(signal, 0.9*amplitude, peak_idx)
+
+    if threshold is None:
+        threshold_level = threshold_sigmas*noise_rms
+    else:
+        threshold_level = numpy.full(len(signal), threshold, dtype=float)
+    over_threshold = amplitude >= threshold_level
+    time_over_threshold = (threshold_crossings(signal, threshold_level, peak_idx, leading=False) - threshold_crossings(signal, threshold_level, peak_idx))*x_increment
+
+    return {
+        "polarity": sign,
+        "baseline": baseline,
+        "noise_rms": noise_rms,
+        "amplitude": amplitude,
+        "peak_time": x_origin + peak_idx*x_increment,
+        "rise_time": (rise_end - rise_start)*x_increment,
+        "collected_charge": numpy.nansum(signal, axis=1)*x_increment/impedance,
+        "time_over_threshold": numpy.where(over_threshold, time_over_threshold, numpy.nan),
+    }
+
+def extract_batch_features(path:Path, output_format:str, trigger_range:tuple, schema_version:int, feature_options:dict):
+    # Reads the waveforms of a range of triggers and returns the dataframe with their features
+    metadata_df, samples = read_waveform_array(path, output_format, trigger_range, schema_version)
+    if len(metadata_df) == 0: # e.g. a range with only skipped files
+        return pandas.DataFrame(numpy.zeros(0, dtype=waveform_features_table["columns"])).set_index(waveform_features_table["index"])
+
+    features = pulse_features(
+                                samples,
+                                metadata_df["number_points"].to_numpy(),
+                                metadata_df["x_origin"].to_numpy(),
+                                metadata_df["x_increment"].to_numpy(),
+                                **feature_options,
+                            )
+    del samples
+
+    features_df = pandas.DataFrame({name: metadata_df[name].to_numpy() for name in waveform_features_table["index"]})
+    for name, values in features.items():
+        features_df[name] = values.astype(waveform_features_table["columns"][name])
+    features_df.set_index(waveform_features_table["index"], inplace=True)
+    return features_df
+
+def script_main(
+        run_directory:Path,
+        batch_size:int=1000,
+        jobs:int=1,
+        baseline_fraction:float=0.1,
+        polarity:str="auto",
+        threshold:float=None,
+        threshold_sigmas:float=5,
+        impedance:float=50,
+        ):
+    script_logger = logging.getLogger('extract_pulse_features')
+
+    with RM.RunManager(run_directory.resolve()) as John:
+        John.create_run(raise_error=False)
+
+        if not John.task_completed("convert_scope_data"):
+            script_logger.error("You must first convert the scope data with convert_scope_data.py")
+            return
+
+        output_path, output_format = find_converted_output(John.path_directory/"data")
+        if output_path is None:
+            script_logger.error("No converted waveforms found in {}".format(John.path_directory/"data"))
+            return
+
+        with John.handle_task("extract_pulse_features"):
+            schema_version = read_schema_version(output_path, output_format)
+            trigger_ranges = trigger_batches(output_path, output_format, batch_size)
+
+            feature_options = {
+                "baseline_fraction": baseline_fraction,
+                "polarity": polarity,
+                "threshold": threshold,
+                "threshold_sigmas": threshold_sigmas,
+                "impedance": impedance,
+            }
+
+            # The features are small compared to the waveforms, so they are kept in memory and only written once all the workers finished reading
+            features_dfs = []
+            with tqdm(total=len(trigger_ranges), desc="Extracting pulse features...") as progress_bar:
+                for features_df in map_trigger_batches_in_order(extract_batch_features, output_path, output_format, trigger_ranges, schema_version, feature_options, jobs):
+                    features_dfs += [features_df]
+                    progress_bar.update(1)
+            del trigger_ranges
+
+            script_logger.info('Saving waveform features into database...')
+            if len(features_dfs) > 0:
+                with output_writers[output_format](output_path) as writer:
+                    writer.write('waveform_features', pandas.concat(features_dfs))
+            del features_dfs
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Extracts the features of each pulse (baseline, noise, amplitude, peak time, rise time, collected charge and time over threshold) from the waveforms converted with convert_scope_data.py into the waveform_features table')
+    parser.add_argument('--dir',
+        metavar = 'path',
+        help = 'Path to the run directory.',
+        required = True,
+        dest = 'directory',
+        type = str,
+    )
+    parser.add_argument(
+        '--batch-size',
+        help = 'Number of triggers processed together. Default: 1000',
+        default = 1000,
+        dest = 'batch_size',
+        type = int,
+    )
+    parser.add_argument(
+        '-j',
+        '--jobs',
+        help = 'Number of processes used to read and process the batches of triggers. Default: 1',
+        default = 1,
+        dest = 'jobs',
+        type = int,
+    )
+    parser.add_argument(
+        '--baseline-fraction',
+        help = 'Fraction of each waveform, from its start, used for the baseline and the noise. Default: 0.1',
+        default = 0.1,
+        dest = 'baseline_fraction',
+        type = float,
+    )
+    parser.add_argument(
+        '--polarity',
+        help = 'Polarity of the pulses, with auto it is found for each waveform. Default: auto',
+        choices = ["auto", "positive", "negative"],
+        default = "auto",
+        dest = 'polarity',
+    )
+    parser.add_argument(
+        '--threshold',
+        help = 'Threshold for the time over threshold, in the units of the waveforms and relative to the baseline. Default: a multiple of the noise of each waveform',
+        default = None,
+        dest = 'threshold',
+        type = float,
+    )
+    parser.add_argument(
+        '--threshold-sigmas',
+        help = 'When no threshold is given, the threshold is this number of times the noise RMS of each waveform. Default: 5',
+        default = 5,
+        dest = 'threshold_sigmas',
+        type = float,
+    )
+    parser.add_argument(
+        '--impedance',
+        help = 'Input impedance, in Ohm, used to convert the integral of the pulse into the collected charge. Default: 50',
+        default = 50,
+        dest = 'impedance',
+        type = float,
+    )
+    parser.add_argument(
+        '-l',
+        '--log-level',
+        help = 'Set the logging level',
+        choices = ["CRITICAL","ERROR","WARNING","INFO","DEBUG","NOTSET"],
+        default = "ERROR",
+        dest = 'log_level',
+    )
+    parser.add_argument(
+        '--log-file',
+        help = 'If set, the full log will be saved to a file (i.e. the log level is ignored)',
+        action = 'store_true',
+        dest = 'log_file',
+    )
+
+    args = parser.parse_args()
+
+    if args.log_file:
+        logging.basicConfig(filename='logging.log', filemode='w', encoding='utf-8', level=logging.NOTSET)
+    else:
+        if args.log_level == "CRITICAL":
+            logging.basicConfig(level=50)
+        elif args.log_level == "ERROR":
+            logging.basicConfig(level=40)
+        elif args.log_level == "WARNING":
+            logging.basicConfig(level=30)
+        elif args.log_level == "INFO":
+            logging.basicConfig(level=20)
+        elif args.log_level == "DEBUG":
+            logging.basicConfig(level=10)
+        elif args.log_level == "NOTSET":
+            logging.basicConfig(level=0)
+
+    script_main(
+        Path(args.directory),
+        batch_size = args.batch_size,
+        jobs = args.jobs,
+        baseline_fraction = args.baseline_fraction,
+        polarity = args.polarity,
+        threshold = args.threshold,
+        threshold_sigmas = args.threshold_sigmas,
+        impedance = args.impedance,
+    )
@@ -0,0 +1,268 @@
+from pathlib import Path # Pathlib documentation, very useful if unfamiliar:
+                         #   https://docs.python.org/3/library/pathlib.html
+import logging
+
+import numpy
+
+from convert_scope_data import file_header_dtype, waveform_header_dtype, waveform_data_header_dtype, InfiniiumBufferDtype
+
+# Deliberate problems which can be introduced in the generated files, each one is rejected by the reader of convert_scope_data
+corruption_types = [
+    "truncated",            # The file ends in the middle of the last buffer
+    "too_small",            # Shorter than the file header
+    "bad_cookie",           # Not an Agilent Binary Data file
+    "bad_waveform_header",  # Waveform header with a size different from 140
+    "bad_buffer_header",    # Buffer header with a size different from 12
+    "points_mismatch",      # The waveform header does not match the number of points in the buffers
+    "zero_bytes_per_point", # Buffer header with 0 bytes per point
+]
+
+def synthetic_waveform(num_points:int, rng:numpy.random.Generator, amplitude:float=0.1, width:float=30, noise:float=0.002):
+    # A gaussian pulse at a random position around the middle of the acquisition window, on top of gaussian noise
+    center = num_points/2 + rng.normal(0, width/3)
+    sample_idx = numpy.arange(num_points)
+    return amplitude*numpy.exp(-((sample_idx - center)/width)**2) + rng.normal(0, noise, num_points)
+
+def scope_file_bytes(
+        rng:numpy.random.Generator,
+        trigger:int=0,
+        num_waveforms:int=2,
+        num_points:int=1000,
+        num_buffers:int=1,
+        buffer_type:int=1,
+        bytes_per_point:int=4,
+        corruption:str=None,
+        num_segments:int=1,
+        ):
+    # Contents of a wav*.bin file with one waveform per channel, built from the same header dtypes used to read the files.
+    # The points of each waveform are split as evenly as possible between its buffers. With more than one segment the file
+    # is a segmented acquisition, with all the segments of each channel one after the other as written by the scope
+    if corruption is not None and corruption not in corruption_types:
+        raise ValueError("Unknown corruption {}, it should be one of {}".format(corruption, corruption_types))
+
+    buffer_dtype = InfiniiumBufferDtype(buffer_type, bytes_per_point)
+
+    chunks = []
+    for waveform_idx, segment_idx in [(waveform_idx, segment_idx) for waveform_idx in range(num_waveforms) for segment_idx in range(num_segments)]:
+        waveform_header = numpy.zeros(1, dtype=waveform_header_dtype)
+        waveform_header['header_size'] = 140
+        waveform_header['waveform_type'] = 1
+        waveform_header['num_waveform_buffers'] = num_buffers
+        waveform_header['num_points'] = num_points
+        waveform_header['count'] = 1
+        waveform_header['x_display_range'] = num_points*1e-11
+        waveform_header['x_display_origin'] = -num_points*0.5e-11
+        waveform_header['x_increment'] = 1e-11
+        waveform_header['x_origin'] = -num_points*0.5e-11 + rng.normal(0, 1e-11) # Trigger jitter
+        waveform_header['x_units'] = 2
+        waveform_header['y_units'] = 1
+        waveform_header['date_string'] = b'17 OCT 2026'
+        waveform_header['time_string'] = '{:02d}:{:02d}:{:02d}'.format((10 + trigger//3600)%24, (trigger//60)%60, trigger%60).encode('utf-8')
+        waveform_header['frame_string'] = b'DSO9254A:MY00000000'
+        waveform_header['waveform_string'] = 'Channel {}'.format(waveform_idx + 1).encode('utf-8')
+        waveform_header['time_tag'] = trigger*1e-3 + segment_idx*1e-6
+        waveform_header['segment_index'] = segment_idx + 1 if num_segments > 1 else 0
+        if corruption == "bad_waveform_header":
+            waveform_header['header_size'] = 136
+        elif corruption == "points_mismatch":
+            waveform_header['num_points'] = num_points + 1
+        chunks += [waveform_header.tobytes()]
+
+        y_data = synthetic_waveform(num_points, rng, amplitude=0.1*(waveform_idx + 1))
+        if buffer_dtype.kind == 'f':
+            samples = y_data.astype(buffer_dtype)
+        elif buffer_dtype.kind == 'u': # Digitizer counts, with the baseline a quarter of the way up the range
+            max_count = 2**(8*bytes_per_point) - 1
+            samples = numpy.clip(numpy.round(max_count*(0.25 + y_data)), 0, max_count).astype(buffer_dtype)
+        else: # Raw data, with the bytes of the counts as the contents
+            samples = rng.integers(0, 256, num_points*bytes_per_point, dtype=numpy.uint8).view(buffer_dtype)
+
+        for buffer_samples in numpy.array_split(samples, num_buffers):
+            buffer_header = numpy.zeros(1, dtype=waveform_data_header_dtype)
+            buffer_header['header_size'] = 12
+            buffer_header['buffer_type'] = buffer_type
+            buffer_header['bytes_per_point'] = bytes_per_point
+            buffer_header['buffer_size'] = len(buffer_samples)*bytes_per_point
+            if corruption == "bad_buffer_header":
+                buffer_header['header_size'] = 16
+            elif corruption == "zero_bytes_per_point":
+                buffer_header['bytes_per_point'] = 0
+            chunks += [buffer_header.tobytes(), buffer_samples.tobytes()]
+
+    body = b''.join(chunks)
+
+    file_header = numpy.zeros(1, dtype=file_header_dtype)
+    file_header['cookie'] = b'AG'
+    file_header['version'] = b'10'
+    file_header['file_size'] = file_header_dtype.itemsize + len(body)
+    file_header['num_waveforms'] = num_waveforms*num_segments
+    if corruption == "bad_cookie":
+        file_header['cookie'] = b'XX'
+
+    contents = file_header.tobytes() + body
+    if corruption == "truncated":
+        contents = contents[:len(contents) - max(1, num_points*bytes_per_point//(2*num_buffers))]
+    elif corruption == "too_small":
+        contents = contents[:file_header_dtype.itemsize//2]
+    return contents
+
+def script_main(
+        output_directory:Path,
+        num_files:int,
+        num_waveforms:int=2,
+        num_points:int=1000,
+        num_buffers:int=1,
+        buffer_type:int=1,
+        bytes_per_point:int=4,
+        num_corrupt:int=0,
+        corruptions:list=corruption_types,
+        seed:int=0,
+        num_segments:int=1,
+        ):
+    # Writes the files wav1.bin to wav{num_files}.bin, with num_corrupt of them, chosen at random, having one of the corruptions.
+    # The same seed always produces the same files. Returns the paths of the files and the corruption of each file, None when valid
+    script_logger = logging.getLogger('generate_scope_data')
+
+    output_directory.mkdir(parents=True, exist_ok=True)
+    rng = numpy.random.default_rng(seed)
+
+    file_corruptions = [None]*num_files
+    for file_idx in rng.choice(num_files, size=min(num_corrupt, num_files), replace=False):
+        file_corruptions[file_idx] = corruptions[rng.integers(len(corruptions))]
+
+    paths = []
+    for file_idx, corruption in enumerate(file_corruptions):
+        path = output_directory/'wav{}.bin'.format(file_idx + 1)
+        path.write_bytes(scope_file_bytes(rng, file_idx*num_segments, num_waveforms, num_points, num_buffers, buffer_type, bytes_per_point, corruption, num_segments))
+        if corruption is not None:
+            script_logger.info("Wrote {} with the corruption {}".format(path.name, corruption))
+        paths += [path]
+
+    script_logger.info("Wrote {} files into {}".format(num_files, output_directory))
+    return paths, file_corruptions
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Generates synthetic oscilloscope data, in the Agilent binary format read by convert_scope_data.py, e.g. for testing and benchmarks')
+    parser.add_argument('--dir',
+        metavar = 'path',
+        help = 'Path to the directory where the wav*.bin files are written.',
+        required = True,
+        dest = 'directory',
+        type = str,
+    )
+    parser.add_argument(
+        '-n',
+        '--num-files',
+        help = 'Number of files, i.e. triggers, to generate. Default: 100',
+        default = 100,
+        dest = 'num_files',
+        type = int,
+    )
+    parser.add_argument(
+        '-w',
+        '--waveforms',
+        help = 'Number of waveforms, i.e. channels, in each file. Default: 2',
+        default = 2,
+        dest = 'num_waveforms',
+        type = int,
+    )
+    parser.add_argument(
+        '-p',
+        '--points',
+        help = 'Number of points in each waveform. Default: 1000',
+        default = 1000,
+        dest = 'num_points',
+        type = int,
+    )
+    parser.add_argument(
+        '-b',
+        '--buffers',
+        help = 'Number of buffers the points of each waveform are split into. Default: 1',
+        default = 1,
+        dest = 'num_buffers',
+        type = int,
+    )
+    parser.add_argument(
+        '--buffer-type',
+        help = 'Type of the buffers: 1 to 5 for floating point data, 6 for unsigned digitizer counts, other values for raw data. Default: 1',
+        default = 1,
+        dest = 'buffer_type',
+        type = int,
+    )
+    parser.add_argument(
+        '--bytes-per-point',
+        help = 'Size of each point, in bytes. Default: 4',
+        default = 4,
+        dest = 'bytes_per_point',
+        type = int,
+    )
+    parser.add_argument(
+        '--segments',
+        help = 'Number of segments, i.e. triggers, in each file. More than 1 writes segmented acquisitions. Default: 1',
+        default = 1,
+        dest = 'num_segments',
+        type = int,
+    )
+    parser.add_argument(
+        '-c',
+        '--corrupt',
+        help = 'Number of files, chosen at random, which are written with a corruption. Default: 0',
+        default = 0,
+        dest = 'num_corrupt',
+        type = int,
+    )
+    parser.add_argument(
+        '--corruptions',
+        help = 'The corruptions to choose from. Default: all of them',
+        choices = corruption_types,
+        default = corruption_types,
+        nargs = '+',
+        dest = 'corruptions',
+    )
+    parser.add_argument(
+        '-s',
+        '--seed',
+        help = 'Seed of the random numbers, the same seed always generates the same files. Default: 0',
+        default = 0,
+        dest = 'seed',
+        type = int,
+    )
+    parser.add_argument(
+        '-l',
+        '--log-level',
+        help = 'Set the logging level',
+        choices = ["CRITICAL","ERROR","WARNING","INFO","DEBUG","NOTSET"],
+        default = "ERROR",
+        dest = 'log_level',
+    )
+
+    args = parser.parse_args()
+
+    if args.log_level == "CRITICAL":
+        logging.basicConfig(level=50)
+    elif args.log_level == "ERROR":
+        logging.basicConfig(level=40)
+    elif args.log_level == "WARNING":
+        logging.basicConfig(level=30)
+    elif args.log_level == "INFO":
+        logging.basicConfig(level=20)
+    elif args.log_level == "DEBUG":
+        logging.basicConfig(level=10)
+    elif args.log_level == "NOTSET":
+        logging.basicConfig(level=0)
+
+    script_main(
+        Path(args.directory),
+        args.num_files,
+        args.num_waveforms,
+        args.num_points,
+        args.num_buffers,
+        args.buffer_type,
+        args.bytes_per_point,
+        args.num_corrupt,
+        args.corruptions,
+        args.seed,
+        args.num_segments,
+    )
@@ -2,17 +2,115 @@ from pathlib import Path # Pathlib documentation, very useful if unfamiliar:
                          #   https://docs.python.org/3/library/pathlib.html
 import logging
 
+import os
+import time
+import hashlib
 import sqlite3
+import numpy
 import pandas
 import shutil
 
-import plotly.express as px
+from concurrent.futures import ThreadPoolExecutor
 
 import lip_pps_run_manager as RM
 
-def script_main(run_directory: Path, device_name: str, reference_curves = [], measurement_name = "LIP"):
+iv_columns = ["Bias voltage (V)", "Bias current (A)"]
+
+def default_cache_directory():
+    return Path(os.environ.get("XDG_CACHE_HOME", Path.home()/".cache"))/"plot_IV_curve"
+
+def read_reference_curve(location:Path, data_type:str, invert:bool):
+    # Voltage and current of the reference curve, as a 2 column array, or None for an unknown data type
+    if data_type == "feather":
+        reference_curve_df = pandas.read_feather(location, columns=iv_columns)
+    elif data_type == "sqlite":
+        with sqlite3.connect(location) as sqlite3_connection:
+            reference_curve_df = pandas.read_sql('SELECT {} FROM measurements'.format(", ".join('"{}"'.format(column) for column in iv_columns)), sqlite3_connection, index_col=None)
+    else:
+        return None
+
+    values = reference_curve_df[iv_columns].to_numpy(dtype=float)
+    if invert:
+        values = -values
+    return values
+
+def cached_reference_curve(location:Path, data_type:str, invert:bool, cache_directory:Path):
+    # Same as read_reference_curve, but kept in cache_directory as .npy files named after the path of the curve, its modification
+    # time and size, and the invert flag. Entries for an older version of the same file are removed when it is read again
     script_logger = logging.getLogger('plot_IV_curve')
 
+    location_stat = location.stat()
+    location_hash = hashlib.sha1("{}:{}".format(data_type, location.resolve()).encode('utf-8')).hexdigest()[:16]
+    version = "{}_{}".format(location_stat.st_mtime_ns, location_stat.st_size)
+    cache_file = cache_directory/"{}_{}_{}.npy".format(location_hash, version, int(invert))
+
+    try:
+        values = numpy.load(cache_file)
+        os.utime(cache_file) # The modification time of the entries is their last use, for evict_reference_curve_cache
+        return values
+    except (OSError, ValueError): # Not cached yet, or a broken entry
+        pass
+
+    values = read_reference_curve(location, data_type, invert)
+    if values is None:
+        return None
+
+    try:
+        cache_directory.mkdir(parents=True, exist_ok=True)
+        for stale_file in cache_directory.glob("{}_*.npy".format(location_hash)):
+            if not stale_file.name.startswith("{}_{}_".format(location_hash, version)):
+                stale_file.unlink(missing_ok=True)
+        temporary_file = cache_directory/"{}.{}.tmp".format(cache_file.stem, os.getpid())
+        with open(temporary_file, 'wb') as out_file:
+            numpy.save(out_file, values)
+        os.replace(temporary_file, cache_file) # Atomic, so concurrent runs never read a partial entry
+    except OSError as e:
+        script_logger.warning("Could not cache the reference curve {} in {}: {}".format(location, cache_directory, e))
+    return values
+
+def evict_reference_curve_cache(cache_directory:Path, max_age_days:float=30):
+    # Removes the entries which were not used in the last max_age_days, e.g. of reference curves which no longer exist
+    if not cache_directory.is_dir():
+        return
+    oldest_time = time.time() - max_age_days*24*3600
+    for cache_file in cache_directory.glob("*.npy"):
+        try:
+            if cache_file.stat().st_mtime < oldest_time:
+                cache_file.unlink()
+        except OSError: # Removed by another run
+            pass
+
+def load_reference_curves(reference_curves:list, cache_directory:Path=None):
+    # Reduced data frame of each reference curve, in the same order, with None for the curves which do not exist or have an unknown
+    # type. The curves are loaded in a thread pool, from the cache unless cache_directory is None
+    def load_reference_curve(curve:dict):
+        if not curve["location"].is_file():
+            return None
+        if cache_directory is None:
+            values = read_reference_curve(curve["location"], curve["type"], curve["invert"])
+        else:
+            values = cached_reference_curve(curve["location"], curve["type"], curve["invert"], cache_directory)
+        if values is None:
+            return None
+        reduced_df = pandas.DataFrame(values, columns=iv_columns)
+        reduced_df["measurement"] = curve["name"]
+        return reduced_df
+
+    if len(reference_curves) == 0:
+        return []
+    if cache_directory is not None:
+        evict_reference_curve_cache(cache_directory)
+    with ThreadPoolExecutor(max_workers=min(len(reference_curves), 8)) as executor:
+        return list(executor.map(load_reference_curve, reference_curves))
+
+def script_main(run_directory: Path, device_name: str, reference_curves = [], measurement_name = "LIP", plots: bool = True, use_cache: bool = True, cache_directory: Path = None):
+    script_logger = logging.getLogger('plot_IV_curve')
+
+    if not use_cache:
+        cache_directory = None
+    elif cache_directory is None:
+        cache_directory = default_cache_directory()
+
     with RM.RunManager(run_directory.resolve()) as Michael:
         Michael.create_run(raise_error=False)
 
@@ -27,33 +125,15 @@ def script_main(run_directory: Path, device_name: str, reference_curves = [], me
                 measurements_df = pandas.read_sql('SELECT * FROM measurements', sqlite3_connection, index_col=None)
                 measurements_df["measurement"] = measurement_name
 
-                for curve in reference_curves:
-                    name = curve["name"]
-                    location = curve["location"]
-                    data_type = curve["type"]
-                    invert = curve["invert"]
-
-                    if not location.is_file():
-                        continue
-
-                    if data_type == "feather":
-                        reference_curve_df = pandas.read_feather(location)
-                    elif data_type == "sqlite":
-                        with sqlite3.connect(location) as new_sqlite3_connection:
-                            reference_curve_df = pandas.read_sql('SELECT * FROM measurements', new_sqlite3_connection, index_col=None)
-                    else:
-                        continue
+                reference_dfs = [reduced_df for reduced_df in load_reference_curves(reference_curves, cache_directory) if reduced_df is not None]
+                if len(reference_dfs) > 0:
+                    measurements_df = pandas.concat([measurements_df] + reference_dfs, axis=0, ignore_index=True)
 
-                    reduced_df = reference_curve_df[["Bias voltage (V)", "Bias current (A)"]].copy()
+                if not plots: # Only save the data of the curves, without importing plotly
+                    measurements_df.to_csv(Maria.task_path/"IV_curve.csv", index=False)
+                    return
 
-                    if invert:
-                        reduced_df["Bias voltage (V)"] = -reduced_df["Bias voltage (V)"]
-                        reduced_df["Bias current (A)"] = -reduced_df["Bias current (A)"]
-                        pass
-                    reduced_df["measurement"] = name
-
-                    #measurements_df = measurements_df.append(reduced_df, ignore_index=True)
-                    measurements_df = pandas.concat([measurements_df, reduced_df], axis=0, ignore_index=True)
+                import plotly.express as px # Slow to import, so only imported when plotting
 
                 color_column = None
                 if len(reference_curves) > 0:
@@ -100,6 +180,26 @@ if __name__ == '__main__':
         action = 'store_true',
         dest = 'log_file',
     )
+    parser.add_argument(
+        '--no-plots',
+        help = 'Do not make the plot, only save the data of the IV curves to IV_curve.csv. plotly is then not imported',
+        action = 'store_false',
+        dest = 'plots',
+    )
+    parser.add_argument(
+        '--no-cache',
+        help = 'Always read the reference curves from their files, instead of from the cache of reduced reference curves',
+        action = 'store_false',
+        dest = 'use_cache',
+    )
+    parser.add_argument(
+        '--cache-dir',
+        metavar = 'path',
+        help = 'Path to the directory of the cache of reduced reference curves. Default: $XDG_CACHE_HOME/plot_IV_curve or ~/.cache/plot_IV_curve',
+        default = None,
+        dest = 'cache_directory',
+        type = str,
+    )
 
     args = parser.parse_args()
 
@@ -148,4 +248,4 @@ if __name__ == '__main__':
 
     measurement_name = "LIP - High Resolution"
 
-    script_main(Path(args.directory), args.device, reference_curves, measurement_name)
\ No newline at end of file
+    script_main(Path(args.directory), args.device, reference_curves, measurement_name, plots=args.plots, use_cache=args.use_cache, cache_directory=Path(args.cache_directory) if args.cache_directory is not None else None)
\ No newline at end of file
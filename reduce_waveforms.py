@@ -0,0 +1,321 @@
+from pathlib import Path # Pathlib documentation, very useful if unfamiliar:
+                         #   https://docs.python.org/3/library/pathlib.html
+import logging
+
+import numpy
+import pandas
+
+import lip_pps_run_manager as RM
+
+from tqdm import tqdm
+
+from run_storage import output_writers, read_table, read_schema_version, read_waveform_array, find_converted_output, trigger_batches, map_trigger_batches_in_order, merged_moments
+
+class WaveformReduction:
+    """Statistics of every sample, i.e. of every (channel_idx, waveform_idx, x_idx), across the triggers of a run.
+
+    The count, mean time, mean, variance, minimum and maximum of each sample are kept, and optionally a histogram of
+    its values with the bin edges given for each channel. A reduction can be computed for any block of triggers and
+    the partial reductions merged, with the mean and variance merged with run_storage.merged_moments, so
+    the memory only depends on the number of samples per waveform and not on the number of triggers.
+    """
+    def __init__(self, histogram_edges:dict=None):
+        self.histogram_edges = histogram_edges # Bin edges of the histograms of each channel_idx, no histograms when None
+        self.statistics = {}
+
+    def _empty_statistics(self, channel_idx:int, size:int):
+        statistics = {
+            "count": numpy.zeros(size, dtype=numpy.int64),
+            "x_sum": numpy.zeros(size),
+            "mean": numpy.zeros(size),
+            "m2": numpy.zeros(size),
+            "minimum": numpy.full(size, numpy.inf),
+            "maximum": numpy.full(size, -numpy.inf),
+        }
+        if self.histogram_edges is not None:
+            statistics["histogram"] = numpy.zeros((size, len(self.histogram_edges[channel_idx]) - 1), dtype=numpy.int64)
+        return statistics
+
+    def _resized(self, key:tuple, size:int):
+        # Statistics of the key with at least size samples, waveforms of different lengths are allowed
+        statistics = self.statistics.get(key)
+        if statistics is None:
+            statistics = self._empty_statistics(key[0], size)
+        elif len(statistics["count"]) < size:
+            extended = self._empty_statistics(key[0], size)
+            for name, values in statistics.items():
+                extended[name][:len(values)] = values
+            statistics = extended
+        self.statistics[key] = statistics
+        return statistics
+
+    def update(self, metadata_df:pandas.DataFrame, samples:numpy.ndarray):
+        # Adds a block of waveforms, as returned by read_waveform_array
+        block = WaveformReduction(self.histogram_edges)
+        channel_idx = metadata_df["channel_idx"].to_numpy()
+        waveform_idx = metadata_df["waveform_idx"].to_numpy()
+        for channel, waveform in numpy.unique(numpy.stack([channel_idx, waveform_idx]), axis=1).T:
+            rows = numpy.flatnonzero((channel_idx == channel) & (waveform_idx == waveform))
+            key_samples = samples[rows]
+            valid = ~numpy.isnan(key_samples)
+            x_idx = numpy.arange(key_samples.shape[1])
+
+            statistics = block._resized((int(channel), int(waveform)), key_samples.shape[1])
+            statistics["count"] += valid.sum(axis=0)
+            with numpy.errstate(invalid='ignore', divide='ignore'):
+                statistics["mean"] = numpy.where(statistics["count"] > 0, numpy.where(valid, key_samples, 0).sum(axis=0)/statistics["count"], 0)
+            statistics["m2"] = numpy.where(valid, (key_samples - statistics["mean"])**2, 0).sum(axis=0)
+            statistics["minimum"] = numpy.where(valid, key_samples, numpy.inf).min(axis=0)
+            statistics["maximum"] = numpy.where(valid, key_samples, -numpy.inf).max(axis=0)
+            statistics["x_sum"] = numpy.where(valid, x_idx * metadata_df["x_increment"].to_numpy()[rows, None] + metadata_df["x_origin"].to_numpy()[rows, None], 0).sum(axis=0)
+
+            if self.histogram_edges is not None: # A single bincount for all the samples, with the bin offset by the sample index
+                edges = self.histogram_edges[int(channel)]
+                num_bins = len(edges) - 1
+                bin_idx = numpy.searchsorted(edges, key_samples, side='right') - 1
+                bin_idx[key_samples == edges[-1]] = num_bins - 1 # The last bin includes its upper edge
+                in_range = valid & (bin_idx >= 0) & (bin_idx < num_bins)
+                flat_idx = (x_idx*num_bins + bin_idx)[in_range]
+                statistics["histogram"] += numpy.bincount(flat_idx, minlength=len(x_idx)*num_bins).reshape(len(x_idx), num_bins)
+        self.merge(block)
+
+    def merge(self, other):
+        for key, other_statistics in other.statistics.items():
+            statistics = self._resized(key, len(other_statistics["count"]))
+            other_statistics = other._resized(key, len(statistics["count"]))
+
+            statistics["count"], statistics["mean"], statistics["m2"] = merged_moments(
+                                                                                    statistics["count"], statistics["mean"], statistics["m2"],
+                                                                                    other_statistics["count"], other_statistics["mean"], other_statistics["m2"],
+                                                                                )
+            statistics["x_sum"] = statistics["x_sum"] + other_statistics["x_sum"]
+            statistics["minimum"] = numpy.minimum(statistics["minimum"], other_statistics["minimum"])
+            statistics["maximum"] = numpy.maximum(statistics["maximum"], other_statistics["maximum"])
+            if "histogram" in statistics:
+                statistics["histogram"] = statistics["histogram"] + other_statistics["histogram"]
+
+    def channel_ranges(self):
+        # Minimum and maximum of all the samples of each channel_idx
+        ranges = {}
+        for (channel_idx, _), statistics in self.statistics.items():
+            low, high = ranges.get(channel_idx, (numpy.inf, -numpy.inf))
+            ranges[channel_idx] = (min(low, statistics["minimum"].min()), max(high, statistics["maximum"].max()))
+        return ranges
+
+    def to_dataframe(self):
+        dataframes = []
+        for (channel_idx, waveform_idx), statistics in sorted(self.statistics.items()):
+            count = statistics["count"]
+            with numpy.errstate(invalid='ignore', divide='ignore'):
+                dataframes += [pandas.DataFrame({
+                    "channel_idx": channel_idx,
+                    "waveform_idx": waveform_idx,
+                    "x_idx": numpy.arange(len(count)),
+                    "count": count,
+                    "x": numpy.where(count > 0, statistics["x_sum"]/count, numpy.nan),
+                    "mean": numpy.where(count > 0, statistics["mean"], numpy.nan),
+                    "variance": numpy.where(count > 1, statistics["m2"]/(count - 1), numpy.nan),
+                    "minimum": numpy.where(count > 0, statistics["minimum"], numpy.nan),
+                    "maximum": numpy.where(count > 0, statistics["maximum"], numpy.nan),
+                })]
+        if len(dataframes) == 0:
+            return pandas.DataFrame(columns=["channel_idx", "waveform_idx", "x_idx", "count", "x", "mean", "variance", "minimum", "maximum"]).set_index(["channel_idx", "waveform_idx", "x_idx"])
+        return pandas.concat(dataframes, ignore_index=True).set_index(["channel_idx", "waveform_idx", "x_idx"])
+
+    def histograms_dataframe(self):
+        dataframes = []
+        for (channel_idx, waveform_idx), statistics in sorted(self.statistics.items()):
+            histogram = statistics["histogram"]
+            edges = self.histogram_edges[channel_idx]
+            dataframes += [pandas.DataFrame({
+                "channel_idx": channel_idx,
+                "waveform_idx": waveform_idx,
+                "x_idx": numpy.repeat(numpy.arange(histogram.shape[0]), histogram.shape[1]),
+                "bin_idx": numpy.tile(numpy.arange(histogram.shape[1]), histogram.shape[0]),
+                "bin_low": numpy.tile(edges[:-1], histogram.shape[0]),
+                "bin_high": numpy.tile(edges[1:], histogram.shape[0]),
+                "count": histogram.ravel(),
+            })]
+        return pandas.concat(dataframes, ignore_index=True).set_index(["channel_idx", "waveform_idx", "x_idx", "bin_idx"])
+
+def reduce_block(path:Path, output_format:str, trigger_range:tuple, schema_version:int, reduction_options:dict):
+    # Reads the waveforms of a range of triggers and returns their reduction, to be merged with the others
+    reduction = WaveformReduction(reduction_options["histogram_edges"])
+    metadata_df, samples = read_waveform_array(path, output_format, trigger_range, schema_version)
+    if len(metadata_df) > 0:
+        reduction.update(metadata_df, samples)
+    return reduction
+
+def reduce_run(path:Path, output_format:str, trigger_ranges:list, schema_version:int, histogram_edges:dict=None, jobs:int=1, description:str="Reducing waveforms..."):
+    # Reduces all the ranges of triggers, in a process pool when there is more than one job, merging the partial reductions as they arrive
+    reduction = WaveformReduction(histogram_edges)
+    with tqdm(total=len(trigger_ranges), desc=description) as progress_bar:
+        for block_reduction in map_trigger_batches_in_order(reduce_block, path, output_format, trigger_ranges, schema_version, {"histogram_edges": histogram_edges}, jobs):
+            reduction.merge(block_reduction)
+            progress_bar.update(1)
+    return reduction
+
+def plot_envelopes(statistics_df:pandas.DataFrame, channel_names:dict, task_path:Path):
+    import plotly.graph_objects as go # Slow to import, so only imported when plotting
+
+    fig = go.Figure()
+    for (channel_idx, waveform_idx), key_df in statistics_df.reset_index().groupby(["channel_idx", "waveform_idx"]):
+        name = channel_names.get(channel_idx, "Channel {}".format(channel_idx))
+        sigma = numpy.sqrt(key_df["variance"])
+        for y, line_dash, label in [(key_df["maximum"], 'dot', "maximum"), (key_df["mean"] + sigma, 'dash', "mean + sigma"), (key_df["mean"], 'solid', "mean"), (key_df["mean"] - sigma, 'dash', "mean - sigma"), (key_df["minimum"], 'dot', "minimum")]:
+            fig.add_trace(go.Scattergl(
+                x = key_df["x"],
+                y = y,
+                mode = 'lines',
+                line_dash = line_dash,
+                legendgroup = name,
+                name = "{} {}".format(name, label),
+            ))
+    fig.update_layout(
+        title = "Envelopes of the waveforms",
+        xaxis_title = "Time (s)",
+        yaxis_title = "Amplitude (V)",
+    )
+    fig.write_html(
+        task_path/'waveform_envelopes.html',
+        include_plotlyjs = 'cdn',
+    )
+
+def script_main(
+        run_directory:Path,
+        batch_size:int=1000,
+        jobs:int=1,
+        histogram_bins:int=0,
+        histogram_range:tuple=None,
+        plots:bool=True,
+        ):
+    script_logger = logging.getLogger('reduce_waveforms')
+
+    with RM.RunManager(run_directory.resolve()) as John:
+        John.create_run(raise_error=False)
+
+        if not John.task_completed("convert_scope_data"):
+            script_logger.error("You must first convert the scope data with convert_scope_data.py")
+            return
+
+        output_path, output_format = find_converted_output(John.path_directory/"data")
+        if output_path is None:
+            script_logger.error("No converted waveforms found in {}".format(John.path_directory/"data"))
+            return
+
+        with John.handle_task("reduce_waveforms") as Helena:
+            schema_version = read_schema_version(output_path, output_format)
+            trigger_ranges = trigger_batches(output_path, output_format, batch_size)
+
+            channel_map_df = read_table(output_path, output_format, 'channel_map')
+
+            histogram_edges = None
+            if histogram_bins > 0 and histogram_range is not None: # The histograms are then made in the same pass
+                histogram_edges = {int(channel_idx): numpy.linspace(histogram_range[0], histogram_range[1], histogram_bins + 1) for channel_idx in channel_map_df["channel_idx"]}
+            reduction = reduce_run(output_path, output_format, trigger_ranges, schema_version, histogram_edges, jobs=jobs)
+            if histogram_bins > 0 and histogram_range is None: # The range of each channel is only known after a first pass over the run
+                histogram_edges = {channel_idx: numpy.linspace(low, high, histogram_bins + 1) for channel_idx, (low, high) in reduction.channel_ranges().items()}
+                reduction = reduce_run(output_path, output_format, trigger_ranges, schema_version, histogram_edges, jobs, description="Histogramming waveforms...")
+            del trigger_ranges
+            del histogram_edges
+
+            statistics_df = reduction.to_dataframe()
+            script_logger.info('Saving the waveform statistics into database...')
+            with output_writers[output_format](output_path) as writer:
+                writer.write('waveform_statistics', statistics_df)
+                if histogram_bins > 0:
+                    writer.write('waveform_sample_histograms', reduction.histograms_dataframe())
+            del reduction
+
+            if plots:
+                plot_envelopes(statistics_df, dict(zip(channel_map_df["channel_idx"].astype(int), channel_map_df["channel_name"])), Helena.task_path)
+            del channel_map_df
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Computes the mean, variance, minimum and maximum envelopes, and optionally histograms, of every sample across the triggers of a run converted with convert_scope_data.py, processing blocks of triggers in parallel with bounded memory')
+    parser.add_argument('--dir',
+        metavar = 'path',
+        help = 'Path to the run directory.',
+        required = True,
+        dest = 'directory',
+        type = str,
+    )
+    parser.add_argument(
+        '--batch-size',
+        help = 'Number of triggers in each block. Default: 1000',
+        default = 1000,
+        dest = 'batch_size',
+        type = int,
+    )
+    parser.add_argument(
+        '-j',
+        '--jobs',
+        help = 'Number of processes used to read and reduce the blocks of triggers. Default: 1',
+        default = 1,
+        dest = 'jobs',
+        type = int,
+    )
+    parser.add_argument(
+        '--histogram-bins',
+        help = 'Number of bins of the histogram of each sample, 0 to not make the histograms. Default: 0',
+        default = 0,
+        dest = 'histogram_bins',
+        type = int,
+    )
+    parser.add_argument(
+        '--histogram-range',
+        help = 'Range of the histograms, in the units of the waveforms. Default: the range of the samples of each channel, which needs an extra pass over the run',
+        default = None,
+        nargs = 2,
+        dest = 'histogram_range',
+        type = float,
+    )
+    parser.add_argument(
+        '--no-plots',
+        help = 'Do not make the plots, only save the tables. plotly is then not imported',
+        action = 'store_false',
+        dest = 'plots',
+    )
+    parser.add_argument(
+        '-l',
+        '--log-level',
+        help = 'Set the logging level',
+        choices = ["CRITICAL","ERROR","WARNING","INFO","DEBUG","NOTSET"],
+        default = "ERROR",
+        dest = 'log_level',
+    )
+    parser.add_argument(
+        '--log-file',
+        help = 'If set, the full log will be saved to a file (i.e. the log level is ignored)',
+        action = 'store_true',
+        dest = 'log_file',
+    )
+
+    args = parser.parse_args()
+
+    if args.log_file:
+        logging.basicConfig(filename='logging.log', filemode='w', encoding='utf-8', level=logging.NOTSET)
+    else:
+        if args.log_level == "CRITICAL":
+            logging.basicConfig(level=50)
+        elif args.log_level == "ERROR":
+            logging.basicConfig(level=40)
+        elif args.log_level == "WARNING":
+            logging.basicConfig(level=30)
+        elif args.log_level == "INFO":
+            logging.basicConfig(level=20)
+        elif args.log_level == "DEBUG":
+            logging.basicConfig(level=10)
+        elif args.log_level == "NOTSET":
+            logging.basicConfig(level=0)
+
+    script_main(
+        Path(args.directory),
+        batch_size = args.batch_size,
+        jobs = args.jobs,
+        histogram_bins = args.histogram_bins,
+        histogram_range = args.histogram_range,
+        plots = args.plots,
+    )
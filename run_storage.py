@@ -0,0 +1,756 @@
+from pathlib import Path # Pathlib documentation, very useful if unfamiliar:
+                         #   https://docs.python.org/3/library/pathlib.html
+import shutil
+import logging
+import time
+import os
+import zlib
+
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import sqlite3
+import numpy
+import pandas
+
+# Output backends for the tables produced by the conversion scripts.
+# Every writer takes the tables as dataframes, with the index set to the key columns of the table.
+# The first write to a table replaces any previous table with the same name, subsequent writes append to it.
+# When created with append=True the writers instead add the rows to the existing tables, e.g. when resuming a conversion.
+
+# Versions of the schema of the sample tables (waveforms and waveform_buffer), stored in the schema_info table:
+#   1 - One row per sample, with the time (x) and amplitude (y) of each sample
+#   2 - One row per waveform, with the samples in a BLOB of the numpy type given in sample_dtype. The time axis
+#       is not stored, it is rebuilt from x_origin and x_increment in waveform_metadata
+#   3 - As version 2, with the y_scale and y_offset of each waveform before its samples. The amplitude is
+#       samples*y_scale + y_offset, which the readers compute, so e.g. ADC counts are stored in their native type
+schema_versions = [1, 2, 3]
+
+# Lossless codecs for the samples BLOBs of the version 2 and 3 schemas, the codec of a run is stored in the schema_info table.
+# Before compressing, integer samples are delta encoded and the bytes of the samples are shuffled, so the bytes of the same
+# significance are next to each other, which makes the waveforms much more compressible. zstd requires the zstandard package
+sample_codecs = ["none", "zlib", "zstd"]
+
+class SQLiteWriter:
+    """Bulk loads the tables into a single SQLite database file
+
+    The rows are inserted with executemany in batches, each write in a single explicit transaction. The indexes on
+    the key columns are only created when the writer is closed, so they are built once instead of being updated for
+    every inserted row. When the writer creates a new file for a bulk load, the journal is kept in memory and nothing
+    is synced to disk, so the file is only consistent once the writer has been closed. When appending or writing into
+    an existing file, e.g. a finished run, the default rollback journal is kept, so a crash can not corrupt the data
+    already in it. Without bulk_load, e.g. for a conversion which can be resumed after being interrupted, the file is
+    written with a write-ahead log, so every committed write survives a crash.
+    """
+    def __init__(self, path:Path, batch_size:int=100000, append:bool=False, bulk_load:bool=True):
+        self.path = Path(path)
+        self.batch_size = batch_size
+        self.append = append
+        self.write_ahead_log = not bulk_load
+        self.bulk_load = bulk_load and not append and not self.path.exists()
+        self._connection = sqlite3.connect(self.path, isolation_level=None) # The transactions are handled explicitly
+        if self.bulk_load:
+            self._connection.execute('PRAGMA journal_mode = MEMORY')
+            self._connection.execute('PRAGMA synchronous = OFF')
+        else:
+            if self.write_ahead_log:
+                self._connection.execute('PRAGMA journal_mode = WAL')
+            self._connection.execute('PRAGMA synchronous = NORMAL')
+        self._connection.execute('PRAGMA temp_store = MEMORY')
+        self._connection.execute('PRAGMA cache_size = -262144') # 256 MiB
+        self._written_tables = set()
+        self._pending_indexes = {}
+        self.statistics = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, err_type, err_value, err_traceback):
+        self.close()
+
+    def close(self):
+        if self._connection is None:
+            return
+
+        script_logger = logging.getLogger('run_storage')
+        for table_name, index_columns in self._pending_indexes.items():
+            start_time = time.perf_counter()
+            self._connection.execute('CREATE INDEX IF NOT EXISTS "ix_{}_{}" ON "{}" ({})'.format(
+                                                                                    table_name,
+                                                                                    "_".join(index_columns),
+                                                                                    table_name,
+                                                                                    ",".join('"{}"'.format(column) for column in index_columns),
+                                                                                    ))
+            self.statistics[table_name]["index_seconds"] = time.perf_counter() - start_time
+        self._pending_indexes = {}
+
+        if self.write_ahead_log: # Back to a single file, the log is checkpointed into it
+            try:
+                self._connection.execute('PRAGMA journal_mode = DELETE')
+            except sqlite3.OperationalError: # Another connection is reading the file, which then stays in WAL mode
+                script_logger.info("{} is in use, it is left in WAL mode".format(self.path))
+        self._connection.close()
+        self._connection = None
+
+        for table_name, table_statistics in self.statistics.items():
+            script_logger.info('Wrote {} rows into {} in {:.2f} s ({:.0f} rows/s), index built in {:.2f} s'.format(
+                table_statistics["rows"],
+                table_name,
+                table_statistics["seconds"],
+                table_statistics["rows"]/max(table_statistics["seconds"], 1e-9),
+                table_statistics["index_seconds"],
+            ))
+
+    def _create_table(self, table_name:str, dataframe:pandas.DataFrame, index_columns:list):
+        if not self.append:
+            self._connection.execute('DROP TABLE IF EXISTS "{}"'.format(table_name))
+        self._connection.execute('CREATE TABLE IF NOT EXISTS "{}" ({})'.format(
+                                                                table_name,
+                                                                ", ".join('"{}" {}'.format(column, sqlite_type(dataframe[column])) for column in dataframe.columns),
+                                                                ))
+        if len(index_columns) > 0:
+            self._pending_indexes[table_name] = index_columns
+        self.statistics[table_name] = {"rows": 0, "seconds": 0., "index_seconds": 0.}
+
+    def write(self, table_name:str, dataframe:pandas.DataFrame, index:bool=True):
+        # Like DataFrame.to_sql, the index is stored in the table, as a column named "index" if it has no name
+        index_columns = []
+        if index:
+            index_columns = [name if name is not None else "index" for name in dataframe.index.names]
+            dataframe = dataframe.rename_axis(index_columns).reset_index()
+        else:
+            dataframe = dataframe.reset_index(drop=True)
+
+        start_time = time.perf_counter()
+        if table_name not in self._written_tables:
+            self._create_table(table_name, dataframe, index_columns)
+            self._written_tables.add(table_name)
+
+        # The columns are named, so appending works with tables written with another column order
+        insert_statement = 'INSERT INTO "{}" ({}) VALUES ({})'.format(table_name, ", ".join('"{}"'.format(column) for column in dataframe.columns), ", ".join(["?"]*len(dataframe.columns)))
+        self._connection.execute('BEGIN')
+        try:
+            for batch_start in range(0, len(dataframe), self.batch_size):
+                batch_df = dataframe.iloc[batch_start:batch_start + self.batch_size]
+                self._connection.executemany(insert_statement, zip(*[sqlite_values(batch_df[column]) for column in batch_df.columns]))
+        except:
+            self._connection.execute('ROLLBACK')
+            raise
+        self._connection.execute('COMMIT')
+
+        self.statistics[table_name]["rows"] += len(dataframe)
+        self.statistics[table_name]["seconds"] += time.perf_counter() - start_time
+
+def sqlite_type(series:pandas.Series):
+    # Same column types as declared by DataFrame.to_sql, except for binary data which is declared as BLOB instead of TEXT
+    if series.dtype.kind in "iub":
+        return "INTEGER"
+    if series.dtype.kind == "f":
+        return "REAL"
+    if series.dtype.kind == "M":
+        return "TIMESTAMP"
+
+    value_type = pandas.api.types.infer_dtype(series, skipna=True)
+    if value_type in ["integer", "boolean"]:
+        return "INTEGER"
+    if value_type in ["floating", "mixed-integer-float", "decimal"]:
+        return "REAL"
+    if value_type in ["datetime64", "datetime"]:
+        return "TIMESTAMP"
+    if value_type == "bytes":
+        return "BLOB"
+    return "TEXT"
+
+def sqlite_values(series:pandas.Series):
+    # Converts a column into a list of python values that sqlite3 can bind, with the missing values as NULL
+    if series.dtype.kind in "iub" and not series.hasnans: # Nullable integer and boolean columns with missing values take the slow path
+        return series.to_numpy().tolist()
+    values = series.to_numpy(dtype=object, copy=True)
+    values[pandas.isna(values)] = None
+    if series.dtype.kind == "M" or pandas.api.types.infer_dtype(values, skipna=True) == "datetime":
+        return [value.isoformat(" ") if value is not None else None for value in values]
+    return values.tolist()
+
+class ParquetWriter:
+    """Writes each table into a Parquet dataset, in a directory with the name of the table
+
+    The columns are compressed independently and every row group stores the min/max statistics of its columns,
+    so readers can skip the row groups outside a given trigger range. Tables listed in partitions are further
+    split into one file per value of the partition column (hive style, e.g. waveforms/channel_idx=0/), so that
+    a single channel can be read without touching the others.
+    """
+    def __init__(self, path:Path, partitions:dict={}, compression='zstd', row_group_size:int=2**20, append:bool=False):
+        # Only needed for this backend, so only imported when it is used
+        import pyarrow
+        import pyarrow.parquet
+
+        self._pyarrow = pyarrow
+        self._parquet = pyarrow.parquet
+
+        self.path = Path(path)
+        self.partitions = dict(partitions)
+        self.compression = compression # Either a single codec or a dictionary with the codec of each column
+        self.row_group_size = row_group_size
+        self.append = append
+        self._writers = {}
+        self._written_tables = set()
+
+        self.path.mkdir(exist_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, err_type, err_value, err_traceback):
+        self.close()
+
+    def close(self):
+        for writer in self._writers.values():
+            writer.close()
+        self._writers = {}
+
+    def _write_file(self, directory:Path, dataframe:pandas.DataFrame):
+        # Each directory gets a single new file per writer, which is only readable once the writer is closed
+        table = self._pyarrow.Table.from_pandas(dataframe, preserve_index=False)
+
+        if directory not in self._writers:
+            directory.mkdir(parents=True, exist_ok=True)
+            self._writers[directory] = self._parquet.ParquetWriter(
+                                                                    directory/'part-{}.parquet'.format(len(list(directory.glob('part-*.parquet')))),
+                                                                    table.schema,
+                                                                    compression = self.compression,
+                                                                    write_statistics = True,
+                                                                )
+        else:
+            table = table.cast(self._writers[directory].schema)
+
+        self._writers[directory].write_table(table, row_group_size=self.row_group_size)
+
+    def write(self, table_name:str, dataframe:pandas.DataFrame, index:bool=True):
+        if len(dataframe) == 0: # Nothing to add, and an empty dataframe does not carry enough type information for the parquet schema
+            return
+
+        if index and any(name is not None for name in dataframe.index.names):
+            dataframe = dataframe.reset_index()
+        elif not index:
+            dataframe = dataframe.reset_index(drop=True)
+
+        table_path = self.path/table_name
+        if table_name not in self._written_tables and table_path.exists() and not self.append:
+            shutil.rmtree(table_path)
+        self._written_tables.add(table_name)
+
+        if table_name not in self.partitions:
+            self._write_file(table_path, dataframe)
+            return
+
+        partition_column = self.partitions[table_name]
+        for partition_value, partition_df in dataframe.groupby(partition_column, sort=True):
+            self._write_file(
+                table_path/'{}={}'.format(partition_column, partition_value),
+                partition_df.drop(columns=[partition_column]),
+            )
+
+output_writers = {
+    "sqlite": SQLiteWriter,
+    "parquet": ParquetWriter,
+}
+
+def read_parquet_table(
+        path:Path,
+        table_name:str,
+        columns:list=None,
+        channel_idx:int=None,
+        trigger_range:tuple=None,
+        ):
+    # Reads a table written by ParquetWriter, optionally only for a single channel and/or a (first, last) range of triggers.
+    # The filters are pushed down to the parquet reader, so only the matching partitions and row groups are read from disk
+    filters = []
+    if channel_idx is not None:
+        filters += [("channel_idx", "=", channel_idx)]
+    if trigger_range is not None:
+        filters += [("n_trigger", ">=", trigger_range[0]), ("n_trigger", "<=", trigger_range[1])]
+    if len(filters) == 0:
+        filters = None
+
+    dataframe = pandas.read_parquet(Path(path)/table_name, columns=columns, filters=filters)
+
+    # The partition columns are read back as categoricals, convert them back to their plain type
+    for column in dataframe.columns:
+        if isinstance(dataframe[column].dtype, pandas.CategoricalDtype):
+            dataframe[column] = dataframe[column].astype(dataframe[column].cat.categories.dtype)
+
+    return dataframe
+
+def read_table(path:Path, output_format:str, table_name:str, columns:list=None, trigger_range:tuple=None, channel_idx:int=None):
+    # Reads a table from the output of convert_scope_data, for either of the output formats, optionally only the rows of a (first, last) range of triggers
+    # and/or of a single channel
+    if output_format == "parquet":
+        return read_parquet_table(path, table_name, columns=columns, channel_idx=channel_idx, trigger_range=trigger_range)
+
+    column_list = "*"
+    if columns is not None:
+        column_list = ", ".join(columns)
+    conditions = []
+    parameters = ()
+    if trigger_range is not None: # Uses the index on the key columns, which start with n_trigger
+        conditions += ['n_trigger BETWEEN ? AND ?']
+        parameters += (int(trigger_range[0]), int(trigger_range[1]))
+    if channel_idx is not None:
+        conditions += ['channel_idx = ?']
+        parameters += (int(channel_idx),)
+    query = 'SELECT {} FROM {}'.format(column_list, table_name)
+    if len(conditions) > 0:
+        query += ' WHERE ' + ' AND '.join(conditions)
+    with sqlite3.connect(path) as sqlite3_connection:
+        return pandas.read_sql(query, sqlite3_connection, params=parameters)
+
+def find_converted_output(data_dir:Path):
+    # Returns the path and the format of the waveforms converted by convert_scope_data into the data directory of a run, or (None, None)
+    for output_format in output_writers:
+        path = Path(data_dir)/'waveforms.{}'.format(output_format)
+        if path.exists():
+            return path, output_format
+    return None, None
+
+def table_exists(path:Path, output_format:str, table_name:str):
+    if output_format == "parquet":
+        return (Path(path)/table_name).is_dir()
+
+    if not Path(path).is_file():
+        return False
+    with sqlite3.connect(path) as sqlite3_connection:
+        return sqlite3_connection.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (table_name,)).fetchone() is not None
+
+def discard_triggers(path:Path, output_format:str, first_trigger:int, stale_triggers:list=[]):
+    # Removes the rows of the triggers from first_trigger onwards and of the stale triggers from all the tables with a n_trigger column,
+    # e.g. the rows written by an interrupted conversion which are not in the manifest, or those of files which were converted again
+    script_logger = logging.getLogger('run_storage')
+    stale_triggers = [int(n_trigger) for n_trigger in stale_triggers]
+
+    if output_format == "sqlite":
+        with sqlite3.connect(path) as sqlite3_connection:
+            sqlite3_connection.execute('CREATE TEMPORARY TABLE stale_triggers (n_trigger INTEGER PRIMARY KEY)')
+            sqlite3_connection.executemany('INSERT INTO stale_triggers VALUES (?)', [(n_trigger,) for n_trigger in stale_triggers])
+            for (table_name,) in sqlite3_connection.execute("SELECT name FROM sqlite_master WHERE type='table'").fetchall():
+                columns = [column[1] for column in sqlite3_connection.execute('PRAGMA table_info("{}")'.format(table_name))]
+                if "n_trigger" not in columns:
+                    continue
+                deleted = sqlite3_connection.execute(
+                    'DELETE FROM "{}" WHERE n_trigger >= ? OR n_trigger IN (SELECT n_trigger FROM stale_triggers)'.format(table_name),
+                    (first_trigger,)
+                ).rowcount
+                if deleted > 0:
+                    script_logger.info('Discarded {} rows from {}'.format(deleted, table_name))
+        return
+
+    import pyarrow.compute
+    import pyarrow.parquet
+
+    for file_path in sorted(Path(path).glob('**/part-*.parquet')):
+        try:
+            table = pyarrow.parquet.read_table(file_path)
+        except pyarrow.ArrowInvalid: # Not closed by the writer, so all its rows were written after the last manifest entry
+            script_logger.info('Discarded the unfinished file {}'.format(file_path))
+            file_path.unlink()
+            continue
+        if "n_trigger" not in table.column_names:
+            continue
+
+        keep = pyarrow.compute.and_(
+                                    pyarrow.compute.less(table["n_trigger"], first_trigger),
+                                    pyarrow.compute.invert(pyarrow.compute.is_in(table["n_trigger"], value_set=pyarrow.array(stale_triggers, type=table.schema.field("n_trigger").type))),
+                                    )
+        if pyarrow.compute.all(keep).as_py() is False:
+            script_logger.info('Discarded {} rows from {}'.format(len(table) - pyarrow.compute.sum(keep).as_py(), file_path))
+            pyarrow.parquet.write_table(table.filter(keep), file_path, compression='zstd', write_statistics=True)
+
+def read_schema_version(path:Path, output_format:str):
+    # Runs converted before the schema version was recorded use version 1
+    try:
+        return int(read_table(path, output_format, "schema_info")["schema_version"].iloc[0])
+    except (pandas.errors.DatabaseError, FileNotFoundError):
+        return 1
+
+def read_sample_codec(path:Path, output_format:str):
+    # Runs converted before the codec was recorded are not compressed
+    try:
+        schema_info_df = read_table(path, output_format, "schema_info")
+    except (pandas.errors.DatabaseError, FileNotFoundError):
+        return "none"
+    if "sample_codec" not in schema_info_df.columns:
+        return "none"
+    return str(schema_info_df["sample_codec"].iloc[0])
+
+def codec_functions(codec:str):
+    # Compression and decompression functions of a codec, the modules are only imported when they are used
+    if codec == "zlib":
+        return lambda data: zlib.compress(data, 1), zlib.decompress
+    elif codec == "zstd":
+        import zstandard # Optional dependency
+        return lambda data: zstandard.compress(data, 3), zstandard.decompress
+    raise ValueError("Unknown sample codec {}, it should be one of {}".format(codec, sample_codecs))
+
+def shuffle_samples(samples:numpy.ndarray):
+    # Filters applied before compressing a 2D array of waveforms with the same type, one per row. Integer samples are delta encoded,
+    # the differences wrap around so the decoding is exact, and the bytes of the samples of each waveform are grouped by significance
+    if samples.dtype.kind in 'iu':
+        samples = numpy.diff(samples, axis=1, prepend=numpy.zeros((len(samples), 1), dtype=samples.dtype)).astype(samples.dtype, copy=False)
+    samples = numpy.ascontiguousarray(samples)
+    return samples.view('u1').reshape(samples.shape[0], samples.shape[1], samples.dtype.itemsize).transpose(0, 2, 1).reshape(len(samples), -1)
+
+def unshuffle_samples(shuffled:numpy.ndarray, sample_dtype:numpy.dtype):
+    # Inverse of shuffle_samples, from the 2D array of bytes of the waveforms
+    samples = numpy.ascontiguousarray(shuffled.reshape(len(shuffled), sample_dtype.itemsize, -1).transpose(0, 2, 1)).view(sample_dtype).reshape(len(shuffled), -1)
+    if sample_dtype.kind in 'iu':
+        samples = numpy.cumsum(samples, axis=1, dtype=sample_dtype).astype(sample_dtype, copy=False)
+    return samples
+
+def encode_samples(samples:numpy.ndarray, codec:str="none"):
+    # Bytes of the samples to store in a BLOB, compressed with the codec
+    if codec == "none":
+        return numpy.ascontiguousarray(samples).tobytes()
+    compress, _ = codec_functions(codec)
+    return compress(shuffle_samples(samples.reshape(1, -1)).tobytes())
+
+def decode_samples(samples:bytes, sample_dtype:str, codec:str="none"):
+    # Samples stored in a BLOB of the version 2 and 3 schemas, a zero-copy view when they are not compressed
+    sample_dtype = numpy.dtype(sample_dtype)
+    if codec == "none":
+        return numpy.frombuffer(samples, dtype=sample_dtype)
+    _, decompress = codec_functions(codec)
+    return unshuffle_samples(numpy.frombuffer(decompress(samples), dtype='u1').reshape(1, -1), sample_dtype)[0]
+
+def map_in_threads(function, items:list, jobs:int=None):
+    # function applied to every item, in a thread pool for long lists, with each thread working on a contiguous slice.
+    # The codecs release the GIL while compressing, so the threads run in parallel
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    if jobs <= 1 or len(items) < 4*jobs:
+        return [function(item) for item in items]
+    slice_size = -(-len(items)//(4*jobs))
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        slices = executor.map(lambda start: [function(item) for item in items[start:start + slice_size]], range(0, len(items), slice_size))
+        return [result for slice_results in slices for result in slice_results]
+
+def merged_moments(count, mean, m2, other_count, other_mean, other_m2):
+    # Count, mean and sum of squared deviations of the union of two sets of values from those of each set, with the pairwise
+    # algorithm of Chan et al. Works element-wise on arrays, a set with no values leaves the other one unchanged
+    new_count = count + other_count
+    other_fraction = other_count/numpy.maximum(new_count, 1)
+    delta = other_mean - mean
+    return new_count, mean + delta*other_fraction, m2 + (other_m2 + delta**2 * count * other_fraction)
+
+def init_worker_logging(level:int):
+    logging.basicConfig(level=level)
+
+def trigger_batches(path:Path, output_format:str, batch_size:int):
+    # Consecutive (first, last) ranges of batch_size triggers covering all the triggers of the run
+    triggers = read_table(path, output_format, 'run_metadata', columns=["n_trigger"])["n_trigger"]
+    if len(triggers) == 0:
+        return []
+    return [(first_trigger, first_trigger + batch_size - 1) for first_trigger in range(0, int(triggers.max()) + 1, batch_size)]
+
+def map_trigger_batches_in_order(batch_function, path:Path, output_format:str, trigger_ranges:list, schema_version:int, options:dict, jobs:int=1):
+    # Yields batch_function(path, output_format, trigger_range, schema_version, options) for each range of triggers, in order. With more than one
+    # job the ranges are processed in a process pool, with at most two ranges per job waiting so memory stays bounded
+    if jobs <= 1:
+        for trigger_range in trigger_ranges:
+            yield batch_function(path, output_format, trigger_range, schema_version, options)
+        return
+
+    with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker_logging, initargs=(logging.getLogger().getEffectiveLevel(),)) as executor:
+        pending = deque()
+        for trigger_range in trigger_ranges:
+            pending.append(executor.submit(batch_function, path, output_format, trigger_range, schema_version, options))
+            if len(pending) >= 2*jobs:
+                yield pending.popleft().result()
+        while len(pending) > 0:
+            yield pending.popleft().result()
+
+def encode_sample_blobs(samples:list, sample_dtypes:list, codec:str="none", jobs:int=None):
+    # Compresses the uncompressed BLOBs of a samples column. The filters are applied to all the waveforms at once when they have
+    # the same type and length, which is the usual case, and the compression runs in a thread pool
+    if codec == "none":
+        return list(samples)
+    compress, _ = codec_functions(codec)
+    if len(set(sample_dtypes)) == 1 and len(set(len(blob) for blob in samples)) == 1:
+        shuffled = shuffle_samples(numpy.frombuffer(b"".join(samples), dtype=numpy.dtype(sample_dtypes[0])).reshape(len(samples), -1))
+        return map_in_threads(lambda waveform_bytes: compress(waveform_bytes.tobytes()), list(shuffled), jobs)
+    return map_in_threads(lambda blob_dtype: encode_samples(decode_samples(*blob_dtype), codec), list(zip(samples, sample_dtypes)), jobs)
+
+def decode_sample_blobs(samples:list, sample_dtypes:list, codec:str="none", jobs:int=None):
+    # Decodes the BLOBs of a samples column into a list of arrays, decompressing in a thread pool
+    if codec == "none":
+        return [decode_samples(blob, sample_dtype) for blob, sample_dtype in zip(samples, sample_dtypes)]
+    _, decompress = codec_functions(codec)
+    decompressed = map_in_threads(decompress, list(samples), jobs)
+    if len(set(sample_dtypes)) == 1 and len(set(len(waveform_bytes) for waveform_bytes in decompressed)) == 1:
+        return list(unshuffle_samples(numpy.frombuffer(b"".join(decompressed), dtype='u1').reshape(len(decompressed), -1), numpy.dtype(sample_dtypes[0])))
+    return [unshuffle_samples(numpy.frombuffer(waveform_bytes, dtype='u1').reshape(1, -1), numpy.dtype(sample_dtype))[0] for waveform_bytes, sample_dtype in zip(decompressed, sample_dtypes)]
+
+def scale_samples(samples:numpy.ndarray, y_scale, y_offset):
+    # Amplitude of samples stored with the scaling of the version 3 schema, as float. Samples without scaling are only converted,
+    # so the values are bit-identical to those of the other schema versions
+    if numpy.all(y_scale == 1) and numpy.all(y_offset == 0):
+        return samples.astype(float)
+    return samples.astype(float)*y_scale + y_offset
+
+def waveform_time(number_points:int, x_origin:float, x_increment:float):
+    # Same operation order as the converter used for the version 1 schema, so the time values are bit-identical
+    return numpy.arange(number_points) * x_increment + x_origin
+
+def read_compact_waveform(sqlite3_connection:sqlite3.Connection, n_trigger:int, channel_idx:int, waveform_idx:int=0, schema_version:int=2, sample_codec:str="none"):
+    # Returns the time and amplitude arrays of a single waveform from a version 2 or 3 SQLite file, or None if it does not exist
+    scaling_columns = 'w.y_scale, w.y_offset' if schema_version >= 3 else '1, 0'
+    row = sqlite3_connection.execute(
+        'SELECT w.samples, w.sample_dtype, {}, m.number_points, m.x_origin, m.x_increment FROM waveforms AS w '.format(scaling_columns) +
+        'JOIN waveform_metadata AS m ON w.n_trigger = m.n_trigger AND w.channel_idx = m.channel_idx AND w.waveform_idx = m.waveform_idx '
+        'WHERE w.n_trigger = ? AND w.channel_idx = ? AND w.waveform_idx = ?',
+        (n_trigger, channel_idx, waveform_idx)
+    ).fetchone()
+    if row is None:
+        return None
+    samples, sample_dtype, y_scale, y_offset, number_points, x_origin, x_increment = row
+    return waveform_time(number_points, x_origin, x_increment), scale_samples(decode_samples(samples, sample_dtype, sample_codec), y_scale, y_offset)
+
+def expand_compact_waveforms(waveforms_df:pandas.DataFrame, waveform_metadata_df:pandas.DataFrame, sample_codec:str="none"):
+    # Rebuilds the one row per sample layout of the version 1 schema from version 2 or 3 waveform rows and their metadata
+    keys = ["n_trigger", "channel_idx", "waveform_idx"]
+    if any(name is not None for name in waveforms_df.index.names):
+        waveforms_df = waveforms_df.reset_index()
+    if any(name is not None for name in waveform_metadata_df.index.names):
+        waveform_metadata_df = waveform_metadata_df.reset_index()
+
+    merged_df = waveforms_df.merge(waveform_metadata_df[keys + ["x_origin", "x_increment"]], on=keys, how="left")
+    number_points = merged_df["number_points"].to_numpy()
+
+    x_idx = numpy.concatenate([numpy.arange(points) for points in number_points] + [numpy.zeros(0, dtype=int)])
+    y_scale = merged_df["y_scale"] if "y_scale" in merged_df.columns else numpy.ones(len(merged_df))
+    y_offset = merged_df["y_offset"] if "y_offset" in merged_df.columns else numpy.zeros(len(merged_df))
+    decoded_samples = decode_sample_blobs(merged_df["samples"].tolist(), merged_df["sample_dtype"].tolist(), sample_codec)
+    y = numpy.concatenate([scale_samples(samples, scale, offset) for samples, scale, offset in zip(decoded_samples, y_scale, y_offset)] + [numpy.zeros(0)])
+
+    samples_df = pandas.DataFrame(
+                                    {
+                                        "channel_idx": numpy.repeat(merged_df["channel_idx"].to_numpy(), number_points),
+                                        "waveform_idx": numpy.repeat(merged_df["waveform_idx"].to_numpy(), number_points),
+                                        "n_trigger": numpy.repeat(merged_df["n_trigger"].to_numpy(), number_points),
+                                        "x": x_idx * numpy.repeat(merged_df["x_increment"].to_numpy(), number_points) + numpy.repeat(merged_df["x_origin"].to_numpy(), number_points),
+                                        "y": y,
+                                        "x_idx": x_idx,
+                                    }
+                                )
+    samples_df.set_index(["n_trigger", "channel_idx", "waveform_idx", "x_idx"], inplace=True)
+    return samples_df
+
+def combined_waveform_key(dataframe:pandas.DataFrame, channel_count:int, waveform_count:int):
+    # Single integer for the (n_trigger, channel_idx, waveform_idx) key columns, which sorts in the same order as the columns
+    n_trigger = dataframe["n_trigger"].to_numpy(dtype=numpy.int64)
+    channel_idx = dataframe["channel_idx"].to_numpy(dtype=numpy.int64)
+    waveform_idx = dataframe["waveform_idx"].to_numpy(dtype=numpy.int64)
+    return (n_trigger*channel_count + channel_idx)*waveform_count + waveform_idx
+
+def waveform_rows(keys_df:pandas.DataFrame, metadata_df:pandas.DataFrame):
+    # Position in metadata_df, which must be sorted by the key columns, of the waveform of every row of keys_df.
+    # The rows are found with a binary search on the combined keys instead of a merge
+    channel_count = int(metadata_df["channel_idx"].max()) + 1
+    waveform_count = int(metadata_df["waveform_idx"].max()) + 1
+    return numpy.searchsorted(
+                                combined_waveform_key(metadata_df, channel_count, waveform_count),
+                                combined_waveform_key(keys_df, channel_count, waveform_count),
+                            )
+
+def read_waveform_array(path:Path, output_format:str, trigger_range:tuple, schema_version:int=None, channel_idx:int=None, sample_codec:str=None):
+    # Reads the waveforms of a (first, last) range of triggers, optionally of a single channel, into a 2D float array with one row per waveform, for either schema version.
+    # Shorter waveforms are padded with NaN. Returns the metadata of the waveforms, sorted by the key columns and in the same order as
+    # the rows of the array, with their number of points and time axis, and the array
+    if schema_version is None:
+        schema_version = read_schema_version(path, output_format)
+    if sample_codec is None and schema_version >= 2:
+        sample_codec = read_sample_codec(path, output_format)
+    keys = ["n_trigger", "channel_idx", "waveform_idx"]
+
+    metadata_df = read_table(path, output_format, 'waveform_metadata', columns=keys + ["number_points", "x_origin", "x_increment"], trigger_range=trigger_range, channel_idx=channel_idx)
+    metadata_df = metadata_df.sort_values(keys, ignore_index=True)
+    if len(metadata_df) == 0:
+        return metadata_df, numpy.zeros((0, 0))
+
+    samples = numpy.full((len(metadata_df), int(metadata_df["number_points"].max())), numpy.nan)
+
+    if schema_version >= 2:
+        scaling_columns = ["y_scale", "y_offset"] if schema_version >= 3 else []
+        waveforms_df = read_table(path, output_format, 'waveforms', columns=keys + ["number_points", "sample_dtype", "samples"] + scaling_columns, trigger_range=trigger_range, channel_idx=channel_idx)
+        rows = waveform_rows(waveforms_df, metadata_df)
+        if sample_codec == "none" and waveforms_df["sample_dtype"].nunique() == 1 and (waveforms_df["number_points"] == samples.shape[1]).all(): # Same length and type, decoded in one go
+            samples[rows] = decode_samples(b"".join(waveforms_df["samples"]), waveforms_df["sample_dtype"].iloc[0]).reshape(len(waveforms_df), samples.shape[1])
+        else:
+            for row, waveform_y in zip(rows, decode_sample_blobs(waveforms_df["samples"].tolist(), waveforms_df["sample_dtype"].tolist(), sample_codec)):
+                samples[row, :len(waveform_y)] = waveform_y
+        if len(scaling_columns) > 0: # Scaled in place, the padding stays NaN
+            y_scale = numpy.ones(len(metadata_df))
+            y_offset = numpy.zeros(len(metadata_df))
+            y_scale[rows] = waveforms_df["y_scale"].to_numpy()
+            y_offset[rows] = waveforms_df["y_offset"].to_numpy()
+            if not (numpy.all(y_scale == 1) and numpy.all(y_offset == 0)):
+                samples *= y_scale[:, numpy.newaxis]
+                samples += y_offset[:, numpy.newaxis]
+        return metadata_df, samples
+
+    waveforms_df = read_table(path, output_format, 'waveforms', columns=keys + ["x_idx", "y"], trigger_range=trigger_range, channel_idx=channel_idx)
+    samples[waveform_rows(waveforms_df, metadata_df), waveforms_df["x_idx"].to_numpy()] = waveforms_df["y"].to_numpy()
+    return metadata_df, samples
+
+class WaveformStore:
+    """Random access to the waveforms of a run converted by convert_scope_data, for either output format and schema version.
+
+    The waveform metadata is loaded when the store is opened and indexed by (n_trigger, channel_idx, waveform_idx) in a
+    dense array, so a waveform is located in constant time without scanning the tables. The samples are only read on
+    request, in blocks of block_size consecutive triggers of the same channel, and kept in a least recently used cache
+    of at most cache_bytes, in the type they are stored with and scaled when returned. Slices of triggers and iterating
+    over the run in chunks bypass the cache.
+    """
+    def __init__(self, path:Path, output_format:str=None, cache_bytes:int=256*2**20, block_size:int=None):
+        self.path = Path(path)
+        if output_format is None:
+            output_format = self.path.suffix.lstrip('.')
+        if output_format not in output_writers:
+            raise ValueError("Unknown output format {}, it should be one of {}".format(output_format, list(output_writers)))
+        self.output_format = output_format
+        self.schema_version = read_schema_version(self.path, self.output_format)
+        self.sample_codec = read_sample_codec(self.path, self.output_format)
+
+        keys = ["n_trigger", "channel_idx", "waveform_idx"]
+        self.metadata = read_table(self.path, self.output_format, 'waveform_metadata', columns=keys + ["number_points", "x_origin", "x_increment"])
+        self.metadata = self.metadata.sort_values(keys, ignore_index=True)
+
+        self.channels = {}
+        if table_exists(self.path, self.output_format, 'channel_map'):
+            channel_map_df = read_table(self.path, self.output_format, 'channel_map')
+            self.channels = dict(zip(channel_map_df["channel_name"], channel_map_df["channel_idx"].astype(int)))
+
+        index_shape = tuple(int(self.metadata[key].max()) + 1 if len(self.metadata) > 0 else 0 for key in keys)
+        self._rows = numpy.full(index_shape, -1, dtype=numpy.int64)
+        self._rows[tuple(self.metadata[key].to_numpy() for key in keys)] = numpy.arange(len(self.metadata))
+        self._channel_idx = self.metadata["channel_idx"].to_numpy()
+        self._number_points = self.metadata["number_points"].to_numpy()
+        self._x_origin = self.metadata["x_origin"].to_numpy()
+        self._x_increment = self.metadata["x_increment"].to_numpy()
+        self._y_scale = numpy.ones(len(self.metadata))
+        self._y_offset = numpy.zeros(len(self.metadata))
+        if self.schema_version >= 3:
+            scaling_df = read_table(self.path, self.output_format, 'waveforms', columns=keys + ["y_scale", "y_offset"])
+            scaling_rows = self._rows[tuple(scaling_df[key].to_numpy() for key in keys)]
+            self._y_scale[scaling_rows] = scaling_df["y_scale"].to_numpy()
+            self._y_offset[scaling_rows] = scaling_df["y_offset"].to_numpy()
+            del scaling_df
+
+        if block_size is None: # Parquet reads whole row groups, so reading more triggers at once costs little more
+            block_size = 256 if self.output_format == "parquet" else 1
+        self.block_size = block_size
+        self.cache_bytes = cache_bytes
+        self._cache = OrderedDict()
+        self._cached_bytes = 0
+        self.statistics = {"hits": 0, "misses": 0}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, err_type, err_value, err_traceback):
+        self.clear_cache()
+
+    def __len__(self):
+        return len(self.metadata)
+
+    @property
+    def num_triggers(self):
+        return self._rows.shape[0]
+
+    def channel_index(self, channel):
+        # The channels are given either by their index or by their name in the channel map
+        if isinstance(channel, str):
+            return self.channels[channel]
+        return int(channel)
+
+    def _row(self, n_trigger:int, channel_idx:int, waveform_idx:int=None):
+        if n_trigger < 0 or n_trigger >= self._rows.shape[0] or channel_idx < 0 or channel_idx >= self._rows.shape[1]:
+            raise KeyError("There is no waveform for trigger {} and channel {}".format(n_trigger, channel_idx))
+        if waveform_idx is None: # The first waveform of the channel, there is usually only one
+            rows = self._rows[n_trigger, channel_idx]
+            rows = rows[rows >= 0]
+            row = rows[0] if len(rows) > 0 else -1
+        elif 0 <= waveform_idx < self._rows.shape[2]:
+            row = self._rows[n_trigger, channel_idx, waveform_idx]
+        else:
+            row = -1
+        if row < 0:
+            raise KeyError("There is no waveform for trigger {} and channel {}".format(n_trigger, channel_idx))
+        return int(row)
+
+    def time(self, row:int):
+        return waveform_time(int(self._number_points[row]), self._x_origin[row], self._x_increment[row])
+
+    def waveform(self, n_trigger:int, channel, waveform_idx:int=None):
+        # Returns the time and amplitude arrays of a single waveform, raises a KeyError if it does not exist
+        row = self._row(int(n_trigger), self.channel_index(channel), waveform_idx)
+        if row in self._cache:
+            self.statistics["hits"] += 1
+            self._cache.move_to_end(row)
+            y = self._cache[row]
+        else:
+            self.statistics["misses"] += 1
+            y = self._load_block(int(n_trigger), int(self._channel_idx[row]), row)
+        return self.time(row), scale_samples(y, self._y_scale[row], self._y_offset[row])
+
+    def _load_block(self, n_trigger:int, channel_idx:int, requested_row:int):
+        # Reads the block of triggers of the requested waveform into the cache, and returns the samples of the requested waveform
+        keys = ["n_trigger", "channel_idx", "waveform_idx"]
+        first_trigger = n_trigger - n_trigger%self.block_size
+        trigger_range = (first_trigger, first_trigger + self.block_size - 1)
+        if self.schema_version >= 2: # Kept in the stored type, e.g. one byte per sample for 8 bit ADC counts
+            waveforms_df = read_table(self.path, self.output_format, 'waveforms', columns=keys + ["sample_dtype", "samples"], trigger_range=trigger_range, channel_idx=channel_idx)
+            block_rows = self._rows[tuple(waveforms_df[key].to_numpy() for key in keys)]
+            block_samples = decode_sample_blobs(waveforms_df["samples"].tolist(), waveforms_df["sample_dtype"].tolist(), self.sample_codec)
+            del waveforms_df
+        else:
+            block_metadata_df, samples = read_waveform_array(self.path, self.output_format, trigger_range, self.schema_version, channel_idx, self.sample_codec)
+            block_rows = self._rows[tuple(block_metadata_df[key].to_numpy() for key in keys)]
+            block_samples = [y[:number_points].copy() for number_points, y in zip(block_metadata_df["number_points"].to_numpy(), samples)]
+            del block_metadata_df
+            del samples
+        for row, y in zip(block_rows, block_samples):
+            if row != requested_row:
+                self._cache_put(int(row), y)
+        # The requested waveform is added last, so it is the most recently used one and not evicted by the rest of the block
+        requested_y = block_samples[numpy.flatnonzero(block_rows == requested_row)[0]]
+        self._cache_put(requested_row, requested_y)
+        return requested_y
+
+    def _cache_put(self, row:int, y:numpy.ndarray):
+        if y.nbytes > self.cache_bytes:
+            return
+        if row in self._cache:
+            self._cached_bytes -= self._cache.pop(row).nbytes
+        self._cache[row] = y
+        self._cached_bytes += y.nbytes
+        while self._cached_bytes > self.cache_bytes:
+            _, evicted_y = self._cache.popitem(last=False)
+            self._cached_bytes -= evicted_y.nbytes
+
+    def clear_cache(self):
+        self._cache.clear()
+        self._cached_bytes = 0
+
+    def triggers(self, first_trigger:int, last_trigger:int, channel=None):
+        # Returns the metadata, the 2D time array and the 2D amplitude array, padded with NaN, of the waveforms of a range of triggers, optionally of a single channel
+        channel_idx = None
+        if channel is not None:
+            channel_idx = self.channel_index(channel)
+        metadata_df, samples = read_waveform_array(self.path, self.output_format, (first_trigger, last_trigger), self.schema_version, channel_idx, self.sample_codec)
+        x_idx = numpy.arange(samples.shape[1])
+        times = numpy.where(x_idx < metadata_df["number_points"].to_numpy()[:, None], x_idx * metadata_df["x_increment"].to_numpy()[:, None] + metadata_df["x_origin"].to_numpy()[:, None], numpy.nan)
+        return metadata_df, times, samples
+
+    def iter_chunks(self, chunk_size:int=1000, channel=None):
+        # Yields the result of triggers for consecutive chunks of chunk_size triggers covering the whole run, so it can be processed with bounded memory
+        for first_trigger in range(0, self.num_triggers, chunk_size):
+            yield self.triggers(first_trigger, first_trigger + chunk_size - 1, channel)